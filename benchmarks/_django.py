@@ -0,0 +1,29 @@
+"""Shared setup for the benchmark scripts."""
+import contextlib
+import logging
+import os
+
+
+@contextlib.contextmanager
+def django_test_database():
+    """Configure Django and run the block against a throwaway test database."""
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pc_usage_manager.settings')
+    import django
+    django.setup()
+
+    from django.conf import settings
+    from django.db import connection
+    from django.test.utils import setup_test_environment, teardown_test_environment
+
+    # One client drives every request, so the rate limits would answer most of them with 429
+    settings.TIME_THROTTLE = {**settings.TIME_THROTTLE, 'RATES': {}}
+    # Keep per-request log events out of the results
+    logging.getLogger('time_management').setLevel(logging.WARNING)
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
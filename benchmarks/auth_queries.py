@@ -0,0 +1,60 @@
+"""
+Per-request cost of the time endpoints with database-backed and stateless
+JWT authentication.
+
+    python -m benchmarks.auth_queries [--requests 500]
+"""
+import argparse
+import time
+from benchmarks._django import django_test_database
+
+
+def run(authentication_classes, requests):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from django.urls import reverse
+    from rest_framework.test import APIClient
+    from time_management.views import UserTimeView
+
+    client = APIClient()
+    response = client.post(reverse('login'), {'username': 'bench', 'password': 'bench-password-123'}, format='json')
+    headers = {'HTTP_AUTHORIZATION': f"Bearer {response.data['access']}"}
+    url = reverse('add-user-minutes', kwargs={'username': 'bench'})
+
+    original = UserTimeView.authentication_classes
+    UserTimeView.authentication_classes = authentication_classes
+    try:
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            for _ in range(requests):
+                client.patch(url, {'add_minutes': 1}, format='json', **headers)
+            elapsed = time.perf_counter() - start
+    finally:
+        UserTimeView.authentication_classes = original
+    return len(queries) / requests, elapsed / requests * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=500)
+    args = parser.parse_args()
+
+    with django_test_database():
+        from django.contrib.auth.models import User
+        from rest_framework.authentication import SessionAuthentication
+        from rest_framework_simplejwt.authentication import JWTAuthentication
+        from time_management.authentication import StatelessJWTAuthentication
+
+        User.objects.create_user(username='bench', password='bench-password-123')
+        modes = {
+            'database user (JWTAuthentication)': [SessionAuthentication, JWTAuthentication],
+            'stateless claims (StatelessJWTAuthentication)': [SessionAuthentication, StatelessJWTAuthentication],
+        }
+        print(f"{'mode':<48} {'queries/req':>12} {'ms/req':>8}")
+        for name, classes in modes.items():
+            queries, ms = run(classes, args.requests)
+            print(f"{name:<48} {queries:>12.2f} {ms:>8.3f}")
+
+
+if __name__ == '__main__':
+    main()
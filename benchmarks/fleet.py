@@ -0,0 +1,292 @@
+"""
+Load test that simulates a fleet of client PCs against a running server.
+
+Seeds ``--users`` accounts in the server's database (the one selected by the
+usual settings, so SQLite by default or PostgreSQL with PRODUCTION and
+DATABASE_URL), logs every simulated PC in, then drives a weighted mix of
+remaining-time syncs, cashier top-ups, token refreshes and logout/login
+cycles from ``--concurrency`` threads for ``--duration`` seconds.
+
+    python manage.py migrate
+    TIME_THROTTLE_ENABLED=False python manage.py runserver --noreload &
+    python -m benchmarks.fleet --users 500 --concurrency 50 --duration 60 --save-baseline baseline.json
+    python -m benchmarks.fleet --users 500 --concurrency 50 --duration 60 --compare baseline.json
+
+Throughput and p50/p95/p99 latency are reported per operation. Queries per
+request come from the server's /metrics endpoint, so scrape access
+(METRICS_TOKEN) must match. Every simulated PC shares this machine's
+address, so the server must run with its rate limits off
+(TIME_THROTTLE_ENABLED=False); the run stops if it answers 429.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+PASSWORD = 'fleet-password-123'
+
+# Operation -> relative weight in the mix
+MIX = {
+    'sync': 70,
+    'add_minutes': 10,
+    'refresh': 10,
+    'relogin': 10,
+}
+
+# Operation -> view names recorded by MetricsMiddleware
+OPERATION_VIEWS = {
+    'login': ('login',),
+    'sync': ('sync-user-remaining-time',),
+    'add_minutes': ('add-user-minutes',),
+    'refresh': ('token_refresh',),
+    'relogin': ('logout', 'login'),
+}
+
+
+def seed_users(count, prefix):
+    """Create ``count`` users with balances in bulk, reusing one password hash."""
+    from datetime import timedelta
+    from django.contrib.auth.hashers import make_password
+    from django.contrib.auth.models import User
+    from time_management.models import UserTime
+
+    usernames = [f"{prefix}{i}" for i in range(count)]
+    existing = set(User.objects.filter(username__in=usernames).values_list('username', flat=True))
+    password = make_password(PASSWORD)
+    User.objects.bulk_create(
+        [User(username=username, password=password) for username in usernames if username not in existing],
+        batch_size=1000,
+    )
+    user_ids = User.objects.filter(username__in=usernames).values_list('id', flat=True)
+    UserTime.objects.bulk_create(
+        [UserTime(user_id=user_id, remaining_time=timedelta(hours=10)) for user_id in user_ids],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+    return usernames
+
+
+class Client:
+    """One keep-alive HTTP connection per worker thread."""
+
+    def __init__(self, base_url, host_header, metrics_token=None):
+        parts = urlsplit(base_url)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip('/')
+        self.host_header = host_header
+        self.metrics_token = metrics_token
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, token=None):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self.connection_class(self.netloc, timeout=30)
+        headers = {'Host': self.host_header, 'Content-Type': 'application/json'}
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
+        try:
+            connection.request(method, self.prefix + path, body=json.dumps(body) if body is not None else None, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            self._local.connection = None
+            connection.close()
+            raise
+        return response.status, data
+
+    def scrape_queries(self):
+        """Return ``{view: (requests, queries)}`` from the server's /metrics."""
+        connection = self.connection_class(self.netloc, timeout=30)
+        headers = {'Host': self.host_header}
+        if self.metrics_token:
+            headers['Authorization'] = f'Bearer {self.metrics_token}'
+        connection.request('GET', '/metrics', headers=headers)
+        text = connection.getresponse().read().decode()
+        connection.close()
+        totals = defaultdict(lambda: [0, 0])
+        for name, view, value in re.findall(
+            r'^(http_request_duration_seconds_count|http_request_db_queries_total)\{view="([^"]+)"[^}]*\} (\S+)$',
+            text, re.MULTILINE,
+        ):
+            totals[view][0 if name == 'http_request_duration_seconds_count' else 1] += float(value)
+        return totals
+
+
+class PC:
+    """A simulated client PC holding one user's tokens."""
+
+    def __init__(self, client, username):
+        self.client = client
+        self.username = username
+        self.access = self.refresh = None
+        self.remaining = 36000
+
+    def login(self):
+        status, data = self.client.request('POST', '/api/login/', {'username': self.username, 'password': PASSWORD})
+        if status != 200:
+            return status
+        body = json.loads(data)
+        self.access, self.refresh = body['access'], body['refresh']
+        return status
+
+    def run(self, operation):
+        if operation == 'sync':
+            self.remaining = max(self.remaining - 5, 0)
+            return self.client.request(
+                'PATCH', f'/api/users/{self.username}/time/update/', {'remaining_time': self.remaining}, self.access,
+            )[0]
+        if operation == 'add_minutes':
+            return self.client.request('PATCH', f'/api/users/{self.username}/time/', {'add_minutes': 15}, self.access)[0]
+        if operation == 'refresh':
+            status, data = self.client.request('POST', '/api/api/token/refresh/', {'refresh': self.refresh})
+            if status == 200:
+                self.access = json.loads(data)['access']
+            return status
+        if operation == 'relogin':
+            status = self.client.request('POST', '/api/logout/', {'refresh': self.refresh}, self.access)[0]
+            return max(status, self.login())
+        raise ValueError(operation)
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+def summarize(latencies, errors, elapsed, before, after):
+    results = {}
+    for operation, samples in sorted(latencies.items()):
+        samples.sort()
+        requests = queries = 0
+        for view in OPERATION_VIEWS[operation]:
+            requests += after[view][0] - before[view][0]
+            queries += after[view][1] - before[view][1]
+        results[operation] = {
+            'requests': len(samples),
+            'errors': errors[operation],
+            'throughput': len(samples) / elapsed,
+            'p50_ms': percentile(samples, 0.50) * 1000,
+            'p95_ms': percentile(samples, 0.95) * 1000,
+            'p99_ms': percentile(samples, 0.99) * 1000,
+            'queries_per_request': queries / requests if requests else None,
+        }
+    total = sum(len(samples) for samples in latencies.values())
+    results['total'] = {'requests': total, 'throughput': total / elapsed}
+    return results
+
+
+def report(results, baseline=None):
+    print(f"{'operation':<12} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>8}")
+    for operation, row in results.items():
+        if operation == 'total':
+            continue
+        queries = f"{row['queries_per_request']:.2f}" if row['queries_per_request'] is not None else '-'
+        print(f"{operation:<12} {row['requests']:>9} {row['errors']:>7} {row['throughput']:>9.1f} "
+              f"{row['p50_ms']:>8.2f} {row['p95_ms']:>8.2f} {row['p99_ms']:>8.2f} {queries:>8}")
+        if baseline and operation in baseline:
+            base = baseline[operation]
+            print(f"{'  vs base':<12} {'':>9} {'':>7} {_delta(row['throughput'], base['throughput']):>9} "
+                  f"{_delta(row['p50_ms'], base['p50_ms']):>8} {_delta(row['p95_ms'], base['p95_ms']):>8} "
+                  f"{_delta(row['p99_ms'], base['p99_ms']):>8}")
+    print(f"total: {results['total']['requests']} requests, {results['total']['throughput']:.1f} req/s")
+
+
+def _delta(value, base):
+    return f"{(value - base) / base * 100:+.0f}%" if base else '-'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--base-url', default='http://127.0.0.1:8000')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--prefix', default='fleet-pc-', help="Username prefix of the seeded users.")
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=30, help="Seconds to drive the mix for.")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed for the operation mix.")
+    parser.add_argument('--save-baseline', metavar='PATH')
+    parser.add_argument('--compare', metavar='PATH', help="Baseline JSON to compare against.")
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pc_usage_manager.settings')
+    import django
+    django.setup()
+    from django.conf import settings
+
+    usernames = seed_users(args.users, args.prefix)
+    host_header = settings.ALLOWED_HOSTS[0] if settings.ALLOWED_HOSTS else urlsplit(args.base_url).netloc
+    client = Client(args.base_url, host_header, getattr(settings, 'METRICS_TOKEN', None))
+
+    pcs = [PC(client, username) for username in usernames]
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        statuses = list(executor.map(PC.login, pcs))
+    if 429 in statuses:
+        parser.error("The server is rate limiting the fleet; start it with TIME_THROTTLE_ENABLED=False.")
+    print(f"Seeded and logged in {len(pcs)} PCs; running for {args.duration:.0f}s at concurrency {args.concurrency}.")
+
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+    throttled = threading.Event()
+    deadline = time.monotonic() + args.duration
+    operations, weights = zip(*MIX.items())
+
+    def worker(index):
+        rng = random.Random(args.seed + index)
+        own = pcs[index::args.concurrency] or pcs
+        local_latencies, local_errors = defaultdict(list), defaultdict(int)
+        while time.monotonic() < deadline:
+            pc = rng.choice(own)
+            operation = rng.choices(operations, weights)[0]
+            start = time.perf_counter()
+            try:
+                status = pc.run(operation)
+            except (http.client.HTTPException, OSError, ValueError, KeyError):
+                status = 599
+            local_latencies[operation].append(time.perf_counter() - start)
+            if status >= 400:
+                local_errors[operation] += 1
+            if status == 429:
+                throttled.set()
+        with lock:
+            for operation, samples in local_latencies.items():
+                latencies[operation].extend(samples)
+            for operation, count in local_errors.items():
+                errors[operation] += count
+
+    before = client.scrape_queries()
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(worker, range(args.concurrency)))
+    elapsed = time.monotonic() - start
+    after = client.scrape_queries()
+
+    if throttled.is_set():
+        parser.error("The server rate limited requests during the run; start it with TIME_THROTTLE_ENABLED=False.")
+    results = summarize(latencies, errors, elapsed, before, after)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    report(results, baseline)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({
+                'config': {key: getattr(args, key) for key in ('users', 'concurrency', 'duration', 'seed')},
+                'database': settings.DATABASES['default']['ENGINE'],
+                'results': results,
+            }, f, indent=2)
+        print(f"Saved baseline to {args.save_baseline}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Logins per second per core during a login storm (every PC of a shift
+logging in at once) for each password hashing policy.
+
+    python -m benchmarks.login_storm [--users 200] [--iterations 100000]
+
+Each policy hashes the users' passwords with its preferred hasher and logs
+every user in once through the login endpoint in this process, so the rate
+is what one core sustains. Argon2 is skipped unless argon2-cffi is installed.
+"""
+import argparse
+import time
+from benchmarks._django import django_test_database
+
+PASSWORD = 'bench-password-123'
+
+
+def run(usernames, hashers, **costs):
+    from django.contrib.auth.hashers import make_password
+    from django.contrib.auth.models import User
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext, override_settings
+    from django.urls import reverse
+    from rest_framework.test import APIClient
+
+    with override_settings(PASSWORD_HASHERS=hashers, **costs):
+        # One hash for everyone: the storm measures verification, not set-up
+        User.objects.filter(username__in=usernames).update(password=make_password(PASSWORD))
+        client = APIClient()
+        url = reverse('login')
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            for username in usernames:
+                response = client.post(url, {'username': username, 'password': PASSWORD}, format='json')
+                assert response.status_code == 200, response.content
+            elapsed = time.perf_counter() - start
+    return len(usernames) / elapsed, elapsed / len(usernames) * 1000, len(queries) / len(usernames)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--iterations', type=int, default=100000, help="PBKDF2 iterations of the tuned policy")
+    args = parser.parse_args()
+
+    with django_test_database():
+        from django.contrib.auth.hashers import PBKDF2PasswordHasher
+        from django.contrib.auth.models import User
+        from time_management.models import UserTime
+
+        usernames = [f'pc{index}' for index in range(args.users)]
+        users = User.objects.bulk_create([User(username=username) for username in usernames])
+        UserTime.objects.bulk_create([UserTime(user=user) for user in users])
+        policies = {
+            f'pbkdf2 {PBKDF2PasswordHasher.iterations} (default)': (
+                ['time_management.hashers.TunedPBKDF2PasswordHasher'], {'PASSWORD_HASH_ITERATIONS': None},
+            ),
+            f'pbkdf2 {args.iterations}': (
+                ['time_management.hashers.TunedPBKDF2PasswordHasher'], {'PASSWORD_HASH_ITERATIONS': args.iterations},
+            ),
+            'scrypt': (['django.contrib.auth.hashers.ScryptPasswordHasher'], {}),
+        }
+        try:
+            import argon2  # noqa: F401
+            policies['argon2'] = (['time_management.hashers.TunedArgon2PasswordHasher'], {})
+        except ImportError:
+            pass
+
+        print(f"{'policy':<28} {'logins/s':>9} {'ms/login':>9} {'queries':>8}")
+        for name, (hashers, costs) in policies.items():
+            rate, ms, queries = run(usernames, hashers, **costs)
+            print(f"{name:<28} {rate:>9.1f} {ms:>9.2f} {queries:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
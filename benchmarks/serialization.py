@@ -0,0 +1,59 @@
+"""
+Per-response cost of serializing and rendering a balance, with the previous
+ModelSerializer and DRF JSON renderer against the lean serializer and the
+fast renderer, plus parsing a request body with each parser.
+
+    python -m benchmarks.serialization [--responses 100000]
+"""
+import argparse
+import io
+import os
+import time
+
+
+def bench(label, call, responses):
+    start = time.perf_counter()
+    for _ in range(responses):
+        call()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<40} {elapsed / responses * 1e6:>8.2f} us/response")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--responses', type=int, default=100000)
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pc_usage_manager.settings')
+    import django
+    django.setup()
+    from datetime import timedelta
+    from django.contrib.auth.models import User
+    from rest_framework import serializers
+    from rest_framework.parsers import JSONParser
+    from rest_framework.renderers import JSONRenderer
+    from time_management import renderers
+    from time_management.models import UserTime
+    from time_management.renderers import FastJSONParser, FastJSONRenderer
+    from time_management.serializers import UserTimeSerializer
+
+    class ModelUserTimeSerializer(serializers.ModelSerializer):
+        user = serializers.StringRelatedField()
+        remaining_time = serializers.DurationField(source='current_remaining_time', read_only=True)
+
+        class Meta:
+            model = UserTime
+            fields = ['user', 'remaining_time']
+
+    user_time = UserTime(user=User(username='bench'), remaining_time=timedelta(minutes=90))
+    body = b'{"remaining_time": 5400, "device_id": "pc-01", "sequence": 1234}'
+    print(f"JSON library: {'orjson' if renderers.orjson else 'json'}")
+
+    bench("ModelSerializer + JSONRenderer", lambda: JSONRenderer().render(ModelUserTimeSerializer(user_time).data), args.responses)
+    bench("UserTimeSerializer + FastJSONRenderer", lambda: FastJSONRenderer().render(UserTimeSerializer(user_time).data), args.responses)
+    bench("JSONParser", lambda: JSONParser().parse(io.BytesIO(body)), args.responses)
+    bench("FastJSONParser", lambda: FastJSONParser().parse(io.BytesIO(body)), args.responses)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Overhead of a throttle check: the bucket store alone and the full check()
+path with settings lookup, for one hot client and for many clients.
+
+    python -m benchmarks.throttle [--checks 200000] [--clients 10000]
+"""
+import argparse
+import os
+import time
+
+
+def bench(label, take, checks):
+    start = time.perf_counter()
+    for index in range(checks):
+        take(index)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<40} {elapsed / checks * 1e6:>8.3f} us/check")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--checks', type=int, default=200000)
+    parser.add_argument('--clients', type=int, default=10000)
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pc_usage_manager.settings')
+    import django
+    django.setup()
+    from django.conf import settings
+    from time_management import throttling
+
+    # A rate high enough that every check takes a token
+    settings.TIME_THROTTLE = {**settings.TIME_THROTTLE, 'RATES': {'bench': f'{args.checks * 10}/s'}}
+    capacity, refill_rate = throttling.parse_rate(settings.TIME_THROTTLE['RATES']['bench'])
+    store = throttling.MemoryBucketStore()
+    clients = [f'bench:user:{client}' for client in range(args.clients)]
+
+    bench("store, one client", lambda index: store.take('bench:user:1', capacity, refill_rate, time.time()), args.checks)
+    bench(
+        f"store, {args.clients} clients",
+        lambda index: store.take(clients[index % args.clients], capacity, refill_rate, time.time()),
+        args.checks,
+    )
+    bench("check(), one client", lambda index: throttling.check('bench', 'user:1'), args.checks)
+    bench(
+        f"check(), {args.clients} clients",
+        lambda index: throttling.check('bench', clients[index % args.clients]),
+        args.checks,
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+Gunicorn configuration for serving pc_usage_manager over ASGI.
+
+    gunicorn pc_usage_manager.asgi:application -c gunicorn.conf.py
+
+Each uvicorn worker runs one event loop, so a single worker can hold
+thousands of idle-polling clients on the async endpoints under ``api/async/``.
+Every setting can be overridden from the environment.
+
+One worker is the default because the default balance cache, broker,
+throttle store and sync buffer keep their state per process. Set
+``WEB_CONCURRENCY`` above 1 only with the shared backends listed in
+time_management/deployment.py; the server refuses to start otherwise.
+"""
+import os
+import sys
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+worker_class = "uvicorn_worker.UvicornWorker"
+
+# One event loop per core is enough once the backends are shared; the async views never block on I/O
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+# Clients poll over long-lived connections
+keepalive = int(os.getenv("KEEPALIVE", "75"))
+timeout = int(os.getenv("WORKER_TIMEOUT", "30"))
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+
+# Recycle workers periodically to bound memory growth
+max_requests = int(os.getenv("MAX_REQUESTS", "10000"))
+max_requests_jitter = int(os.getenv("MAX_REQUESTS_JITTER", "1000"))
+
+accesslog = os.getenv("ACCESS_LOG", "-")
+errorlog = "-"
+
+
+def on_starting(server):
+    """Refuse to run several workers while a backend keeps its state in one process."""
+    if server.cfg.workers <= 1:
+        return
+    import django
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pc_usage_manager.settings')
+    django.setup()
+    from time_management.deployment import process_local_backends
+
+    problems = process_local_backends()
+    if problems:
+        server.log.error(
+            "Not starting %d workers: these backends keep their state in one process "
+            "(see time_management/deployment.py):\n  %s\nSet WEB_CONCURRENCY=1 or configure shared backends.",
+            server.cfg.workers, "\n  ".join(problems),
+        )
+        sys.exit(1)
+    server.log.warning("/metrics reports only the worker that answers each scrape.")
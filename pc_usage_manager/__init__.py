@@ -0,0 +1,5 @@
+import time
+
+# Reference point for the startup timing reported by ``manage.py bootstrap``;
+# this package is imported as soon as Django reads the settings.
+STARTED_AT = time.perf_counter()
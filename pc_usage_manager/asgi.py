@@ -3,6 +3,11 @@ ASGI config for pc_usage_manager project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+In production it is served by gunicorn with uvicorn workers, configured in
+``gunicorn.conf.py``::
+
+    gunicorn pc_usage_manager.asgi:application -c gunicorn.conf.py
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
@@ -0,0 +1,58 @@
+"""
+Production database settings built from ``DATABASE_URL`` and the environment.
+
+``DB_POOL`` picks how connections are managed:
+
+``psycopg`` (default for PostgreSQL)
+    A psycopg 3 connection pool per process (Django's ``OPTIONS['pool']``),
+    sized by ``DB_POOL_MIN_SIZE``/``DB_POOL_MAX_SIZE``; a request waits up
+    to ``DB_POOL_TIMEOUT`` seconds for a free connection. This is the mode
+    that reuses connections under the ASGI server: each request there runs
+    its sync code in a new thread context, so persistent connections are
+    not reused but pile up, one per request thread.
+``persistent``
+    Each thread keeps its connection for ``DB_CONN_MAX_AGE`` seconds and
+    checks it is alive before reusing it after a request. Only for the WSGI
+    server, whose worker threads serve request after request.
+``external``
+    An external transaction-mode pooler such as PgBouncer. Connections to it
+    persist, and server-side cursors are disabled because they do not survive
+    transaction pooling.
+``none`` (default for other databases)
+    A new connection per request.
+"""
+import os
+import dj_database_url
+
+POOL_MODES = ('persistent', 'psycopg', 'external', 'none')
+
+
+def _env(env, name, default, cast=int):
+    return cast(env[name]) if env.get(name) else default
+
+
+def database_config(url, env=os.environ):
+    """Return the ``DATABASES`` entry for ``url`` with the ``DB_*`` connection settings in ``env`` applied."""
+    default_mode = 'psycopg' if dj_database_url.parse(url)['ENGINE'] == 'django.db.backends.postgresql' else 'none'
+    mode = env.get('DB_POOL', default_mode).lower()
+    if mode not in POOL_MODES:
+        raise ValueError(f"DB_POOL must be one of {', '.join(POOL_MODES)}, not '{mode}'.")
+
+    config = dj_database_url.parse(
+        url,
+        conn_max_age=_env(env, 'DB_CONN_MAX_AGE', 600) if mode in ('persistent', 'external') else 0,
+        conn_health_checks=mode in ('persistent', 'external'),
+        disable_server_side_cursors=mode == 'external',
+    )
+    options = config.setdefault('OPTIONS', {})
+    if env.get('DB_CONNECT_TIMEOUT'):
+        options['connect_timeout'] = int(env['DB_CONNECT_TIMEOUT'])
+    if mode == 'psycopg':
+        options['pool'] = {
+            'min_size': _env(env, 'DB_POOL_MIN_SIZE', 2),
+            'max_size': _env(env, 'DB_POOL_MAX_SIZE', 10),
+            'timeout': _env(env, 'DB_POOL_TIMEOUT', 10.0, float),
+            'max_idle': _env(env, 'DB_POOL_MAX_IDLE', 300.0, float),
+            'max_lifetime': _env(env, 'DB_POOL_MAX_LIFETIME', 3600.0, float),
+        }
+    return config
@@ -11,9 +11,8 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 import os
 from pathlib import Path
-import dj_database_url
+from pc_usage_manager.database import database_config
 from datetime import timedelta
-from tutorial.settings import SECRET_KEY
 
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -55,6 +54,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'time_management.metrics.MetricsMiddleware',
+    'time_management.routers.PrimaryPinMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -86,14 +87,29 @@ WSGI_APPLICATION = 'pc_usage_manager.wsgi.application'
 
 
 REST_FRAMEWORK = {
+    # Session authentication is free for requests without a session cookie.
+    # TokenAuthentication is not listed: rest_framework.authtoken is not installed.
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework.authentication.SessionAuthentication',
-        'rest_framework.authentication.TokenAuthentication',
         'rest_framework_simplejwt.authentication.JWTAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
+    # Views opt in with a throttle_scope rated in TIME_THROTTLE['RATES']
+    'DEFAULT_THROTTLE_CLASSES': [
+        'time_management.throttling.TokenBucketThrottle',
+    ],
+    # orjson-backed when installed, stdlib json otherwise; same output
+    'DEFAULT_RENDERER_CLASSES': [
+        'time_management.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'time_management.renderers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
 }
 
 SIMPLE_JWT = {
@@ -109,8 +125,93 @@ SIMPLE_JWT = {
     'USER_ID_CLAIM': 'user_id',
     'AUTH_TOKEN_CLASSES': ('rest_framework_simplejwt.tokens.AccessToken',),
     'TOKEN_TYPE_CLAIM': 'token_type',
+    'TOKEN_OBTAIN_SERIALIZER': 'time_management.serializers.ClaimsTokenObtainPairSerializer',
+    'TOKEN_REFRESH_SERIALIZER': 'time_management.serializers.ClaimsTokenRefreshSerializer',
+}
+
+# Answer refresh-time blacklist checks from an in-process set of blacklisted
+# JTIs, rebuilt every REBUILD_INTERVAL seconds (see time_management/tokens.py).
+# Tokens blacklisted by another process may refresh until the next rebuild.
+TOKEN_BLACKLIST_FILTER = {
+    'ENABLED': os.getenv("TOKEN_BLACKLIST_FILTER", "False").lower() in ("true", "1"),
+    'REBUILD_INTERVAL': float(os.getenv("TOKEN_BLACKLIST_FILTER_INTERVAL", "30")),
 }
 
+# Authenticate the time endpoints from the access token claims (user id,
+# username, staff flag) without loading the user row on every request.
+TIME_JWT_STATELESS = os.getenv("TIME_JWT_STATELESS", "True").lower() in ("true", "1")
+
+
+# Time sync
+# Maximum number of items accepted by the bulk time sync endpoint.
+TIME_BULK_SYNC_MAX_ITEMS = int(os.getenv("TIME_BULK_SYNC_MAX_ITEMS", "1000"))
+
+# Buffer heartbeat syncs in memory and persist them in bulk (see time_management/buffer.py).
+# The default MemoryStore is per process; with more than one worker use
+# time_management.buffer.CacheStore and TIME_SYNC_STORE_ALIAS naming a shared cache.
+TIME_SYNC_WRITE_BEHIND = {
+    'ENABLED': os.getenv("TIME_SYNC_WRITE_BEHIND", "False").lower() in ("true", "1"),
+    'FLUSH_INTERVAL': float(os.getenv("TIME_SYNC_FLUSH_INTERVAL", "5")),
+    'STORE': os.getenv("TIME_SYNC_STORE", 'time_management.buffer.MemoryStore'),
+    'STORE_OPTIONS': {'alias': os.environ["TIME_SYNC_STORE_ALIAS"]} if os.getenv("TIME_SYNC_STORE_ALIAS") else {},
+}
+
+# Bulk user provisioning (see time_management/provisioning.py): the most users
+# accepted per request and the threads hashing their passwords (default: one per CPU).
+TIME_PROVISION_MAX_ITEMS = int(os.getenv("TIME_PROVISION_MAX_ITEMS", "5000"))
+TIME_PROVISION_WORKERS = int(os.environ["TIME_PROVISION_WORKERS"]) if os.getenv("TIME_PROVISION_WORKERS") else None
+
+# Token-bucket limits per client and endpoint scope, as '<requests>/<s|min|hour|day>'
+# (see time_management/throttling.py). Use CacheBucketStore with
+# STORE_OPTIONS {'alias': ...} to share limits between processes. TIME_THROTTLE_ENABLED=False
+# clears the rates, e.g. for load tests that drive many clients from one address.
+TIME_THROTTLE = {
+    'STORE': os.getenv("TIME_THROTTLE_STORE", 'time_management.throttling.MemoryBucketStore'),
+    'STORE_OPTIONS': {},
+    'RATES': {} if os.getenv("TIME_THROTTLE_ENABLED", "True").lower() not in ("true", "1") else {
+        'login': os.getenv("TIME_THROTTLE_LOGIN", "10/min"),  # Per username
+        'login_ip': os.getenv("TIME_THROTTLE_LOGIN_IP", "120/min"),  # Per IP address, shared by a lab's PCs
+        'register': '20/hour',  # Per IP address
+        'sync': os.getenv("TIME_THROTTLE_SYNC", "60/min"),
+        'time': '60/min',
+        'session': '30/min',
+        'bulk': '60/min',
+        'reports': '30/min',
+    },
+}
+
+# Threads used by the async login view for password hashing (see time_management/async_views.py).
+ASYNC_AUTH_WORKERS = int(os.getenv("ASYNC_AUTH_WORKERS", "4"))
+
+# Balance change streaming (see time_management/pubsub.py). Use RedisBroker
+# with OPTIONS {'url': ...} when running more than one process.
+TIME_PUBSUB = {
+    'BACKEND': os.getenv("TIME_PUBSUB_BACKEND", 'time_management.pubsub.InProcessBroker'),
+    'OPTIONS': {'url': os.environ["TIME_PUBSUB_URL"]} if os.getenv("TIME_PUBSUB_URL") else {},
+}
+TIME_STREAM_KEEPALIVE = 15  # Seconds between keepalive comments on idle streams
+TIME_STREAM_EXPIRY_WARNING = 60  # Seconds before a running session runs out to send an 'expiring' event
+
+# Request metrics served on /metrics (see time_management/metrics.py).
+# Requests slower than the threshold (seconds) are logged with their SQL.
+METRICS_SLOW_REQUEST_THRESHOLD = float(os.environ["METRICS_SLOW_REQUEST_THRESHOLD"]) if os.getenv("METRICS_SLOW_REQUEST_THRESHOLD") else None
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+# Balance reads are served from this cache (CACHES['balances'] below) and kept current by every
+# balance write that sees it. The default local-memory cache only sees writes made in its own
+# process: those of runexpiryscheduler, management commands and other workers show after its
+# entries time out, so they are kept for seconds. A shared cache keeps them for minutes.
+BALANCE_CACHE_ALIAS = 'balances'
+_BALANCE_CACHE_SHARED = 'locmem' not in os.getenv("BALANCE_CACHE_BACKEND", 'locmem')
+BALANCE_CACHE_TIMEOUT = int(os.getenv("BALANCE_CACHE_TIMEOUT", "300" if _BALANCE_CACHE_SHARED else "10"))
+# While a session runs, the balance ETag changes once per this many seconds of countdown.
+TIME_BALANCE_ETAG_RESOLUTION = 60
+# Add the balance as a number of seconds ('remaining_seconds') next to the 'remaining_time' duration string.
+TIME_REMAINING_SECONDS = os.getenv("TIME_REMAINING_SECONDS", "False").lower() in ("true", "1")
+
+# Rows read per database round trip (and per streamed chunk) by the balance and ledger exports.
+TIME_EXPORT_CHUNK_SIZE = int(os.getenv("TIME_EXPORT_CHUNK_SIZE", "2000"))
+
 
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
@@ -122,8 +223,9 @@ if PRODUCTION:
     DATABASE_URL = os.getenv("DATABASE_URL")
     if not DATABASE_URL:
         raise ValueError("DATABASE_URL environment variable is required in PRODUCTION mode.")
+    # Connection reuse and pooling come from DB_POOL and friends (see pc_usage_manager/database.py)
     DATABASES = {
-        'default': dj_database_url.parse(DATABASE_URL)
+        'default': database_config(DATABASE_URL)
     }
 else:
     # Use SQLite for development
@@ -134,6 +236,55 @@ else:
         }
     }
 
+# Read replicas: comma-separated database URLs (any engine, e.g. sqlite:///replica.sqlite3
+# locally). Reads of balances, ledger and users are spread over them by
+# time_management.routers.ReplicaRouter; a client's reads stay on the primary
+# for REPLICA_STICKY_SECONDS after it writes. Tests run the replicas against the primary.
+REPLICA_DATABASES = []
+for index, url in enumerate(filter(None, os.getenv("DATABASE_REPLICA_URLS", "").split(",")), start=1):
+    DATABASES[f'replica{index}'] = {**database_config(url.strip()), 'TEST': {'MIRROR': 'default'}}
+    REPLICA_DATABASES.append(f'replica{index}')
+DATABASE_ROUTERS = ['time_management.routers.ReplicaRouter'] if REPLICA_DATABASES else []
+REPLICA_STICKY_SECONDS = int(os.getenv("REPLICA_STICKY_SECONDS", "5"))
+
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'balances': {
+        'BACKEND': os.getenv("BALANCE_CACHE_BACKEND", 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv("BALANCE_CACHE_LOCATION", 'balances'),
+    },
+}
+
+# Password hashing. PASSWORD_HASHER picks the preferred hasher: pbkdf2 (default), argon2 (needs
+# argon2-cffi), scrypt or bcrypt (needs bcrypt). Hashes made by the others still verify and are
+# upgraded on the next login, as are hashes made at another cost (see time_management/hashers.py).
+_PASSWORD_HASHERS = {
+    'pbkdf2': 'time_management.hashers.TunedPBKDF2PasswordHasher',
+    'argon2': 'time_management.hashers.TunedArgon2PasswordHasher',
+    'scrypt': 'django.contrib.auth.hashers.ScryptPasswordHasher',
+    'bcrypt': 'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+}
+PASSWORD_HASHER = os.getenv("PASSWORD_HASHER", "pbkdf2").lower()
+PASSWORD_HASHERS = [
+    _PASSWORD_HASHERS[PASSWORD_HASHER],
+    *(path for name, path in _PASSWORD_HASHERS.items() if name != PASSWORD_HASHER),
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+]
+PASSWORD_HASH_ITERATIONS = int(os.environ["PASSWORD_HASH_ITERATIONS"]) if os.getenv("PASSWORD_HASH_ITERATIONS") else None
+PASSWORD_HASH_ARGON2_TIME_COST = int(os.environ["PASSWORD_HASH_ARGON2_TIME_COST"]) if os.getenv("PASSWORD_HASH_ARGON2_TIME_COST") else None
+PASSWORD_HASH_ARGON2_MEMORY_COST = int(os.environ["PASSWORD_HASH_ARGON2_MEMORY_COST"]) if os.getenv("PASSWORD_HASH_ARGON2_MEMORY_COST") else None
+
+# Loads the balance with the user and leaves password upgrades to the login transaction.
+AUTHENTICATION_BACKENDS = ['time_management.backends.BalanceModelBackend']
+# Record each login's refresh token as an OutstandingToken (one INSERT per login). Blacklisting
+# works without it; the rows only list issued tokens in the admin.
+TIME_LOGIN_RECORD_TOKENS = os.getenv("TIME_LOGIN_RECORD_TOKENS", "True").lower() in ("true", "1")
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -176,16 +327,33 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
+# Records are formatted and written on a background thread (see time_management/logs.py).
+# LOG_FORMAT is 'kv' (key=value) or 'json'. LOG_SAMPLING keeps only a fraction
+# of high-frequency events, e.g. LOG_SAMPLING="time_synced:0.01,usage_reported:0.1".
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_SAMPLING = {
+    event: float(rate)
+    for event, rate in (item.split(":") for item in os.getenv("LOG_SAMPLING", "time_synced:0.01").split(",") if item)
+}
+
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
+    "formatters": {
+        "kv": {"()": "time_management.logs.KeyValueFormatter"},
+        "json": {"()": "time_management.logs.JSONFormatter"},
+    },
     "handlers": {
         "console": {
-            "class": "logging.StreamHandler",
+            "class": "time_management.logs.BackgroundHandler",
+            "formatter": os.getenv("LOG_FORMAT", "kv"),
         },
     },
     "root": {
         "handlers": ["console"],
         "level": "WARNING",
     },
-}
\ No newline at end of file
+    "loggers": {
+        "time_management": {"level": LOG_LEVEL},
+    },
+}
@@ -1,7 +1,9 @@
 from django.contrib import admin
 from django.urls import path, include
+from time_management.metrics import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include("time_management.urls")),
+    path('metrics', metrics_view, name='metrics'),
 ]
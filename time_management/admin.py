@@ -1,4 +1,81 @@
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin.helpers import ActionForm
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+from datetime import timedelta
+from .buffer import flush_pending, get_write_behind_buffer
 from .models import UserTime
 
-admin.site.register(UserTime)
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that reads the row count of an unfiltered PostgreSQL table
+    from the planner statistics instead of running ``COUNT(*)``.
+
+    Small tables, filtered querysets and other databases are counted exactly.
+    """
+
+    EXACT_COUNT_BELOW = 10000
+
+    @cached_property
+    def count(self):
+        query = self.object_list.query
+        connection = connections[self.object_list.db]
+        if connection.vendor == 'postgresql' and not query.where:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT reltuples FROM pg_class WHERE oid = %s::regclass", [query.model._meta.db_table])
+                row = cursor.fetchone()
+            if row and row[0] >= self.EXACT_COUNT_BELOW:
+                return int(row[0])
+        return super().count
+
+
+class TopUpActionForm(ActionForm):
+    minutes = forms.IntegerField(required=False, min_value=1, label="Minutes:")
+
+
+@admin.register(UserTime)
+class UserTimeAdmin(admin.ModelAdmin):
+    list_display = ('user', 'remaining_time', 'session_started_at', 'expires_at', 'updated_at')
+    list_select_related = ('user',)
+    # Case-sensitive prefix lookups can use the username's unique index
+    search_fields = ('user__username__startswith',)
+    search_help_text = "Username prefix (case-sensitive)"
+    raw_id_fields = ('user',)
+    readonly_fields = ('version', 'updated_at', 'expires_at')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    action_form = TopUpActionForm
+    actions = ('add_minutes', 'zero_balance')
+
+    def _flush_pending(self, queryset):
+        # A buffered sync flushed after an admin write would overwrite it
+        if get_write_behind_buffer() is not None:
+            flush_pending(*queryset.values_list('user__username', flat=True))
+
+    def save_model(self, request, obj, form, change):
+        if change:
+            flush_pending(obj.user.username)
+        super().save_model(request, obj, form, change)
+
+    @admin.action(description="Add the minutes above to the selected balances")
+    def add_minutes(self, request, queryset):
+        try:
+            minutes = TopUpActionForm.base_fields['minutes'].clean(request.POST.get('minutes'))
+        except ValidationError:
+            minutes = None
+        if minutes is None:
+            self.message_user(request, "Enter a positive number of minutes to add.", messages.ERROR)
+            return
+        self._flush_pending(queryset)
+        user_times = UserTime.objects.add_many(timedelta(minutes=minutes), queryset.values('user_id'))
+        self.message_user(request, f"Added {minutes} minutes to {len(user_times)} balances.", messages.SUCCESS)
+
+    @admin.action(description="Zero the selected balances")
+    def zero_balance(self, request, queryset):
+        self._flush_pending(queryset)
+        user_times = UserTime.objects.set_many(timedelta(0), queryset.values('user_id'))
+        self.message_user(request, f"Zeroed {len(user_times)} balances.", messages.SUCCESS)
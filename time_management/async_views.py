@@ -0,0 +1,303 @@
+"""
+Native async versions of the login, logout and time endpoints, plus a
+Server-Sent Events stream of balance changes.
+
+They are served under ``api/async/`` with the same request and response
+shapes as the DRF views and are meant to run under an ASGI server (see
+``gunicorn.conf.py``), where one process can hold thousands of idle clients.
+Database access goes through the async ORM, and logins (dominated by slow
+password hashing, see login.py) run on a bounded thread pool
+(``ASYNC_AUTH_WORKERS``) so they never block the event loop.
+"""
+import asyncio
+import json
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import wraps
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import close_old_connections
+from django.http import StreamingHttpResponse
+from django.utils.duration import duration_string
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import status
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from .authentication import AsyncJWTAuthentication
+from .buffer import flush_pending, get_write_behind_buffer
+from .cache import balance_user_id
+from .login import log_in
+from .logs import get_event_logger
+from .models import UserTime
+from .pubsub import get_broker
+from .renderers import FastJsonResponse, loads
+from .serializers import MAX_MINUTES, MAX_SECONDS, UserTimeSerializer
+from .throttling import check_buckets, client_ident, login_buckets
+from .tokens import ClaimsRefreshToken
+
+logger = get_event_logger(__name__)
+
+_authenticator = AsyncJWTAuthentication()
+_auth_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'ASYNC_AUTH_WORKERS', 4),
+    thread_name_prefix='async-auth',
+)
+
+
+def _log_in(request, username, password):
+    try:
+        return log_in(request, username, password)
+    finally:
+        # Pool threads outlive requests, so release their connection like request_finished would
+        close_old_connections()
+
+
+def async_api_view(method, authenticated=True, throttle_scope=None, throttle_buckets=None):
+    """
+    Wrap an async view with method checking, JWT authentication, JSON body
+    parsing and throttling in ``throttle_scope`` per user (or in the
+    ``(scope, ident)`` buckets returned by ``throttle_buckets(request, data)``).
+    Views are only called with a JSON object; other bodies get 400.
+    """
+    def decorator(view):
+        @csrf_exempt
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method != method:
+                return FastJsonResponse(
+                    {'detail': f'Method "{request.method}" not allowed.'},
+                    status=status.HTTP_405_METHOD_NOT_ALLOWED,
+                )
+            if authenticated:
+                try:
+                    result = await _authenticator.aauthenticate(request)
+                except (AuthenticationFailed, InvalidToken) as e:
+                    detail = e.detail if isinstance(e.detail, dict) else {'detail': e.detail}
+                    return FastJsonResponse(detail, status=status.HTTP_401_UNAUTHORIZED)
+                if result is None:
+                    return FastJsonResponse(
+                        {'detail': 'Authentication credentials were not provided.'},
+                        status=status.HTTP_401_UNAUTHORIZED,
+                    )
+                request.user = result[0]
+            try:
+                data = loads(request.body or b'{}')
+            except ValueError:
+                return FastJsonResponse({'error': 'Invalid JSON body.'}, status=status.HTTP_400_BAD_REQUEST)
+            if throttle_buckets is not None:
+                buckets = throttle_buckets(request, data)
+            elif throttle_scope is not None:
+                buckets = [(throttle_scope, client_ident(request, request.user.id))]
+            else:
+                buckets = []
+            if buckets:
+                wait = check_buckets(buckets)
+                if wait:
+                    return FastJsonResponse(
+                        {'detail': f'Request was throttled. Expected available in {math.ceil(wait)} seconds.'},
+                        status=status.HTTP_429_TOO_MANY_REQUESTS,
+                        headers={'Retry-After': str(math.ceil(wait))},
+                    )
+            # Checked after throttling, so malformed requests still use up tokens
+            if not isinstance(data, dict):
+                return FastJsonResponse({'error': 'JSON body must be an object.'}, status=status.HTTP_400_BAD_REQUEST)
+            return await view(request, data, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# User Login Endpoint
+@async_api_view('POST', authenticated=False, throttle_buckets=login_buckets)
+async def login_user(request, data):
+    logger.debug('login_started')
+    username = data.get('username')
+    password = data.get('password')
+
+    if not username or not password:
+        logger.warning('login_failed', reason='missing_credentials')
+        return FastJsonResponse({"error": "Both username and password are required."}, status=status.HTTP_400_BAD_REQUEST)
+
+    body = await sync_to_async(_log_in, thread_sensitive=False, executor=_auth_executor)(request, username, password)
+    if not body:
+        logger.warning('login_failed', username=username, reason='invalid_credentials')
+        return FastJsonResponse({"error": "Invalid username or password."}, status=status.HTTP_401_UNAUTHORIZED)
+
+    logger.info('login_succeeded', username=username)
+    return FastJsonResponse(body)
+
+
+def _blacklist(refresh_token):
+    ClaimsRefreshToken(refresh_token).blacklist()
+
+
+# User Logout Endpoint
+@async_api_view('POST')
+async def logout_user(request, data):
+    logger.debug('logout_started')
+    try:
+        await sync_to_async(_blacklist)(data.get('refresh'))
+    except Exception as e:
+        logger.warning('logout_failed', error=str(e))
+        return FastJsonResponse({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    logger.info('logged_out')
+    return FastJsonResponse({"success": True, "message": "Logged out successfully and token revoked."})
+
+
+def _bounded_int(value, min_value, max_value):
+    """``value`` as an integer if it is one within the bounds, else ``None``."""
+    if isinstance(value, bool):
+        return None
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        return None
+    return number if min_value <= number <= max_value else None
+
+
+def _user_time_response(user_time, username):
+    if user_time is None:
+        logger.warning('time_update_failed', username=username, reason='user_not_found')
+        return FastJsonResponse({'error': 'User not found.'}, status=status.HTTP_404_NOT_FOUND)
+    return FastJsonResponse(UserTimeSerializer(user_time).data)
+
+
+# Add minutes bought to user's remaining time
+@async_api_view('PATCH', throttle_scope='time')
+async def add_user_minutes(request, data, username):
+    if 'add_minutes' not in data:
+        logger.warning('time_add_failed', username=username, reason='add_minutes_missing')
+        return FastJsonResponse({'error': 'add_minutes field is required'}, status=status.HTTP_400_BAD_REQUEST)
+    minutes = _bounded_int(data['add_minutes'], -MAX_MINUTES, MAX_MINUTES)
+    if minutes is None:
+        logger.warning('time_add_failed', username=username, reason='add_minutes_invalid')
+        return FastJsonResponse(
+            {'error': f'add_minutes must be an integer between {-MAX_MINUTES} and {MAX_MINUTES}'},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    await sync_to_async(flush_pending)(username)
+    user_time = await UserTime.objects.aadd(timedelta(minutes=minutes), username=username)
+    if user_time is not None:
+        logger.info('time_added', username=username, minutes=minutes)
+    return _user_time_response(user_time, username)
+
+
+def _buffer_sync(time_buffer, username, remaining_time):
+    if balance_user_id(username) is None:
+        return False
+    time_buffer.put(username, remaining_time)
+    return True
+
+
+# Sync User Time
+@async_api_view('PATCH', throttle_scope='sync')
+async def sync_user_remaining_time(request, data, username):
+    if 'remaining_time' not in data:
+        logger.warning('time_sync_failed', username=username, reason='remaining_time_missing')
+        return FastJsonResponse({'error': 'remaining_time field is required'}, status=status.HTTP_400_BAD_REQUEST)
+    seconds = _bounded_int(data['remaining_time'], 0, MAX_SECONDS)
+    if seconds is None:
+        logger.warning('time_sync_failed', username=username, reason='remaining_time_invalid')
+        return FastJsonResponse(
+            {'error': f'remaining_time must be an integer between 0 and {MAX_SECONDS}'},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    remaining_time = timedelta(seconds=seconds)
+    time_buffer = get_write_behind_buffer()
+    if time_buffer is not None:
+        # The user lookup and the store may both do blocking I/O (a cache miss, CacheStore)
+        if not await sync_to_async(_buffer_sync)(time_buffer, username, remaining_time):
+            logger.warning('time_sync_failed', username=username, reason='user_not_found')
+            return FastJsonResponse({'error': 'User not found.'}, status=status.HTTP_404_NOT_FOUND)
+        logger.info('time_synced', username=username, seconds=seconds, buffered=True)
+        return FastJsonResponse(UserTimeSerializer(UserTime(user=User(username=username), remaining_time=remaining_time)).data)
+    user_time = await UserTime.objects.aset(remaining_time, username=username)
+    if user_time is not None:
+        logger.info('time_synced', username=username, seconds=seconds)
+    return _user_time_response(user_time, username)
+
+
+# Start counting down the user's balance on the server
+@async_api_view('POST', throttle_scope='session')
+async def start_user_session(request, data, username):
+    await sync_to_async(flush_pending)(username)
+    return _user_time_response(await UserTime.objects.astart_session(username=username), username)
+
+
+# Stop the countdown and persist the time used
+@async_api_view('POST', throttle_scope='session')
+async def stop_user_session(request, data, username):
+    await sync_to_async(flush_pending)(username)
+    return _user_time_response(await UserTime.objects.astop_session(username=username), username)
+
+
+def _live_remaining(state):
+    remaining = state['remaining_time']
+    if state['session_started_at'] is not None:
+        remaining -= time.time() - state['session_started_at']
+    return max(remaining, 0)
+
+
+def _sse(event, username, state):
+    data = json.dumps({
+        'user': username,
+        'remaining_time': duration_string(timedelta(seconds=round(_live_remaining(state)))),
+        'session_active': state['session_started_at'] is not None,
+    })
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+async def _balance_events(user_id, username):
+    keepalive = getattr(settings, 'TIME_STREAM_KEEPALIVE', 15)
+    expiry_warning = getattr(settings, 'TIME_STREAM_EXPIRY_WARNING', 60)
+    broker = get_broker()
+    # Subscribe before reading the balance so no change can slip in between
+    queue = broker.subscribe(user_id)
+    try:
+        try:
+            user_time = await UserTime.objects.aget(user_id=user_id)
+        except UserTime.DoesNotExist:
+            # The user was deleted after the stream was opened
+            logger.warning('balance_stream_failed', username=username, reason='balance_not_found')
+            yield f"event: closed\ndata: {json.dumps({'user': username, 'reason': 'balance_not_found'})}\n\n"
+            return
+        state = {
+            'remaining_time': user_time.remaining_time.total_seconds(),
+            'session_started_at': user_time.session_started_at.timestamp() if user_time.session_started_at else None,
+        }
+        warned = False
+        yield _sse('balance', username, state)
+        while True:
+            until_warning = None
+            if state['session_started_at'] is not None and not warned:
+                until_warning = max(_live_remaining(state) - expiry_warning, 0)
+            timeout = keepalive if until_warning is None else min(keepalive, until_warning)
+            try:
+                state = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                if until_warning is not None and until_warning <= keepalive:
+                    warned = True
+                    yield _sse('expiring', username, state)
+                else:
+                    yield ": keepalive\n\n"
+            else:
+                warned = False
+                yield _sse('balance', username, state)
+    finally:
+        broker.unsubscribe(user_id, queue)
+
+
+# Push balance changes to the user's connected PCs
+@async_api_view('GET')
+async def stream_user_time(request, data, username):
+    user_id = await User.objects.filter(username=username).values_list('id', flat=True).afirst()
+    if user_id is None:
+        logger.warning('balance_stream_failed', username=username, reason='user_not_found')
+        return FastJsonResponse({'error': 'User not found.'}, status=status.HTTP_404_NOT_FOUND)
+    logger.info('balance_stream_opened', username=username)
+    return StreamingHttpResponse(
+        _balance_events(user_id, username),
+        content_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
@@ -0,0 +1,104 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.utils.functional import cached_property
+from rest_framework.authentication import SessionAuthentication
+from rest_framework_simplejwt.authentication import JWTAuthentication, JWTStatelessUserAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+
+
+class LazyTokenUser(TokenUser):
+    """
+    Request user built from the signed access token claims.
+
+    ``id``, ``username`` and ``is_staff`` come straight from the token. Any
+    other attribute loads the ``User`` row on first access, so requests that
+    never need it cost no query.
+    """
+
+    @cached_property
+    def db_user(self):
+        return User.objects.get(**{api_settings.USER_ID_FIELD: self.id})
+
+    @cached_property
+    def username(self):
+        return self.token.get('username') or self.db_user.get_username()
+
+    @cached_property
+    def is_staff(self):
+        if 'is_staff' in self.token:
+            return self.token['is_staff']
+        return self.db_user.is_staff
+
+    def __getattr__(self, attr):
+        if attr.startswith('_') or attr == 'token':
+            raise AttributeError(attr)
+        if attr in self.token:
+            return self.token[attr]
+        return getattr(self.db_user, attr)
+
+
+class StatelessJWTAuthentication(JWTStatelessUserAuthentication):
+    """
+    JWT authentication that trusts the token claims instead of loading the user.
+
+    Deactivating a user takes effect when their access token expires
+    (``ACCESS_TOKEN_LIFETIME``) rather than immediately.
+    """
+
+    def get_user(self, validated_token):
+        if api_settings.USER_ID_CLAIM not in validated_token:
+            raise InvalidToken("Token contained no recognizable user identification")
+        return LazyTokenUser(validated_token)
+
+
+def time_endpoint_authentication_classes():
+    """
+    Authenticators for the time endpoints.
+
+    Session authentication stays first: without a session cookie it costs
+    nothing, and keeping it first preserves the 403 response for anonymous
+    requests. ``TIME_JWT_STATELESS`` selects the claims-only JWT fast path.
+    """
+    if getattr(settings, 'TIME_JWT_STATELESS', True):
+        return [SessionAuthentication, StatelessJWTAuthentication]
+    return [SessionAuthentication, JWTAuthentication]
+
+
+class AsyncJWTAuthentication(JWTAuthentication):
+    """
+    JWT authentication for the native async views.
+
+    Token parsing and signature checks are pure CPU work and reuse the parent
+    class; only the user lookup goes through the async ORM.
+    """
+
+    async def aauthenticate(self, request):
+        header = self.get_header(request)
+        if header is None:
+            return None
+
+        raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+
+        validated_token = self.get_validated_token(raw_token)
+        return await self.aget_user(validated_token), validated_token
+
+    async def aget_user(self, validated_token):
+        if getattr(settings, 'TIME_JWT_STATELESS', True):
+            return StatelessJWTAuthentication().get_user(validated_token)
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError as e:
+            raise InvalidToken("Token contained no recognizable user identification") from e
+
+        try:
+            user = await User.objects.aget(**{api_settings.USER_ID_FIELD: user_id})
+        except User.DoesNotExist as e:
+            raise AuthenticationFailed("User not found", code="user_not_found") from e
+
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed("User is inactive", code="user_inactive")
+        return user
@@ -0,0 +1,44 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.hashers import check_password
+
+UserModel = get_user_model()
+
+
+class BalanceModelBackend(ModelBackend):
+    """
+    ``ModelBackend`` that loads the user's balance row in the same query, so
+    ``user.time`` is free after login.
+
+    A stored password hash that needs upgrading (see time_management/hashers.py)
+    is rehashed and saved as usual, unless ``defer_rehash=True`` is passed:
+    then the new hash is only set on the user and ``user.password_rehashed``
+    is set, for the caller to save in its own transaction.
+    """
+
+    def authenticate(self, request, username=None, password=None, defer_rehash=False, **kwargs):
+        if username is None:
+            username = kwargs.get(UserModel.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+        try:
+            user = UserModel._default_manager.select_related('time').get(**{UserModel.USERNAME_FIELD: username})
+        except UserModel.DoesNotExist:
+            # Hash anyway so unknown usernames take as long as wrong passwords
+            UserModel().set_password(password)
+            return None
+
+        user.password_rehashed = False
+
+        def setter(raw_password):
+            user.set_password(raw_password)
+            # A hash upgrade is not a password change
+            user._password = None
+            user.password_rehashed = True
+
+        if not (check_password(password, user.password, setter) and self.user_can_authenticate(user)):
+            return None
+        if user.password_rehashed and not defer_rehash:
+            user.save(update_fields=['password'])
+            user.password_rehashed = False
+        return user
@@ -0,0 +1,199 @@
+"""
+Write-behind buffer for heartbeat time syncs.
+
+``UpdateUserTimeView`` calls arrive every few seconds per PC and each one
+supersedes the last, so when ``TIME_SYNC_WRITE_BEHIND['ENABLED']`` is set the
+latest value per user is kept in a store and persisted in bulk by a
+background flusher every ``FLUSH_INTERVAL`` seconds and on shutdown. At most
+one flush interval of syncs can be lost if the process dies.
+
+Reads and ``flush_pending`` only see the syncs the store holds. The default
+``MemoryStore`` holds those of its own process, so it is only correct with a
+single server process: with several, a sync buffered by another worker is
+neither read nor flushed before a top-up, and its later flush overwrites the
+top-up. More than one worker needs ``CacheStore`` on a cache shared by all of
+them (the server refuses to start otherwise, see deployment.py).
+
+Example settings::
+
+    TIME_SYNC_WRITE_BEHIND = {
+        'ENABLED': True,
+        'FLUSH_INTERVAL': 5,
+        'STORE': 'time_management.buffer.CacheStore',
+        'STORE_OPTIONS': {'alias': 'default'},
+    }
+"""
+import atexit
+import logging
+import threading
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils.module_loading import import_string
+from .models import UserTime
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': False,
+    'FLUSH_INTERVAL': 5,
+    'STORE': 'time_management.buffer.MemoryStore',
+    'STORE_OPTIONS': {},
+}
+
+
+class MemoryStore:
+    """Per-process store. Last writer wins."""
+
+    process_local = True
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def put(self, username, remaining_time):
+        with self._lock:
+            self._values[username] = remaining_time
+
+    def get(self, username):
+        return self._values.get(username)
+
+    def pop(self, username):
+        with self._lock:
+            return self._values.pop(username, None)
+
+    def drain(self):
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+
+class CacheStore:
+    """
+    Store backed by a Django cache so every process reads the newest value.
+
+    Each process only flushes the users it buffered itself.
+    """
+
+    KEY_PREFIX = 'time_sync:'
+
+    def __init__(self, alias='default', timeout=300):
+        self._cache = caches[alias]
+        self.process_local = isinstance(self._cache, LocMemCache)
+        self._timeout = timeout
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def put(self, username, remaining_time):
+        self._cache.set(self.KEY_PREFIX + username, remaining_time, self._timeout)
+        with self._lock:
+            self._dirty.add(username)
+
+    def get(self, username):
+        return self._cache.get(self.KEY_PREFIX + username)
+
+    def pop(self, username):
+        # Also takes values buffered by other processes; their drain() skips missing keys.
+        with self._lock:
+            self._dirty.discard(username)
+        value = self._cache.get(self.KEY_PREFIX + username)
+        self._cache.delete(self.KEY_PREFIX + username)
+        return value
+
+    def drain(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        if not dirty:
+            return {}
+        values = self._cache.get_many([self.KEY_PREFIX + username for username in dirty])
+        self._cache.delete_many(list(values))
+        return {key[len(self.KEY_PREFIX):]: value for key, value in values.items()}
+
+
+class WriteBehindBuffer:
+    def __init__(self, store, flush_interval):
+        self.store = store
+        self.flush_interval = flush_interval
+        self._inflight = {}  # Values drained but not yet committed, still visible to reads
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def put(self, username, remaining_time):
+        self.store.put(username, remaining_time)
+
+    def get(self, username):
+        """Return the newest buffered balance for ``username`` or ``None``."""
+        value = self.store.get(username)
+        if value is None:
+            value = self._inflight.get(username)
+        return value
+
+    def flush(self, usernames=None):
+        """Persist buffered values, all of them or only those of ``usernames``."""
+        with self._flush_lock:
+            if usernames is None:
+                pending = self.store.drain()
+            else:
+                pending = {username: self.store.pop(username) for username in usernames}
+                pending = {username: value for username, value in pending.items() if value is not None}
+            if not pending:
+                return 0
+            self._inflight = pending
+            try:
+                UserTime.objects.bulk_apply([(username, value, None) for username, value in pending.items()])
+            except Exception:
+                # Put back whatever has not been superseded and retry on the next flush.
+                for username, value in pending.items():
+                    if self.store.get(username) is None:
+                        self.store.put(username, value)
+                raise
+            finally:
+                self._inflight = {}
+        logger.debug("Flushed %d buffered time syncs.", len(pending))
+        return len(pending)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='time-sync-flusher', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval)
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Flushing buffered time syncs failed.")
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_write_behind_buffer():
+    """Return the process-wide buffer, started on first use, or ``None`` when disabled."""
+    global _buffer
+    config = {**DEFAULTS, **getattr(settings, 'TIME_SYNC_WRITE_BEHIND', {})}
+    if not config['ENABLED']:
+        return None
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                store = import_string(config['STORE'])(**config['STORE_OPTIONS'])
+                _buffer = WriteBehindBuffer(store, config['FLUSH_INTERVAL'])
+                _buffer.start()
+    return _buffer
+
+
+def flush_pending(*usernames):
+    """Persist buffered syncs for ``usernames`` before another write touches their balance."""
+    buffer = get_write_behind_buffer()
+    if buffer is not None:
+        buffer.flush(usernames=usernames)
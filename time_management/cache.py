@@ -0,0 +1,87 @@
+"""
+Cache of user balances for the balance read endpoint.
+
+Entries are read through on a miss and written through by every balance
+mutation once it commits (see signals.py), so polling clients are served
+without touching the database. The backend is the ``BALANCE_CACHE_ALIAS``
+cache, local memory unless configured otherwise.
+
+A write-through only reaches the cache of the process that made the write.
+With a local-memory cache, entries are therefore current only for writes
+made in the same process. Writes from other processes, such as other
+workers, ``runexpiryscheduler`` and management commands, are served stale
+until the entry expires after ``BALANCE_CACHE_TIMEOUT`` seconds. That
+timeout defaults to seconds for a local-memory cache and to minutes for a
+shared one (see settings.py). More than one worker needs a shared cache
+(see deployment.py).
+"""
+from django.conf import settings
+from django.core.cache import caches
+from .models import UserTime
+
+BALANCE_KEY = 'balance:{}'  # By user id, so mutations keyed by id can write through
+USER_ID_KEY = 'balance-user:{}'  # Username -> user id
+
+
+def _cache():
+    return caches[getattr(settings, 'BALANCE_CACHE_ALIAS', 'default')]
+
+
+def _timeout():
+    return getattr(settings, 'BALANCE_CACHE_TIMEOUT', 300)
+
+
+def balance_state(user_time):
+    """The cached representation of a balance row."""
+    return {
+        'user_id': user_time.user_id,
+        'remaining_time': user_time.remaining_time,
+        'session_started_at': user_time.session_started_at,
+        'version': user_time.version,
+        'updated_at': user_time.updated_at,
+    }
+
+
+def get_balance(username):
+    """Return the cached balance state for ``username``, loading it on a miss, or ``None``."""
+    cache = _cache()
+    user_id = cache.get(USER_ID_KEY.format(username))
+    if user_id is not None:
+        state = cache.get(BALANCE_KEY.format(user_id))
+        if state is not None:
+            return state
+
+    user_time = UserTime.objects.filter(user__username=username).first()
+    if user_time is None:
+        return None
+    state = balance_state(user_time)
+    cache.set(USER_ID_KEY.format(username), user_time.user_id, _timeout())
+    # add() never replaces a newer value written through by a concurrent mutation
+    cache.add(BALANCE_KEY.format(user_time.user_id), state, _timeout())
+    return state
+
+
+def balance_user_id(username):
+    """Return the id of the user ``username`` if they have a balance row, else ``None``; cached like balances."""
+    cache = _cache()
+    user_id = cache.get(USER_ID_KEY.format(username))
+    if user_id is None:
+        user_id = UserTime.objects.filter(user__username=username).values_list('user_id', flat=True).first()
+        if user_id is not None:
+            cache.set(USER_ID_KEY.format(username), user_id, _timeout())
+    return user_id
+
+
+def store_balances(user_times):
+    """Write through committed balances, keeping whichever cached version is newer."""
+    cache = _cache()
+    states = {BALANCE_KEY.format(user_time.user_id): balance_state(user_time) for user_time in user_times}
+    cached = cache.get_many(list(states))
+    cache.set_many(
+        {key: state for key, state in states.items() if key not in cached or cached[key]['version'] < state['version']},
+        _timeout(),
+    )
+
+
+def forget_balance(user_id):
+    _cache().delete(BALANCE_KEY.format(user_id))
@@ -0,0 +1,63 @@
+"""
+Checks for state kept in the memory of one server process.
+
+The default backends keep their state per process, which is right for a
+single server process and wrong for several: each process would serve its
+own balances, streams, rate limits and buffered syncs. Running more than one
+worker needs a shared backend for each of them:
+
+``CACHES[BALANCE_CACHE_ALIAS]``
+    A shared cache (Redis, Memcached or the database cache), not
+    ``LocMemCache``, so a balance written by one process is not served stale
+    by another (see cache.py).
+``TIME_PUBSUB['BACKEND']``
+    ``time_management.pubsub.RedisBroker``, so balance changes reach streams
+    held by other processes, including expiries made by
+    ``runexpiryscheduler`` (see pubsub.py).
+``TIME_THROTTLE['STORE']``
+    ``time_management.throttling.CacheBucketStore`` on a shared cache, unless
+    no rates are set, or every process applies the limits on its own.
+``TIME_SYNC_WRITE_BEHIND['STORE']``
+    ``time_management.buffer.CacheStore`` on a shared cache, when the buffer
+    is enabled, so reads and ``flush_pending`` see syncs buffered elsewhere.
+
+``/metrics`` is always per process: each scrape reports the worker that
+answered it.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils.module_loading import import_string
+from . import buffer, pubsub, throttling
+
+
+def is_process_local_cache(alias):
+    """Whether the ``alias`` cache keeps its entries in this process's memory."""
+    return isinstance(caches[alias], LocMemCache)
+
+
+def process_local_backends():
+    """Return a message for each configured backend whose state only this process sees."""
+    found = []
+    alias = getattr(settings, 'BALANCE_CACHE_ALIAS', 'default')
+    if is_process_local_cache(alias):
+        found.append(f"CACHES['{alias}'] (the balance cache) is a local-memory cache; use a shared cache.")
+
+    broker = {**pubsub.DEFAULTS, **getattr(settings, 'TIME_PUBSUB', {})}
+    if import_string(broker['BACKEND']).process_local:
+        found.append("TIME_PUBSUB['BACKEND'] delivers only within one process; use time_management.pubsub.RedisBroker.")
+
+    throttle = {**throttling.DEFAULTS, **getattr(settings, 'TIME_THROTTLE', {})}
+    if throttle['RATES'] and import_string(throttle['STORE'])(**throttle['STORE_OPTIONS']).process_local:
+        found.append(
+            "TIME_THROTTLE['STORE'] keeps buckets per process; use time_management.throttling.CacheBucketStore "
+            "on a shared cache."
+        )
+
+    write_behind = {**buffer.DEFAULTS, **getattr(settings, 'TIME_SYNC_WRITE_BEHIND', {})}
+    if write_behind['ENABLED'] and import_string(write_behind['STORE'])(**write_behind['STORE_OPTIONS']).process_local:
+        found.append(
+            "TIME_SYNC_WRITE_BEHIND['STORE'] buffers syncs per process; use time_management.buffer.CacheStore "
+            "on a shared cache."
+        )
+    return found
@@ -0,0 +1,100 @@
+"""
+Server-side expiry of running sessions.
+
+``ExpiryScheduler`` keeps a min-heap of the sessions that run out within
+``horizon`` seconds, read with a range scan on the indexed
+``UserTime.expires_at`` column, and sleeps until the earliest one is due.
+Due sessions are zeroed in batches by ``UserTime.objects.expire_sessions``,
+which sends ``balance_changed`` (so connected PCs are pushed the new
+balance) and ``session_expired``.
+
+The window is re-read every ``refresh`` seconds to pick up sessions started
+or topped up by other processes, so a session shorter than ``refresh`` can
+expire up to that late. Heap entries made stale by a top-up are harmless:
+``expire_sessions`` only touches rows that are still due. At most
+``load_limit`` rows are read at a time; after a backlog the window is re-read
+as soon as the loaded part has been expired.
+
+``run`` logs a failed pass (a database outage, say), waits with exponential
+backoff up to ``MAX_BACKOFF`` seconds and carries on from a fresh read.
+"""
+import heapq
+import logging
+import threading
+from datetime import timedelta
+from django.db import close_old_connections
+from django.utils import timezone
+from .models import UserTime
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiryScheduler:
+    MAX_BACKOFF = 60
+
+    def __init__(self, horizon=300, refresh=10, batch_size=1000, load_limit=10000):
+        if refresh > horizon:
+            raise ValueError("refresh must not exceed horizon.")
+        self.horizon = timedelta(seconds=horizon)
+        self.refresh = timedelta(seconds=refresh)
+        self.batch_size = batch_size
+        self.load_limit = load_limit
+        self._heap = []  # (expires_at, user_id)
+        self._next_load = None
+        self._truncated = False  # The last load hit load_limit
+
+    def load(self, now):
+        """Replace the heap with the sessions expiring before ``now + horizon``."""
+        rows = (
+            UserTime.objects.filter(expires_at__lte=now + self.horizon)
+            .order_by('expires_at')
+            .values_list('expires_at', 'user_id')[:self.load_limit]
+        )
+        # Rows come back sorted, which is already a valid heap
+        self._heap = list(rows)
+        self._truncated = len(self._heap) >= self.load_limit
+        self._next_load = now + self.refresh
+        logger.debug("Loaded %d upcoming expiries.", len(self._heap))
+
+    def run_pending(self, now):
+        """Expire up to ``batch_size`` sessions due by ``now``. Returns the expired rows."""
+        if self._next_load is None or now >= self._next_load or (self._truncated and not self._heap):
+            self.load(now)
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+            due.append(heapq.heappop(self._heap)[1])
+        if not due:
+            return []
+        expired = UserTime.objects.expire_sessions(due, now=now)
+        if expired:
+            logger.info("Expired %d sessions.", len(expired))
+        return expired
+
+    def seconds_until_next(self, now):
+        """Seconds until the next expiry is due or the window must be re-read."""
+        if self._truncated and not self._heap:
+            return 0
+        next_at = self._next_load
+        if self._heap:
+            next_at = min(next_at, self._heap[0][0])
+        return max((next_at - now).total_seconds(), 0)
+
+    def run(self, stop_event=None):
+        """Expire sessions as they come due until ``stop_event`` is set."""
+        stop_event = stop_event or threading.Event()
+        failures = 0
+        while not stop_event.is_set():
+            try:
+                self.run_pending(timezone.now())
+            except Exception:
+                failures += 1
+                delay = min(2 ** (failures - 1), self.MAX_BACKOFF)
+                logger.exception("Expiring sessions failed, retrying in %ds.", delay)
+                # Entries taken off the heap may not have been expired; read the window again
+                self._heap, self._next_load = [], None
+                close_old_connections()
+                stop_event.wait(delay)
+                continue
+            failures = 0
+            close_old_connections()
+            stop_event.wait(self.seconds_until_next(timezone.now()))
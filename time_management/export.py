@@ -0,0 +1,112 @@
+"""
+Streaming exports of the balances and the usage ledger.
+
+``export`` yields an export as byte chunks while reading the rows with
+``QuerySet.iterator``, so memory stays flat and the first chunk is ready
+after the first ``chunk_size`` rows, however many rows there are. Rows are
+read as tuples, with the username joined in the same query. Exports are CSV
+(with a header row) or NDJSON, optionally gzip compressed; each compressed
+chunk is flushed so clients can start decompressing straight away.
+
+``aexport`` is the same export as an async iterator, for responses served
+over ASGI: Django reads a sync iterator there by collecting it into a list
+first, which would hold the whole export in memory before the first byte.
+"""
+import csv
+import zlib
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from .models import LedgerEntry, UserTime
+
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+}
+
+# Columns of each dataset, the (lazy) query they are read from and the lookups filling them
+DATASETS = {
+    'balances': (
+        ('user_id', 'username', 'remaining_seconds', 'session_started_at', 'expires_at', 'version', 'updated_at'),
+        UserTime.objects.order_by('user_id'),
+        ('user_id', 'user__username', 'remaining_time', 'session_started_at', 'expires_at', 'version', 'updated_at'),
+    ),
+    'ledger': (
+        ('id', 'user_id', 'username', 'kind', 'balance_seconds', 'created_at'),
+        LedgerEntry.objects.order_by('id'),
+        ('id', 'user_id', 'user__username', 'kind', 'balance', 'created_at'),
+    ),
+}
+
+
+class _Echo:
+    """File-like object handing back what ``csv.writer`` writes instead of storing it."""
+
+    def write(self, value):
+        return value
+
+
+def _plain(value):
+    if hasattr(value, 'total_seconds'):
+        return int(value.total_seconds())
+    return value
+
+
+def rows(dataset, chunk_size=2000):
+    """Yield the rows of ``dataset`` as tuples, durations in whole seconds."""
+    columns, queryset, lookups = DATASETS[dataset]
+    for row in queryset.values_list(*lookups).iterator(chunk_size=chunk_size):
+        yield tuple(_plain(value) for value in row)
+
+
+def _lines(dataset, output, chunk_size):
+    columns = DATASETS[dataset][0]
+    if output == 'csv':
+        writer = csv.writer(_Echo())
+        yield writer.writerow(columns)
+        for row in rows(dataset, chunk_size):
+            yield writer.writerow(['' if value is None else value for value in row])
+    else:
+        encoder = DjangoJSONEncoder(separators=(',', ':'))
+        for row in rows(dataset, chunk_size):
+            yield encoder.encode(dict(zip(columns, row))) + '\n'
+
+
+def export(dataset, output='csv', compress=False, chunk_size=2000):
+    """Yield ``dataset`` in the ``output`` format as byte chunks of ``chunk_size`` rows."""
+    if dataset not in DATASETS:
+        raise ValueError(f"Unknown dataset '{dataset}'.")
+    if output not in FORMATS:
+        raise ValueError(f"Unknown format '{output}'.")
+
+    compressor = zlib.compressobj(wbits=31) if compress else None  # 31: gzip container
+    batch = []
+    for line in _lines(dataset, output, chunk_size):
+        batch.append(line)
+        if len(batch) >= chunk_size:
+            data = ''.join(batch).encode()
+            batch.clear()
+            if compressor:
+                data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            yield data
+    data = ''.join(batch).encode()
+    if compressor:
+        yield compressor.compress(data) + compressor.flush()
+    elif data:
+        yield data
+
+
+async def aexport(dataset, output='csv', compress=False, chunk_size=2000):
+    """``export`` as an async iterator. Each chunk is read in the request's sync thread, like the ORM calls."""
+    chunks = export(dataset, output, compress=compress, chunk_size=chunk_size)
+    # One thread for the whole export, since the rows come from one server-side cursor
+    read = sync_to_async(next, thread_sensitive=True)
+    try:
+        while (chunk := await read(chunks, None)) is not None:
+            yield chunk
+    finally:
+        await sync_to_async(chunks.close, thread_sensitive=True)()
+
+
+def filename(dataset, output='csv', compress=False):
+    """Return the download file name of an export."""
+    return f"{dataset}.{FORMATS[output][1]}" + ('.gz' if compress else '')
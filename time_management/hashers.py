@@ -0,0 +1,32 @@
+"""
+Password hashers with costs tunable from settings.
+
+``PASSWORD_HASHER`` in settings.py picks the preferred hasher. A stored hash
+made by another hasher or at another cost still verifies, and is rehashed
+with the preferred one on the user's next successful login, so changing the
+policy needs no migration. The costs are read on every use, so they can be
+changed without a code change:
+
+``PASSWORD_HASH_ITERATIONS``
+    PBKDF2 iterations (Django's default when unset).
+``PASSWORD_HASH_ARGON2_TIME_COST`` / ``PASSWORD_HASH_ARGON2_MEMORY_COST``
+    Argon2 passes and memory in KiB (Django's defaults when unset).
+"""
+from django.conf import settings
+from django.contrib.auth.hashers import Argon2PasswordHasher, PBKDF2PasswordHasher
+
+
+class TunedPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    @property
+    def iterations(self):
+        return getattr(settings, 'PASSWORD_HASH_ITERATIONS', None) or PBKDF2PasswordHasher.iterations
+
+
+class TunedArgon2PasswordHasher(Argon2PasswordHasher):
+    @property
+    def time_cost(self):
+        return getattr(settings, 'PASSWORD_HASH_ARGON2_TIME_COST', None) or Argon2PasswordHasher.time_cost
+
+    @property
+    def memory_cost(self):
+        return getattr(settings, 'PASSWORD_HASH_ARGON2_MEMORY_COST', None) or Argon2PasswordHasher.memory_cost
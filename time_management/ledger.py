@@ -0,0 +1,152 @@
+"""
+Usage ledger and its rollups.
+
+Every balance change appends a ``LedgerEntry`` with the balance it left, in
+the same transaction (see signals.py), or on PostgreSQL in the same statement
+for single-row changes (see ``UserTimeManager._mutate``). A new user's empty
+balance is implied, not recorded. ``roll_up`` folds new entries, in id order,
+into the per-user ``UserUsage`` and per-day ``DailyUsage`` totals and
+advances the ``RollupCursor``, so reports read the rollups and never the raw
+ledger. ``rebuild_rollups`` recomputes them from the whole ledger.
+
+Only entries older than ``settle`` seconds are rolled up: ids are assigned
+before commit, so a slow transaction can commit an entry below ids that were
+already visible.
+"""
+import logging
+from datetime import timedelta
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+from .models import DailyUsage, LedgerEntry, RollupCursor, UserUsage
+
+logger = logging.getLogger(__name__)
+
+USAGE_FIELDS = ('purchased', 'consumed', 'corrected')
+
+
+def record_entries(user_times, kind):
+    """
+    Append one ledger entry per changed balance.
+
+    A PC reports its balance on every heartbeat, usually unchanged while it is
+    idle, so sync entries that leave the balance where the user's last entry
+    left it are dropped: they carry no usage and would only grow the ledger.
+    """
+    if kind == LedgerEntry.Kind.SYNC:
+        last_balances = _last_balances({user_time.user_id for user_time in user_times})
+        user_times = [
+            user_time for user_time in user_times
+            if last_balances.get(user_time.user_id) != user_time.remaining_time
+        ]
+        if not user_times:
+            return
+    LedgerEntry.objects.bulk_create([
+        LedgerEntry(
+            user_id=user_time.user_id,
+            kind=kind,
+            balance=user_time.remaining_time,
+            created_at=user_time.updated_at or timezone.now(),
+        )
+        for user_time in user_times
+    ])
+
+
+def _last_balances(user_ids):
+    """Return ``{user id: balance}`` as left by each user's latest ledger entry."""
+    latest = LedgerEntry.objects.filter(user_id=OuterRef('pk')).order_by('-id').values('balance')[:1]
+    return dict(
+        User.objects.filter(pk__in=user_ids)
+        .annotate(balance=Subquery(latest))
+        .filter(balance__isnull=False)
+        .values_list('pk', 'balance')
+    )
+
+
+def classify(kind, amount):
+    """Return the usage field an entry's ``amount`` counts towards and its value there, or ``None``."""
+    if kind == LedgerEntry.Kind.OPENING or not amount:
+        return None
+    if kind in (LedgerEntry.Kind.CONSUMPTION, LedgerEntry.Kind.EXPIRY):
+        return 'consumed', -amount
+    if kind == LedgerEntry.Kind.SYNC and amount < timedelta(0):
+        # The PC reports what is left, so a lower balance is time used
+        return 'consumed', -amount
+    if kind == LedgerEntry.Kind.PURCHASE and amount > timedelta(0):
+        return 'purchased', amount
+    return 'corrected', amount
+
+
+def roll_up(batch_size=5000, settle=60, now=None):
+    """Fold settled ledger entries into the rollups. Returns the number of entries rolled up."""
+    cutoff = (now or timezone.now()) - timedelta(seconds=settle)
+    rolled = 0
+    while True:
+        with transaction.atomic():
+            # The cursor row lock keeps concurrent roll-ups from double counting
+            cursor = RollupCursor.objects.select_for_update().get_or_create(pk=1)[0]
+            entries = list(
+                LedgerEntry.objects.filter(id__gt=cursor.last_entry_id, created_at__lte=cutoff)
+                .order_by('id')
+                .values_list('id', 'user_id', 'kind', 'balance', 'created_at')[:batch_size]
+            )
+            if not entries:
+                break
+            _apply(entries)
+            cursor.last_entry_id = entries[-1][0]
+            cursor.save(update_fields=['last_entry_id'])
+        rolled += len(entries)
+        logger.debug("Rolled up %d ledger entries.", len(entries))
+        if len(entries) < batch_size:
+            break
+    return rolled
+
+
+def rebuild_rollups(batch_size=5000, settle=60, now=None):
+    """Recompute the rollups from the start of the ledger."""
+    with transaction.atomic():
+        RollupCursor.objects.select_for_update().get_or_create(pk=1)
+        UserUsage.objects.all().delete()
+        DailyUsage.objects.all().delete()
+        RollupCursor.objects.filter(pk=1).update(last_entry_id=0)
+    return roll_up(batch_size=batch_size, settle=settle, now=now)
+
+
+def _apply(entries):
+    users = UserUsage.objects.in_bulk({user_id for _, user_id, _, _, _ in entries})
+    new_users = []
+    days = {}
+    for _, user_id, kind, balance, created_at in entries:
+        usage = users.get(user_id)
+        if usage is None:
+            usage = users[user_id] = UserUsage(user_id=user_id)
+            new_users.append(usage)
+        amount, usage.balance = balance - usage.balance, balance
+
+        day = timezone.localdate(created_at)
+        totals = days.setdefault(day, dict.fromkeys(USAGE_FIELDS, timedelta(0)) | {'entries': 0})
+        totals['entries'] += 1
+        usage_change = classify(kind, amount)
+        if usage_change is not None:
+            field, value = usage_change
+            setattr(usage, field, getattr(usage, field) + value)
+            totals[field] += value
+
+    UserUsage.objects.bulk_create(new_users)
+    new_user_ids = {usage.user_id for usage in new_users}
+    UserUsage.objects.bulk_update(
+        [usage for usage in users.values() if usage.user_id not in new_user_ids], [*USAGE_FIELDS, 'balance'],
+    )
+
+    existing = DailyUsage.objects.in_bulk(list(days), field_name='day')
+    new_days = []
+    for day, totals in days.items():
+        daily = existing.get(day)
+        if daily is None:
+            new_days.append(DailyUsage(day=day, **totals))
+            continue
+        for field, value in totals.items():
+            setattr(daily, field, getattr(daily, field) + value)
+    DailyUsage.objects.bulk_create(new_days)
+    DailyUsage.objects.bulk_update(list(existing.values()), [*USAGE_FIELDS, 'entries'])
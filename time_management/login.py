@@ -0,0 +1,70 @@
+"""
+The login pipeline shared by the sync and async login endpoints.
+
+``authenticate`` loads the user and balance in one query (see backends.py)
+and spends nearly all of a login's CPU in the password hasher, whose cost is
+set by the ``PASSWORD_HASH*`` settings. The tokens are then minted and
+signed once, and the login's writes go in one short transaction:
+
+* the upgraded password hash, when the stored one was made by another
+  hasher or at another cost;
+* ``last_login``, when ``SIMPLE_JWT['UPDATE_LAST_LOGIN']`` is on, as a plain
+  UPDATE that sends no ``User`` save signals;
+* the ``OutstandingToken`` row for the refresh token, unless
+  ``TIME_LOGIN_RECORD_TOKENS`` is off. Blacklisting does not need that row
+  (it is created on logout), it only lists issued tokens in the admin.
+
+With the defaults and an up-to-date hash a login is one read and one insert,
+and needs no transaction.
+"""
+from contextlib import nullcontext
+from django.conf import settings
+from django.contrib.auth import authenticate
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+from rest_framework_simplejwt.settings import api_settings
+from .buffer import get_write_behind_buffer
+from .models import UserTime
+from .serializers import remaining_seconds_field
+from .tokens import ClaimsRefreshToken
+
+
+def log_in(request, username, password):
+    """Check the credentials and issue tokens. Returns the login response body, or ``None`` for bad credentials."""
+    user = authenticate(request, username=username, password=password, defer_rehash=True)
+    if user is None:
+        return None
+
+    refresh = ClaimsRefreshToken.mint(user)
+    encoded_refresh, encoded_access = str(refresh), str(refresh.access_token)
+
+    updates = {}
+    if getattr(user, 'password_rehashed', False):
+        updates['password'] = user.password
+    if api_settings.UPDATE_LAST_LOGIN:
+        updates['last_login'] = user.last_login = timezone.now()
+    # A lone token insert is atomic by itself
+    with transaction.atomic() if updates else nullcontext():
+        if updates:
+            User.objects.filter(pk=user.pk).update(**updates)
+        if getattr(settings, 'TIME_LOGIN_RECORD_TOKENS', True):
+            refresh.outstanding_token(user, encoded_refresh).save()
+        try:
+            user_time = user.time
+        except UserTime.DoesNotExist:
+            # Users created without signals (fixtures, raw imports) get their balance row lazily
+            user_time, created = UserTime.objects.get_or_create(user=user)
+
+    remaining_time = user_time.current_remaining_time
+    time_buffer = get_write_behind_buffer()
+    if time_buffer is not None and time_buffer.get(user.username) is not None:
+        remaining_time = time_buffer.get(user.username)
+    return {
+        "success": True,
+        "username": user.username,
+        "remaining_time": str(remaining_time),
+        **remaining_seconds_field(remaining_time),
+        "access": encoded_access,
+        "refresh": encoded_refresh,
+    }
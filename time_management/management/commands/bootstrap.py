@@ -0,0 +1,91 @@
+import os
+import time
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.migrations.executor import MigrationExecutor
+import pc_usage_manager
+
+
+class Command(BaseCommand):
+    help = (
+        "Prepares the database and starts the server in this process: applies pending migrations, "
+        "creates the admin user if missing and reports how long each startup phase took."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--server', choices=['asgi', 'wsgi', 'runserver', 'none'], default='none',
+            help="Server to run once bootstrapped: gunicorn with uvicorn (asgi) or sync (wsgi) workers, "
+                 "the development server, or none.",
+        )
+        parser.add_argument('--bind', default=os.getenv("BIND", "0.0.0.0:8000"))
+
+    def handle(self, *args, server, bind, **options):
+        phases = [('settings and apps', time.perf_counter() - pc_usage_manager.STARTED_AT)]
+
+        def phase(name, started):
+            phases.append((name, time.perf_counter() - started))
+
+        started = time.perf_counter()
+        executor = MigrationExecutor(connections[DEFAULT_DB_ALIAS])
+        pending = executor.migration_plan(executor.loader.graph.leaf_nodes())
+        phase('migration check', started)
+        if pending:
+            started = time.perf_counter()
+            call_command('migrate', interactive=False, verbosity=options['verbosity'])
+            phase(f'migrate ({len(pending)} migrations)', started)
+
+        started = time.perf_counter()
+        self.ensure_admin()
+        phase('admin user', started)
+
+        for name, seconds in phases:
+            self.stdout.write(f"  {name:<28} {seconds * 1000:>8.1f} ms")
+        self.stdout.write(f"Bootstrapped in {sum(seconds for _, seconds in phases) * 1000:.1f} ms.")
+
+        # Workers are forked from this process and must not share its database connections
+        connections.close_all()
+        if server == 'runserver':
+            call_command('runserver', bind, use_reloader=False)
+        elif server != 'none':
+            self.serve(server, bind)
+
+    def ensure_admin(self):
+        username = os.getenv('ADMIN_USER', 'admin')
+        if User.objects.filter(username=username).exists():
+            return
+        password = os.getenv('ADMIN_PASSWORD')
+        if not password:
+            message = f"Not creating the admin user '{username}': ADMIN_PASSWORD is empty."
+            if not User.objects.filter(is_superuser=True).exists():
+                message += " No superuser exists, so the admin site cannot be used until it is set."
+            self.stderr.write(self.style.WARNING(message))
+            return
+        User.objects.create_superuser(username, os.getenv('ADMIN_EMAIL', 'admin@example.com'), password)
+        self.stdout.write(f"Created the admin user '{username}'.")
+
+    def serve(self, server, bind):
+        """Run gunicorn on the application already loaded here; workers fork from this process."""
+        from gunicorn.app.base import Application
+
+        if server == 'asgi':
+            from pc_usage_manager.asgi import application
+        else:
+            from pc_usage_manager.wsgi import application
+        options = {'bind': bind, 'preload_app': True}
+        if server == 'wsgi':
+            options['worker_class'] = 'sync'
+
+        class Server(Application):
+            def load_config(self):
+                self.load_config_from_file(str(settings.BASE_DIR / 'gunicorn.conf.py'))
+                for key, value in options.items():
+                    self.cfg.set(key, value)
+
+            def load(self):
+                return application
+
+        Server().run()
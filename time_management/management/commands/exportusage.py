@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+from time_management import export
+
+
+class Command(BaseCommand):
+    help = "Streams every balance or ledger entry as CSV or NDJSON, optionally gzip compressed to a file."
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=list(export.DATASETS), help="What to export.")
+        parser.add_argument('--format', dest='output', choices=list(export.FORMATS), default='csv')
+        parser.add_argument('--gzip', action='store_true', help="Compress the output with gzip (needs --output-file).")
+        parser.add_argument('--chunk-size', type=int, default=2000, help="Rows read per database round trip.")
+        parser.add_argument('-o', '--output-file', default=None, help="Write to this file instead of stdout.")
+
+    def handle(self, *args, dataset, output, gzip, chunk_size, output_file, **options):
+        if gzip and output_file is None:
+            raise CommandError("--gzip needs --output-file.")
+        chunks = export.export(dataset, output, compress=gzip, chunk_size=chunk_size)
+        if output_file is None:
+            for chunk in chunks:
+                self.stdout.write(chunk.decode(), ending='')
+            return
+        with open(output_file, 'wb') as file:
+            for chunk in chunks:
+                file.write(chunk)
+        self.stderr.write(f"Exported {dataset} to {output_file}.")
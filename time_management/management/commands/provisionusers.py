@@ -0,0 +1,34 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from time_management.provisioning import provision_users, read_rows
+
+
+class Command(BaseCommand):
+    help = "Creates users and their starting balances from a CSV (with a header row) or JSON file."
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help="CSV or JSON file with username, password, email and minutes per user.")
+        parser.add_argument(
+            '--format', dest='file_format', choices=['csv', 'json'], default=None,
+            help="File format; guessed from the extension by default.",
+        )
+        parser.add_argument('--chunk-size', type=int, default=500, help="Users inserted per transaction.")
+        parser.add_argument(
+            '--workers', type=int, default=None,
+            help="Processes hashing passwords (default: one per CPU, 1 hashes inline).",
+        )
+
+    def handle(self, *args, file, file_format, chunk_size, workers, **options):
+        file_format = file_format or ('json' if file.endswith('.json') else 'csv')
+        try:
+            with open(file, newline='', encoding='utf-8') as rows_file:
+                result = provision_users(read_rows(rows_file, file_format), chunk_size=chunk_size, workers=workers)
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Could not read {file}: {e}")
+
+        for error in result['errors']:
+            self.stderr.write(f"Row {error['row']} ({error['username']}): {json.dumps(error['error'])}")
+        self.stdout.write(
+            f"Created {result['created']} users in {result['seconds']:.2f}s "
+            f"({result['rows_per_second']:.0f} rows/s), skipped {len(result['errors'])}."
+        )
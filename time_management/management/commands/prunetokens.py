@@ -0,0 +1,22 @@
+import time
+from django.core.management.base import BaseCommand
+from time_management.tokens import prune_expired_tokens
+
+
+class Command(BaseCommand):
+    help = "Deletes expired outstanding and blacklisted tokens in batches, once or periodically."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Tokens deleted per transaction.")
+        parser.add_argument(
+            '--every', type=float, default=None, metavar='SECONDS',
+            help="Keep running and prune every SECONDS instead of once.",
+        )
+
+    def handle(self, *args, batch_size, every, **options):
+        while True:
+            deleted = prune_expired_tokens(batch_size=batch_size)
+            self.stdout.write(f"Pruned {deleted} expired tokens.")
+            if every is None:
+                return
+            time.sleep(every)
@@ -0,0 +1,30 @@
+import time
+from django.core.management.base import BaseCommand
+from time_management.ledger import rebuild_rollups, roll_up
+
+
+class Command(BaseCommand):
+    help = "Folds new usage ledger entries into the per-user and per-day rollups, once or periodically."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help="Ledger entries rolled up per transaction.")
+        parser.add_argument(
+            '--settle', type=float, default=60, metavar='SECONDS',
+            help="Only roll up entries older than SECONDS, so late commits are not skipped.",
+        )
+        parser.add_argument('--rebuild', action='store_true', help="Recompute the rollups from the whole ledger first.")
+        parser.add_argument(
+            '--every', type=float, default=None, metavar='SECONDS',
+            help="Keep running and roll up every SECONDS instead of once.",
+        )
+
+    def handle(self, *args, batch_size, settle, rebuild, every, **options):
+        if rebuild:
+            rolled = rebuild_rollups(batch_size=batch_size, settle=settle)
+            self.stdout.write(f"Rebuilt the rollups from {rolled} ledger entries.")
+        while True:
+            rolled = roll_up(batch_size=batch_size, settle=settle)
+            self.stdout.write(f"Rolled up {rolled} ledger entries.")
+            if every is None:
+                return
+            time.sleep(every)
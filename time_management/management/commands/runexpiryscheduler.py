@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from time_management.expiry import ExpiryScheduler
+from time_management.pubsub import get_broker
+
+
+class Command(BaseCommand):
+    help = "Zeroes the balance of running sessions as they run out, using the indexed expires_at column."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--horizon', type=float, default=300, metavar='SECONDS',
+            help="How far ahead upcoming expiries are loaded into memory.",
+        )
+        parser.add_argument(
+            '--refresh', type=float, default=10, metavar='SECONDS',
+            help="How often the upcoming expiries are re-read to pick up new and extended sessions.",
+        )
+        parser.add_argument('--batch-size', type=int, default=1000, help="Sessions expired per transaction.")
+        parser.add_argument('--load-limit', type=int, default=10000, help="Upcoming expiries read per query.")
+        parser.add_argument('--once', action='store_true', help="Expire the sessions due now and exit.")
+
+    def handle(self, *args, horizon, refresh, batch_size, load_limit, once, **options):
+        if get_broker().process_local:
+            raise CommandError(
+                "TIME_PUBSUB['BACKEND'] only delivers within one process, so the sessions this command expires "
+                "would never be pushed to connected clients. Use time_management.pubsub.RedisBroker."
+            )
+        scheduler = ExpiryScheduler(
+            horizon=horizon, refresh=min(refresh, horizon), batch_size=batch_size, load_limit=load_limit,
+        )
+        if once:
+            now = timezone.now()
+            expired = len(scheduler.run_pending(now))
+            while scheduler.seconds_until_next(now) == 0:
+                expired += len(scheduler.run_pending(now))
+            self.stdout.write(f"Expired {expired} sessions.")
+            return
+        self.stdout.write(f"Expiring sessions with a {horizon:.0f}s horizon, refreshed every {refresh:.0f}s.")
+        scheduler.run()
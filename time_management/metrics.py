@@ -0,0 +1,233 @@
+"""
+Per-view request metrics exposed in the Prometheus text format.
+
+``MetricsMiddleware`` records, for each view, method and status code, a
+latency histogram, the number and total time of database queries and the
+response size. Counters are kept in per-thread shards, so recording never
+takes a lock; ``metrics_view`` sums the shards when scraped, and the shards
+of finished threads are folded into a base total. The middleware works in
+both sync and async mode.
+
+Requests slower than ``METRICS_SLOW_REQUEST_THRESHOLD`` seconds are logged
+to the ``time_management.slow_requests`` logger with the SQL they executed.
+
+When a database uses a psycopg connection pool, its statistics are exported
+as ``db_pool_*`` metrics labelled with the database alias, and the log
+records dropped by ``time_management.logs.BackgroundHandler`` as
+``log_records_dropped_total``.
+"""
+import logging
+import threading
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connection, connections
+from django.http import HttpResponse
+from .logs import BackgroundHandler
+
+slow_request_logger = logging.getLogger('time_management.slow_requests')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Offsets into a shard entry, after one count per latency bucket
+_SUM, _COUNT, _QUERIES, _QUERY_TIME, _SIZE = range(len(LATENCY_BUCKETS) + 1, len(LATENCY_BUCKETS) + 6)
+_ENTRY_SIZE = _SIZE + 1
+
+
+def _add(totals, shard):
+    for key, entry in list(shard.items()):
+        total = totals.setdefault(key, [0] * _ENTRY_SIZE)
+        for index, value in enumerate(entry):
+            total[index] += value
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []  # (thread, shard) pairs
+        self._base = {}  # Totals folded in from the shards of finished threads
+        self._shards_lock = threading.Lock()  # Only taken when a thread records its first request, and to collect
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                # Servers may use a thread per request; don't keep a shard for each one
+                self._fold_finished()
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def _fold_finished(self):
+        """Add the shards of finished threads to the base totals and drop them. Called with the lock held."""
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                _add(self._base, shard)
+        self._shards = live
+
+    def record(self, view, method, status, duration, queries, query_time, size):
+        shard = self._shard()
+        key = (view, method, status)
+        entry = shard.get(key)
+        if entry is None:
+            entry = shard[key] = [0] * _ENTRY_SIZE
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if duration <= bound:
+                entry[index] += 1
+                break
+        else:
+            entry[len(LATENCY_BUCKETS)] += 1  # +Inf
+        entry[_SUM] += duration
+        entry[_COUNT] += 1
+        entry[_QUERIES] += queries
+        entry[_QUERY_TIME] += query_time
+        entry[_SIZE] += size
+
+    def collect(self):
+        """Return ``{(view, method, status): entry}`` summed over all threads."""
+        with self._shards_lock:
+            self._fold_finished()
+            totals = {}
+            _add(totals, self._base)
+            shards = [shard for thread, shard in self._shards]
+        for shard in shards:
+            _add(totals, shard)
+        return totals
+
+    def render(self):
+        """Render the collected metrics in the Prometheus text exposition format."""
+        totals = self.collect()
+        lines = [
+            "# HELP http_request_duration_seconds Request latency by view, method and status.",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        for (view, method, status), entry in sorted(totals.items()):
+            labels = f'view="{view}",method="{method}",status="{status}"'
+            cumulative = 0
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                cumulative += entry[index]
+                lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {entry[_COUNT]}')
+            lines.append(f'http_request_duration_seconds_sum{{{labels}}} {entry[_SUM]}')
+            lines.append(f'http_request_duration_seconds_count{{{labels}}} {entry[_COUNT]}')
+        for name, index, help_text in (
+            ('http_request_db_queries_total', _QUERIES, "Database queries executed by requests."),
+            ('http_request_db_query_seconds_total', _QUERY_TIME, "Time spent in database queries."),
+            ('http_response_size_bytes_total', _SIZE, "Response body bytes sent."),
+        ):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for (view, method, status), entry in sorted(totals.items()):
+                lines.append(f'{name}{{view="{view}",method="{method}",status="{status}"}} {entry[index]}')
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+# psycopg_pool statistics reported as gauges; the others are running totals
+POOL_GAUGES = ('pool_min', 'pool_max', 'pool_size', 'pool_available', 'requests_waiting')
+
+
+def render_pool_stats():
+    """Render the statistics of the psycopg connection pools of this process."""
+    stats = {}
+    for alias in connections:
+        pool = getattr(connections[alias], 'pool', None)
+        if pool is not None:
+            stats[alias] = pool.get_stats()
+    lines = []
+    for name in sorted({name for alias_stats in stats.values() for name in alias_stats}):
+        lines.append(f"# TYPE db_{name} {'gauge' if name in POOL_GAUGES else 'counter'}")
+        for alias, alias_stats in sorted(stats.items()):
+            if name in alias_stats:
+                lines.append(f'db_{name}{{alias="{alias}"}} {alias_stats[name]}')
+    return "".join(f"{line}\n" for line in lines)
+
+
+def render_log_stats():
+    """Render the number of log records dropped by the background log handlers of this process."""
+    loggers = [logging.getLogger(), *logging.Logger.manager.loggerDict.values()]
+    handlers = {
+        handler for logger in loggers for handler in getattr(logger, 'handlers', ())
+        if isinstance(handler, BackgroundHandler)
+    }
+    return (
+        "# HELP log_records_dropped_total Log records dropped because the background log queue was full.\n"
+        "# TYPE log_records_dropped_total counter\n"
+        f"log_records_dropped_total {sum(handler.dropped for handler in handlers)}\n"
+    )
+
+
+class _QueryRecorder:
+    """Database execute wrapper counting queries and, for the slow log, keeping their SQL."""
+
+    def __init__(self, keep_sql):
+        self.count = 0
+        self.time = 0.0
+        self.keep_sql = keep_sql
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.count += 1
+            self.time += duration
+            if self.keep_sql:
+                self.queries.append((sql, duration))
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.slow_threshold = getattr(settings, 'METRICS_SLOW_REQUEST_THRESHOLD', None)
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        recorder = _QueryRecorder(keep_sql=self.slow_threshold is not None)
+        start = time.perf_counter()
+        with connection.execute_wrapper(recorder):
+            response = self.get_response(request)
+        self.record(request, response, recorder, time.perf_counter() - start)
+        return response
+
+    async def __acall__(self, request):
+        recorder = _QueryRecorder(keep_sql=self.slow_threshold is not None)
+        start = time.perf_counter()
+        # Async ORM queries run in sync_to_async threads that share this context's connection
+        with connection.execute_wrapper(recorder):
+            response = await self.get_response(request)
+        self.record(request, response, recorder, time.perf_counter() - start)
+        return response
+
+    def record(self, request, response, recorder, duration):
+        match = request.resolver_match
+        view = (match.url_name or match.view_name) if match else '<unmatched>'
+        size = 0 if response.streaming else len(response.content)
+        registry.record(view, request.method, response.status_code, duration, recorder.count, recorder.time, size)
+
+        if self.slow_threshold is not None and duration >= self.slow_threshold:
+            slow_request_logger.warning(
+                "Slow request %s %s (%s) took %.3fs with %d queries in %.3fs:\n%s",
+                request.method, request.path, view, duration, recorder.count, recorder.time,
+                "\n".join(f"  [{query_time:.4f}s] {sql}" for sql, query_time in recorder.queries),
+            )
+
+
+def metrics_view(request):
+    """Serve the collected metrics. Requires ``Bearer <METRICS_TOKEN>`` when that setting is set."""
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return HttpResponse(status=403)
+    return HttpResponse(registry.render() + render_pool_stats() + render_log_stats(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-16 20:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('time_management', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usertime',
+            name='session_started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """
+    Index token_blacklist_outstandingtoken.expires_at so prunetokens finds
+    expired tokens without scanning the table. The table belongs to
+    simplejwt's token_blacklist app, hence raw SQL.
+    """
+
+    dependencies = [
+        ('time_management', '0002_usertime_session_started_at'),
+        ('token_blacklist', '0013_alter_blacklistedtoken_options_and_more'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql='CREATE INDEX "token_blacklist_outstandingtoken_expires_at_idx" '
+                'ON "token_blacklist_outstandingtoken" ("expires_at");',
+            reverse_sql='DROP INDEX "token_blacklist_outstandingtoken_expires_at_idx";',
+        ),
+    ]
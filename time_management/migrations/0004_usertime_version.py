@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-16 21:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('time_management', '0003_outstandingtoken_expires_at_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usertime',
+            name='updated_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='usertime',
+            name='version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,23 @@
+from django.db import migrations, models
+
+
+def backfill_expires_at(apps, schema_editor):
+    UserTime = apps.get_model('time_management', 'UserTime')
+    running = UserTime.objects.using(schema_editor.connection.alias).filter(session_started_at__isnull=False)
+    running.update(expires_at=models.F('session_started_at') + models.F('remaining_time'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('time_management', '0004_usertime_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usertime',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(backfill_expires_at, migrations.RunPython.noop),
+    ]
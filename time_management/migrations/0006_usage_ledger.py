@@ -0,0 +1,79 @@
+# Generated by Django 5.1.4 on 2026-10-16 21:14
+
+import datetime
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def open_ledger(apps, schema_editor):
+    # Start every existing balance's history with an opening entry
+    UserTime = apps.get_model('time_management', 'UserTime')
+    LedgerEntry = apps.get_model('time_management', 'LedgerEntry')
+    db = schema_editor.connection.alias
+    now = datetime.datetime.now(datetime.timezone.utc)
+    balances = UserTime.objects.using(db).values_list('user_id', 'remaining_time').iterator(chunk_size=2000)
+    batch = []
+    for user_id, remaining_time in balances:
+        batch.append(LedgerEntry(user_id=user_id, kind='opening', balance=remaining_time, created_at=now))
+        if len(batch) == 2000:
+            LedgerEntry.objects.using(db).bulk_create(batch)
+            batch = []
+    LedgerEntry.objects.using(db).bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('time_management', '0005_usertime_expires_at'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(unique=True)),
+                ('purchased', models.DurationField(default=datetime.timedelta(0))),
+                ('consumed', models.DurationField(default=datetime.timedelta(0))),
+                ('corrected', models.DurationField(default=datetime.timedelta(0))),
+                ('entries', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'daily usage',
+            },
+        ),
+        migrations.CreateModel(
+            name='RollupCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_entry_id', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserUsage',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='usage', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('purchased', models.DurationField(default=datetime.timedelta(0))),
+                ('consumed', models.DurationField(default=datetime.timedelta(0))),
+                ('corrected', models.DurationField(default=datetime.timedelta(0))),
+                ('balance', models.DurationField(default=datetime.timedelta(0))),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('opening', 'Opening'), ('purchase', 'Purchase'), ('consumption', 'Consumption'), ('sync', 'Sync'), ('expiry', 'Expiry'), ('correction', 'Correction')], max_length=16)),
+                ('balance', models.DurationField()),
+                ('created_at', models.DateTimeField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ledger_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'ledger entries',
+            },
+        ),
+        migrations.RunPython(open_ledger, migrations.RunPython.noop),
+    ]
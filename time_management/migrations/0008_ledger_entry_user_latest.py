@@ -0,0 +1,19 @@
+# Generated by Django 5.1.4 on 2026-10-16 23:23
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('time_management', '0007_device_sync_cursor'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ledgerentry',
+            index=models.Index(fields=['user', 'id'], name='ledger_entry_user_latest'),
+        ),
+    ]
@@ -1,14 +1,654 @@
-from django.db import models
+from asgiref.sync import sync_to_async
+from contextlib import nullcontext
+from django.db import IntegrityError, connections, models, router, transaction
+from django.db.models.expressions import RawSQL
+from django.dispatch import Signal
 from django.contrib.auth.models import User
-from datetime import timedelta
+from django.utils import timezone
+from datetime import datetime, timedelta
+
+# Sent with ``user_times=[...]`` after every balance mutation, inside the
+# mutating transaction, and with the ``kind`` of change recorded in the
+# ledger (``None`` when the balance itself did not change). On PostgreSQL
+# single-row mutations write their ledger entry in the same statement and send
+# ``ledger_recorded=True``. Receivers live in signals.py.
+balance_changed = Signal()
+
+# Sent with ``user_times=[...]`` for the sessions zeroed by expire_sessions().
+session_expired = Signal()
+
+
+class UserTimeManager(models.Manager):
+    """
+    Balance mutations that run as a single ``UPDATE ... RETURNING`` statement.
+
+    Every mutation is keyed by ``username`` or ``user_id`` and only touches
+    the columns it changes, so concurrent top-ups and syncs never lose updates
+    and each call costs one round trip. ``expires_at`` is kept in step with
+    the balance and session columns in the same statement. The methods return the updated
+    ``UserTime`` (with ``user`` pre-populated when keyed by username) or
+    ``None`` when no balance row matches.
+    """
+
+    # Attempts made by stop_session() before giving up on a row whose session
+    # keeps being restarted underneath it.
+    STOP_SESSION_ATTEMPTS = 3
+
+    def add(self, delta, *, username=None, user_id=None):
+        """Add ``delta`` (a ``timedelta``) to the balance."""
+        return self._mutate(
+            {
+                'remaining_time': ("{remaining_time} + %s", [delta]),
+                'expires_at': (lambda ops: ops.combine_duration_expression('+', ['{expires_at}', '%s']), [delta]),
+            },
+            username=username,
+            user_id=user_id,
+            kind=LedgerEntry.Kind.PURCHASE,
+        )
+
+    def consume(self, delta, *, username=None, user_id=None):
+        """Subtract ``delta`` from the balance, never going below zero."""
+        return self._mutate(
+            {
+                'remaining_time': self._consume_expression(delta),
+                'expires_at': self._consume_expiry_expression(delta),
+            },
+            username=username,
+            user_id=user_id,
+            kind=LedgerEntry.Kind.CONSUMPTION,
+        )
+
+    def set(self, value, *, username=None, user_id=None, now=None):
+        """
+        Overwrite the balance with ``value``.
+
+        A running session is re-anchored to ``now`` so the countdown continues
+        from the new value.
+        """
+        now = now or timezone.now()
+        return self._mutate(
+            {
+                'remaining_time': ("%s", [value]),
+                'session_started_at': ("CASE WHEN {session_started_at} IS NULL THEN NULL ELSE %s END", [now]),
+                'expires_at': ("CASE WHEN {session_started_at} IS NULL THEN NULL ELSE %s END", [now + value]),
+            },
+            username=username,
+            user_id=user_id,
+            kind=LedgerEntry.Kind.SYNC,
+        )
+
+    def start_session(self, *, username=None, user_id=None, now=None):
+        """Start counting down the balance. Starting a running session is a no-op."""
+        now = now or timezone.now()
+        return self._mutate(
+            {
+                'session_started_at': ("COALESCE({session_started_at}, %s)", [now]),
+                'expires_at': (
+                    lambda ops: "COALESCE({expires_at}, %s)" % ops.combine_duration_expression(
+                        '+', ['%s', '{remaining_time}'],
+                    ),
+                    [now],
+                ),
+            },
+            username=username,
+            user_id=user_id,
+        )
+
+    def stop_session(self, *, username=None, user_id=None, now=None):
+        """
+        Stop the countdown and persist the time used since the session started.
+
+        The elapsed time is computed from the stored ``session_started_at`` and
+        applied with a compare-and-set on that column, so top-ups made while
+        the session was running are kept.
+        """
+        now = now or timezone.now()
+        lookup = {'user__username': username} if username is not None else {'user_id': user_id}
+        user_time = None
+        for _ in range(self.STOP_SESSION_ATTEMPTS):
+            # Read from the database written to, so a lagging replica cannot fail the compare-and-set
+            user_time = self.using(router.db_for_write(self.model)).filter(**lookup).first()
+            if user_time is None or user_time.session_started_at is None:
+                return user_time
+            elapsed = max(now - user_time.session_started_at, timedelta(0))
+            updated = self._mutate(
+                {
+                    'remaining_time': self._consume_expression(elapsed),
+                    'session_started_at': ("NULL", []),
+                    'expires_at': ("NULL", []),
+                },
+                username=username,
+                user_id=user_id,
+                condition=("{session_started_at} = %s", [user_time.session_started_at]),
+                kind=LedgerEntry.Kind.CONSUMPTION,
+            )
+            if updated is not None:
+                return updated
+        return user_time
+
+    def consume_reported(self, delta, *, device_id, sequence, username=None, user_id=None):
+        """
+        Subtract ``delta`` consumed on ``device_id`` unless its ``sequence`` was already applied.
+
+        Each device numbers its reports with an increasing ``sequence``, so
+        retries and replays of a report (from any app instance) are ignored.
+        The decrement commutes with top-ups and reports from other devices.
+        Returns ``(user_time, applied)``; ``user_time`` is ``None`` when no
+        balance row matches.
+        """
+        with transaction.atomic(using=router.db_for_write(self.model)):
+            if DeviceSyncCursor.objects.advance(device_id, sequence, username=username, user_id=user_id):
+                return self.consume(delta, username=username, user_id=user_id), True
+            lookup = {'user__username': username} if username is not None else {'user_id': user_id}
+            return self.using(router.db_for_write(self.model)).filter(**lookup).first(), False
+
+    def bulk_apply(self, changes, *, now=None):
+        """
+        Apply many balance changes in one transaction with a constant number of queries.
+
+        ``changes`` is a sequence of ``(username, remaining_time, add)`` tuples
+        where ``remaining_time`` overwrites the balance (or is ``None``) and
+        ``add`` is a ``timedelta`` added afterwards. Changes for the same user
+        are applied in order. Returns ``{username: UserTime}`` for the users
+        that have a balance row.
+        """
+        now = now or timezone.now()
+        # Fold the changes into one (base, delta) pair per user.
+        folded = {}
+        for username, remaining_time, add in changes:
+            base, delta = folded.get(username, (None, timedelta(0)))
+            if remaining_time is not None:
+                base, delta = remaining_time, timedelta(0)
+            folded[username] = (base, delta + (add or timedelta(0)))
+
+        with transaction.atomic(using=router.db_for_write(self.model)):
+            user_ids = dict(
+                self.select_for_update(of=('self',))
+                .filter(user__username__in=folded)
+                .values_list('user__username', 'user_id')
+            )
+            if not user_ids:
+                return {}
+
+            balance_whens, session_whens, expiry_whens = [], [], []
+            for username, user_id in user_ids.items():
+                base, delta = folded[username]
+                if base is not None:
+                    balance_whens.append(models.When(user_id=user_id, then=models.Value(base + delta)))
+                    session_whens.append(user_id)
+                    expiry_whens.append(models.When(
+                        user_id=user_id, session_started_at__isnull=False, then=models.Value(now + base + delta),
+                    ))
+                elif delta:
+                    balance_whens.append(models.When(user_id=user_id, then=models.F('remaining_time') + delta))
+                    expiry_whens.append(models.When(user_id=user_id, then=models.F('expires_at') + delta))
+
+            updates = {}
+            if balance_whens:
+                updates['remaining_time'] = models.Case(*balance_whens, default=models.F('remaining_time'))
+            if session_whens:
+                # Re-anchor running sessions whose balance was overwritten, as set() does.
+                updates['session_started_at'] = models.Case(
+                    models.When(user_id__in=session_whens, session_started_at__isnull=False, then=models.Value(now)),
+                    default=models.F('session_started_at'),
+                )
+            if expiry_whens:
+                updates['expires_at'] = models.Case(*expiry_whens, default=models.F('expires_at'))
+            if updates:
+                self.filter(user_id__in=user_ids.values()).update(
+                    **updates, version=models.F('version') + 1, updated_at=now,
+                )
+
+            fields = [field.name for field in self.model._meta.concrete_fields]
+            user_times = list(
+                self.filter(user_id__in=user_ids.values())
+                .select_related('user')
+                .only(*fields, 'user__username')
+            )
+            synced = [user_time for user_time in user_times if folded[user_time.user.username][0] is not None]
+            purchased = [user_time for user_time in user_times if folded[user_time.user.username][0] is None]
+            for kind, changed in ((LedgerEntry.Kind.SYNC, synced), (LedgerEntry.Kind.PURCHASE, purchased)):
+                if changed:
+                    balance_changed.send(sender=self.model, user_times=changed, kind=kind)
+            return {user_time.user.username: user_time for user_time in user_times}
+
+    def add_many(self, delta, user_ids, *, now=None):
+        """
+        Add ``delta`` to the balance of every user in ``user_ids`` (ids or a
+        queryset of them) with one ``UPDATE``.
+
+        Returns the updated ``UserTime`` rows.
+        """
+        now = now or timezone.now()
+        return self._update_many(
+            user_ids,
+            {'remaining_time': models.F('remaining_time') + delta, 'expires_at': models.F('expires_at') + delta},
+            kind=LedgerEntry.Kind.PURCHASE,
+            now=now,
+        )
+
+    def set_many(self, value, user_ids, *, now=None):
+        """
+        Overwrite the balance of every user in ``user_ids`` with ``value`` in one ``UPDATE``.
+
+        Running sessions are re-anchored at ``now``, as set() does. Returns the
+        updated ``UserTime`` rows.
+        """
+        now = now or timezone.now()
+        running = models.Q(session_started_at__isnull=False)
+        return self._update_many(
+            user_ids,
+            {
+                'remaining_time': value,
+                'session_started_at': models.Case(models.When(running, then=models.Value(now)), default=None),
+                'expires_at': models.Case(models.When(running, then=models.Value(now + value)), default=None),
+            },
+            kind=LedgerEntry.Kind.CORRECTION,
+            now=now,
+        )
+
+    def _update_many(self, user_ids, updates, *, kind, now):
+        with transaction.atomic(using=router.db_for_write(self.model)):
+            # Resolved up front so the rows re-read below are the ones updated
+            user_ids = list(self.select_for_update(of=('self',)).filter(user_id__in=user_ids).values_list('user_id', flat=True))
+            if not user_ids:
+                return []
+            self.filter(user_id__in=user_ids).update(**updates, version=models.F('version') + 1, updated_at=now)
+            fields = [field.name for field in self.model._meta.concrete_fields]
+            user_times = list(
+                self.filter(user_id__in=user_ids)
+                .select_related('user')
+                .only(*fields, 'user__username')
+            )
+            balance_changed.send(sender=self.model, user_times=user_times, kind=kind)
+            return user_times
+
+    def expire_sessions(self, user_ids=None, *, now=None):
+        """
+        Zero the balance and stop the session of users whose time ran out by ``now``.
+
+        Only rows whose ``expires_at`` is still due are touched, so candidates
+        that were topped up or stopped since they were scheduled are skipped.
+        Restricted to ``user_ids`` when given. Returns the expired ``UserTime`` rows.
+        """
+        now = now or timezone.now()
+        with transaction.atomic(using=router.db_for_write(self.model)):
+            qs = self.select_for_update(of=('self',)).filter(expires_at__lte=now)
+            if user_ids is not None:
+                qs = qs.filter(user_id__in=user_ids)
+            expired_ids = list(qs.values_list('user_id', flat=True))
+            if not expired_ids:
+                return []
+            self.filter(user_id__in=expired_ids).update(
+                remaining_time=timedelta(0),
+                session_started_at=None,
+                expires_at=None,
+                version=models.F('version') + 1,
+                updated_at=now,
+            )
+            fields = [field.name for field in self.model._meta.concrete_fields]
+            user_times = list(
+                self.filter(user_id__in=expired_ids)
+                .select_related('user')
+                .only(*fields, 'user__username')
+            )
+            balance_changed.send(sender=self.model, user_times=user_times, kind=LedgerEntry.Kind.EXPIRY)
+            session_expired.send(sender=self.model, user_times=user_times)
+            return user_times
+
+    # Async variants, following the ORM's ``a``-prefix convention.
+    async def aadd(self, delta, **kwargs):
+        return await sync_to_async(self.add)(delta, **kwargs)
+
+    async def aconsume(self, delta, **kwargs):
+        return await sync_to_async(self.consume)(delta, **kwargs)
+
+    async def aset(self, value, **kwargs):
+        return await sync_to_async(self.set)(value, **kwargs)
+
+    async def astart_session(self, **kwargs):
+        return await sync_to_async(self.start_session)(**kwargs)
+
+    async def astop_session(self, **kwargs):
+        return await sync_to_async(self.stop_session)(**kwargs)
+
+    @staticmethod
+    def _with_version(assignments):
+        # Every mutation bumps the balance version used for ETags
+        return {
+            **assignments,
+            'version': ("{version} + 1", []),
+            'updated_at': ("%s", [timezone.now()]),
+        }
+
+    @staticmethod
+    def _consume_expression(delta):
+        return (
+            "CASE WHEN {remaining_time} > %s THEN {remaining_time} - %s ELSE %s END",
+            [delta, delta, timedelta(0)],
+        )
+
+    @staticmethod
+    def _consume_expiry_expression(delta):
+        # Matches _consume_expression: a balance clamped at zero expires when the session started
+        return (
+            lambda ops: "CASE WHEN {remaining_time} > %s THEN %s ELSE {session_started_at} END" % (
+                '%s', ops.combine_duration_expression('-', ['{expires_at}', '%s']),
+            ),
+            [delta, delta],
+        )
+
+    @staticmethod
+    def _render(template, columns, connection):
+        # Templates doing datetime arithmetic are callables taking the backend's
+        # operations, since each backend spells it differently.
+        if callable(template):
+            template = template(connection.ops)
+        return template.format(**columns)
+
+    def _mutate(self, assignments, *, username=None, user_id=None, condition=None, kind=None):
+        """
+        Apply ``assignments`` ({field name: (SQL template, params)}) to one row.
+
+        SQL templates refer to columns by field name, e.g. ``{remaining_time}``,
+        and may be callables taking ``connection.ops`` that return the template.
+        ``condition`` is an optional extra ``(SQL template, params)`` guard and
+        ``kind`` the ledger kind sent with ``balance_changed``.
+        """
+        if (username is None) == (user_id is None):
+            raise TypeError("Exactly one of 'username' or 'user_id' is required.")
+
+        db = router.db_for_write(self.model)
+        connection = connections[db]
+        qn = connection.ops.quote_name
+        fields = self.model._meta.concrete_fields
+        columns = {field.attname: qn(field.column) for field in fields}
+
+        if not self._supports_update_returning(connection):
+            return self._mutate_fallback(db, assignments, columns, username, user_id, condition, kind)
+
+        set_sql, set_params = [], []
+        for name, (template, params) in self._with_version(assignments).items():
+            set_sql.append(f"{columns[name]} = {self._render(template, columns, connection)}")
+            set_params.extend(self._prep(value, connection) for value in params)
+
+        if username is not None:
+            where = "{user_id} = (SELECT {pk} FROM {user_table} WHERE {username} = %s)".format(
+                user_id=columns['user_id'],
+                pk=qn(User._meta.pk.column),
+                user_table=qn(User._meta.db_table),
+                username=qn(User.USERNAME_FIELD),
+            )
+            where_params = [username]
+        else:
+            where = f"{columns['user_id']} = %s"
+            where_params = [user_id]
+        if condition is not None:
+            template, params = condition
+            where = f"{where} AND {self._render(template, columns, connection)}"
+            where_params.extend(self._prep(value, connection) for value in params)
+
+        sql = "UPDATE {table} SET {assignments} WHERE {where} RETURNING {returning}".format(
+            table=qn(self.model._meta.db_table),
+            assignments=", ".join(set_sql),
+            where=where,
+            returning=", ".join(columns.values()),
+        )
+        params = set_params + where_params
+        # On PostgreSQL the ledger entry is inserted by the same statement, which
+        # needs no transaction of its own; elsewhere receivers write it in one.
+        ledger_recorded = kind is not None and connection.vendor == 'postgresql'
+        if ledger_recorded:
+            ledger_sql, ledger_params = self._ledger_insert(kind, columns, connection)
+            sql = f"WITH updated AS ({sql}), recorded AS ({ledger_sql}) SELECT * FROM updated"
+            params += ledger_params
+        with nullcontext() if ledger_recorded else transaction.atomic(using=db, savepoint=False):
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                row = cursor.fetchone()
+            if row is None:
+                return None
+
+            values = [self._convert(field, value, connection) for field, value in zip(fields, row)]
+            user_time = self._build(db, values, username)
+            balance_changed.send(sender=self.model, user_times=[user_time], kind=kind, ledger_recorded=ledger_recorded)
+        return user_time
+
+    @staticmethod
+    def _ledger_insert(kind, columns, connection):
+        # INSERT ... SELECT of the ledger entry for the row returned by the
+        # ``updated`` CTE, skipping syncs that leave the balance where the last
+        # entry left it, as ledger.record_entries does.
+        qn = connection.ops.quote_name
+        ledger = {field.name: qn(field.column) for field in LedgerEntry._meta.concrete_fields}
+        table = qn(LedgerEntry._meta.db_table)
+        sql = (
+            f"INSERT INTO {table} ({ledger['user']}, {ledger['kind']}, {ledger['balance']}, {ledger['created_at']}) "
+            f"SELECT updated.{columns['user_id']}, %s, updated.{columns['remaining_time']}, "
+            f"updated.{columns['updated_at']} FROM updated"
+        )
+        if kind == LedgerEntry.Kind.SYNC:
+            sql += (
+                f" WHERE updated.{columns['remaining_time']} IS DISTINCT FROM ("
+                f"SELECT previous.{ledger['balance']} FROM {table} previous "
+                f"WHERE previous.{ledger['user']} = updated.{columns['user_id']} ORDER BY previous.{ledger['id']} DESC LIMIT 1)"
+            )
+        return sql, [str(kind)]
+
+    def _mutate_fallback(self, db, assignments, columns, username, user_id, condition, kind):
+        # Backends without UPDATE ... RETURNING: lock the row, apply the same
+        # SQL expressions through the ORM and read the result back.
+        connection = connections[db]
+        assignments = self._with_version(assignments)
+        lookup = {'user__username': username} if username is not None else {'user_id': user_id}
+        with transaction.atomic(using=db):
+            qs = self.using(db).select_for_update(of=('self',)).filter(**lookup)
+            if condition is not None:
+                template, params = condition
+                qs = qs.filter(RawSQL(
+                    self._render(template, columns, connection),
+                    [self._prep(value, connection) for value in params],
+                    output_field=models.BooleanField(),
+                ))
+            pk = qs.values_list('pk', flat=True).first()
+            if pk is None:
+                return None
+            qs = self.using(db).filter(pk=pk)
+            qs.update(**{
+                name: RawSQL(
+                    self._render(template, columns, connection),
+                    [self._prep(value, connection) for value in params],
+                    output_field=self.model._meta.get_field(name),
+                )
+                for name, (template, params) in assignments.items()
+            })
+            values = list(qs.values_list(*columns).get())
+            user_time = self._build(db, values, username)
+            balance_changed.send(sender=self.model, user_times=[user_time], kind=kind)
+        return user_time
+
+    def _build(self, db, values, username):
+        instance = self.model.from_db(db, [field.attname for field in self.model._meta.concrete_fields], values)
+        if username is not None:
+            instance.user = User.from_db(db, [User._meta.pk.attname, User.USERNAME_FIELD], [instance.user_id, username])
+        return instance
+
+    @staticmethod
+    def _prep(value, connection):
+        if isinstance(value, timedelta):
+            return models.DurationField().get_db_prep_value(value, connection)
+        if isinstance(value, datetime):
+            return models.DateTimeField().get_db_prep_value(value, connection)
+        return value
+
+    @staticmethod
+    def _convert(field, value, connection):
+        col = field.cached_col
+        for converter in connection.ops.get_db_converters(col) + col.get_db_converters(connection):
+            value = converter(value, col, connection)
+        return value
+
+    @staticmethod
+    def _supports_update_returning(connection):
+        if connection.vendor == 'postgresql':
+            return True
+        if connection.vendor == 'sqlite':
+            return connection.Database.sqlite_version_info >= (3, 35)
+        return False
+
 
 class UserTime(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='time')
     remaining_time = models.DurationField(default=timedelta(minutes=0))
+    # Set while the user's PC is counting down. The live balance is derived
+    # from remaining_time minus the time elapsed since then, so the row is
+    # only written on start, stop, top-up or expiry.
+    session_started_at = models.DateTimeField(null=True, blank=True)
+    # Bumped by every balance change; drives the ETag/Last-Modified of balance reads.
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(null=True, blank=True)
+    # When a running session's balance reaches zero (session_started_at +
+    # remaining_time), NULL otherwise. Indexed so the expiry scheduler reads
+    # only the sessions about to run out.
+    expires_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    objects = UserTimeManager()
+
+    def save(self, *args, **kwargs):
+        # Full saves (admin edits, creation) are balance changes too
+        self.version += 1
+        self.updated_at = timezone.now()
+        self.expires_at = self.session_started_at + self.remaining_time if self.session_started_at else None
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'version', 'updated_at', 'expires_at'}
+        super().save(*args, **kwargs)
 
     def add_time(self, minutes):
-        self.remaining_time += timedelta(minutes=minutes)
-        self.save()
+        updated = UserTime.objects.add(timedelta(minutes=minutes), user_id=self.user_id)
+        if updated is not None:
+            self.remaining_time = updated.remaining_time
+
+    def remaining_time_at(self, now):
+        """Return the balance at ``now``, accounting for a running session."""
+        if self.session_started_at is None:
+            return self.remaining_time
+        elapsed = max(now - self.session_started_at, timedelta(0))
+        return max(self.remaining_time - elapsed, timedelta(0))
+
+    @property
+    def current_remaining_time(self):
+        return self.remaining_time_at(timezone.now())
 
     def __str__(self):
         return f"{self.user.username}: {self.remaining_time}"
+
+
+class DeviceSyncCursorManager(models.Manager):
+    def advance(self, device_id, sequence, *, username=None, user_id=None):
+        """
+        Record ``sequence`` as the device's last applied report.
+
+        Returns ``False`` for a sequence at or below the last one (a replay)
+        and for unknown users. Called inside the transaction applying the report.
+        """
+        db = router.db_for_write(self.model)
+        lookup = {'user__username': username} if username is not None else {'user_id': user_id}
+        if self.filter(**lookup, device_id=device_id, last_sequence__lt=sequence).update(last_sequence=sequence):
+            return True
+        if self.filter(**lookup, device_id=device_id).exists():
+            return False
+        if user_id is None:
+            user_id = User.objects.using(db).filter(username=username).values_list('id', flat=True).first()
+            if user_id is None:
+                return False
+        try:
+            with transaction.atomic(using=db):
+                self.create(user_id=user_id, device_id=device_id, last_sequence=sequence)
+        except IntegrityError:
+            # The device's first report raced with a retry of itself
+            return self.advance(device_id, sequence, user_id=user_id)
+        return True
+
+
+class DeviceSyncCursor(models.Model):
+    """The last usage report applied per user and device (see ``UserTimeManager.consume_reported``)."""
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='device_sync_cursors')
+    device_id = models.CharField(max_length=64)
+    last_sequence = models.BigIntegerField()
+
+    objects = DeviceSyncCursorManager()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['user', 'device_id'], name='unique_device_sync_cursor')]
+
+    def __str__(self):
+        return f"{self.user_id} {self.device_id}: {self.last_sequence}"
+
+
+class LedgerEntry(models.Model):
+    """
+    Append-only record of a balance change and the balance it left.
+
+    Rows are inserted in the transaction of the change they record and never
+    updated. The amount of each change is the difference from the previous
+    entry's balance, which ``time_management.ledger`` folds into the usage
+    rollups.
+    """
+
+    class Kind(models.TextChoices):
+        OPENING = 'opening'  # First balance seen for a user; carries no usage
+        PURCHASE = 'purchase'
+        CONSUMPTION = 'consumption'
+        SYNC = 'sync'  # Balance reported by the user's PC
+        EXPIRY = 'expiry'
+        CORRECTION = 'correction'
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='ledger_entries')
+    kind = models.CharField(max_length=16, choices=Kind.choices)
+    balance = models.DurationField()
+    created_at = models.DateTimeField()
+
+    class Meta:
+        verbose_name_plural = 'ledger entries'
+        # A user's latest entry, which sync entries are compared against
+        indexes = [models.Index(fields=['user', 'id'], name='ledger_entry_user_latest')]
+
+    def __str__(self):
+        return f"{self.user_id} {self.kind}: {self.balance}"
+
+
+class UserUsage(models.Model):
+    """Per-user usage totals rolled up from the ledger."""
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='usage')
+    purchased = models.DurationField(default=timedelta(0))
+    consumed = models.DurationField(default=timedelta(0))
+    corrected = models.DurationField(default=timedelta(0))
+    # Balance after the last rolled-up entry, the base of the next entry's amount
+    balance = models.DurationField(default=timedelta(0))
+
+    def __str__(self):
+        return f"{self.user_id}: +{self.purchased} -{self.consumed}"
+
+
+class DailyUsage(models.Model):
+    """Usage totals of all users per day, rolled up from the ledger."""
+
+    day = models.DateField(unique=True)
+    purchased = models.DurationField(default=timedelta(0))
+    consumed = models.DurationField(default=timedelta(0))
+    corrected = models.DurationField(default=timedelta(0))
+    entries = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = 'daily usage'
+
+    def __str__(self):
+        return f"{self.day}: +{self.purchased} -{self.consumed}"
+
+
+class RollupCursor(models.Model):
+    """The last ledger entry folded into the rollups (a single row)."""
+
+    last_entry_id = models.BigIntegerField(default=0)
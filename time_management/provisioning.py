@@ -0,0 +1,164 @@
+"""
+Bulk creation of users and their starting balances.
+
+``provision_users`` validates the rows, hashes the passwords on a process
+(or thread) pool and inserts the ``User`` and ``UserTime`` rows with ``bulk_create``, one
+transaction per chunk. ``bulk_create`` sends no ``post_save`` signals, so
+each chunk sends one ``balance_changed`` per ledger kind instead: new users
+with a starting balance get a purchase entry (an empty balance needs none,
+as for users created one by one) and every balance is cached and published
+like any other change.
+"""
+import csv
+import json
+import logging
+import os
+import time
+from datetime import timedelta
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from .models import LedgerEntry, UserTime, balance_changed
+from .serializers import ProvisionUserSerializer
+
+logger = logging.getLogger(__name__)
+
+USERNAME_TAKEN = 'A user with that username already exists.'
+
+
+def read_rows(file, file_format):
+    """Yield user rows (dicts) from a CSV file with a header row or a JSON list."""
+    if file_format == 'csv':
+        for row in csv.DictReader(file):
+            yield {key: value for key, value in row.items() if value not in ('', None)}
+    else:
+        yield from json.load(file)
+
+
+def provision_users(rows, *, chunk_size=500, workers=None, processes=True):
+    """
+    Create users from ``rows`` (dicts with ``username`` and optional
+    ``password``, ``email`` and starting ``minutes``).
+
+    Rows that are invalid, repeat an earlier username or name an existing user
+    are skipped. Returns ``{'created', 'errors', 'seconds', 'rows_per_second'}``
+    where ``errors`` lists ``{'row', 'username', 'error'}`` with 0-based row
+    numbers. ``workers`` processes (default: one per CPU) hash the passwords,
+    or threads with ``processes=False``, which is what request handlers must
+    use: forking a threaded server is unsafe. PBKDF2 releases the GIL, so
+    threads hash in parallel too. ``workers=1`` hashes inline.
+    """
+    started = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    created = 0
+    errors = []
+    executor = None
+    if workers > 1:
+        # Loads multiprocessing; only needed here
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+        executor = (ProcessPoolExecutor if processes else ThreadPoolExecutor)(max_workers=workers)
+
+    def hash_passwords(passwords):
+        if executor is None:
+            return list(map(make_password, passwords))
+        return list(executor.map(make_password, passwords, chunksize=max(1, len(passwords) // (workers * 4))))
+
+    try:
+        chunk = []
+        for index, row in enumerate(rows):
+            chunk.append((index, row))
+            if len(chunk) >= chunk_size:
+                created += _provision_chunk(chunk, errors, hash_passwords)
+                chunk = []
+        if chunk:
+            created += _provision_chunk(chunk, errors, hash_passwords)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    seconds = time.perf_counter() - started
+    rows_per_second = created / seconds if seconds else 0.0
+    logger.info(
+        "Provisioned %d users in %.2fs (%.0f rows/s), skipped %d.", created, seconds, rows_per_second, len(errors),
+    )
+    return {'created': created, 'errors': errors, 'seconds': seconds, 'rows_per_second': rows_per_second}
+
+
+def _provision_chunk(chunk, errors, hash_passwords):
+    valid = []
+    for index, row in chunk:
+        serializer = ProvisionUserSerializer(data=row)
+        if serializer.is_valid():
+            valid.append((index, serializer.validated_data))
+        else:
+            username = row.get('username') if isinstance(row, dict) else None
+            errors.append({'row': index, 'username': username, 'error': serializer.errors})
+
+    existing = set(User.objects.filter(username__in=[data['username'] for _, data in valid]).values_list('username', flat=True))
+    accepted = []
+    for index, data in valid:
+        if data['username'] in existing:
+            errors.append({'row': index, 'username': data['username'], 'error': USERNAME_TAKEN})
+            continue
+        existing.add(data['username'])
+        accepted.append((index, data))
+    if not accepted:
+        return 0
+
+    # Hashing dominates; the rows are inserted only once every hash is ready
+    passwords = [data.get('password') for _, data in accepted]
+    to_hash = [password for password in passwords if password is not None]
+    hashes = iter(hash_passwords(to_hash))
+    now = timezone.now()
+    users = [
+        User(
+            username=data['username'],
+            email=data.get('email', ''),
+            password=next(hashes) if password is not None else make_password(None),
+            date_joined=now,
+        )
+        for (index, data), password in zip(accepted, passwords)
+    ]
+
+    while True:
+        try:
+            _insert_chunk(users, [data for _, data in accepted], now)
+            return len(users)
+        except IntegrityError:
+            # A concurrent call created some of the usernames after the check above
+            taken = set(User.objects.filter(username__in=[user.username for user in users]).values_list('username', flat=True))
+            if not taken:
+                raise
+            remaining = []
+            for (index, data), user in zip(accepted, users):
+                if user.username in taken:
+                    errors.append({'row': index, 'username': user.username, 'error': USERNAME_TAKEN})
+                else:
+                    remaining.append(((index, data), user))
+            if not remaining:
+                return 0
+            accepted, users = (list(items) for items in zip(*remaining))
+            for user in users:
+                user.pk = None
+
+
+def _insert_chunk(users, rows, now):
+    with transaction.atomic():
+        User.objects.bulk_create(users)
+        user_times = [
+            UserTime(
+                user=user,
+                remaining_time=timedelta(minutes=data['minutes']),
+                version=1,
+                updated_at=now,
+            )
+            for user, data in zip(users, rows)
+        ]
+        UserTime.objects.bulk_create(user_times)
+        for kind, kind_user_times in (
+            (LedgerEntry.Kind.PURCHASE, [user_time for user_time in user_times if user_time.remaining_time]),
+            (None, [user_time for user_time in user_times if not user_time.remaining_time]),
+        ):
+            if kind_user_times:
+                balance_changed.send(sender=UserTime, user_times=kind_user_times, kind=kind)
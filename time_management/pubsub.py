@@ -0,0 +1,136 @@
+"""
+Publish/subscribe fan-out of balance changes to connected clients.
+
+Messages are keyed by user id. The default ``InProcessBroker`` only reaches
+subscribers in the same process; set ``TIME_PUBSUB['BACKEND']`` to
+``time_management.pubsub.RedisBroker`` (and ``OPTIONS['url']``) when several
+processes serve the streaming endpoint or ``runexpiryscheduler`` runs, since
+the expiries it makes are published from its own process. Both refuse to
+start with a process-local broker (see deployment.py).
+"""
+import asyncio
+import json
+import logging
+import threading
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'BACKEND': 'time_management.pubsub.InProcessBroker',
+    'OPTIONS': {},
+}
+
+
+class InProcessBroker:
+    """
+    Delivers messages to asyncio queues registered by subscribers.
+
+    ``publish`` may be called from any thread; delivery is handed to each
+    subscriber's event loop. Only the newest message matters to a client,
+    so a slow subscriber's queue keeps just the latest one.
+    """
+
+    process_local = True
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id):
+        queue = asyncio.Queue(maxsize=1)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add((loop, queue))
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        with self._lock:
+            subscribers = self._subscribers.get(user_id, set())
+            subscribers.difference_update({entry for entry in subscribers if entry[1] is queue})
+            if not subscribers:
+                self._subscribers.pop(user_id, None)
+
+    def publish_many(self, messages):
+        """Publish ``(user_id, message)`` pairs."""
+        for user_id, message in messages:
+            self._deliver(user_id, message)
+
+    def _deliver(self, user_id, message):
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(_put_latest, queue, message)
+            except RuntimeError:
+                # The subscriber's loop has closed
+                self.unsubscribe(user_id, queue)
+
+
+def _put_latest(queue, message):
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(message)
+
+
+class RedisBroker(InProcessBroker):
+    """
+    Fans messages out across processes through Redis pub/sub.
+
+    Each process runs one listener task that forwards messages to its local
+    subscribers, so Redis sees one connection per process, not per client.
+    """
+
+    CHANNEL_PREFIX = 'time_management:balance:'
+    process_local = False
+
+    def __init__(self, url='redis://localhost:6379/0'):
+        super().__init__()
+        try:
+            import redis
+        except ImportError as e:
+            raise ImproperlyConfigured("RedisBroker requires the 'redis' package.") from e
+        self._url = url
+        self._client = redis.Redis.from_url(url)
+        self._listener = None
+
+    def subscribe(self, user_id):
+        queue = super().subscribe(user_id)
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.get_running_loop().create_task(self._listen())
+        return queue
+
+    def publish_many(self, messages):
+        pipeline = self._client.pipeline(transaction=False)
+        for user_id, message in messages:
+            pipeline.publish(f"{self.CHANNEL_PREFIX}{user_id}", json.dumps(message))
+        pipeline.execute()
+
+    async def _listen(self):
+        import redis.asyncio
+
+        client = redis.asyncio.Redis.from_url(self._url)
+        async with client.pubsub() as pubsub:
+            await pubsub.psubscribe(f"{self.CHANNEL_PREFIX}*")
+            async for item in pubsub.listen():
+                if item['type'] != 'pmessage':
+                    continue
+                user_id = int(item['channel'][len(self.CHANNEL_PREFIX):])
+                self._deliver(user_id, json.loads(item['data']))
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    """Return the process-wide broker configured by ``TIME_PUBSUB``."""
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                config = {**DEFAULTS, **getattr(settings, 'TIME_PUBSUB', {})}
+                _broker = import_string(config['BACKEND'])(**config['OPTIONS'])
+    return _broker
@@ -0,0 +1,67 @@
+"""
+Fast JSON encoding for the API.
+
+``FastJSONRenderer`` and ``FastJSONParser`` replace DRF's JSON renderer and
+parser (see ``REST_FRAMEWORK`` in settings.py), and ``FastJsonResponse``
+replaces Django's ``JsonResponse`` in the async views. They use ``orjson``
+when it is installed and fall back to the standard library otherwise. The
+output is the same compact JSON either way: values orjson does not encode
+natively (dates, durations, decimals, lazy strings) go through DRF's encoder.
+"""
+import json
+from django.http import HttpResponse
+from rest_framework import renderers, parsers
+from rest_framework.exceptions import ParseError
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_encoder = JSONEncoder()
+
+if orjson is not None:
+    # DRF trims datetimes to milliseconds and writes UTC as 'Z'; let its encoder do that.
+    # Keys need not be strings: errors of list fields are keyed by item index.
+    _OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def dumps(data):
+        """Encode ``data`` as compact JSON bytes."""
+        return orjson.dumps(data, default=_encoder.default, option=_OPTIONS)
+
+    loads = orjson.loads
+else:
+    def dumps(data):
+        """Encode ``data`` as compact JSON bytes."""
+        return json.dumps(data, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':')).encode()
+
+    loads = json.loads
+
+
+class FastJSONRenderer(renderers.JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        # Indented output (``Accept: application/json; indent=4``) is for humans; leave it to DRF
+        if self.get_indent(accepted_media_type or '', renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        return dumps(data)
+
+
+class FastJSONParser(parsers.JSONParser):
+    renderer_class = FastJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return loads(stream.read())
+        except ValueError as exc:
+            raise ParseError(f'JSON parse error - {exc}')
+
+
+class FastJsonResponse(HttpResponse):
+    """``JsonResponse`` encoded with ``dumps``."""
+
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(content=dumps(data), **kwargs)
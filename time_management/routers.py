@@ -0,0 +1,112 @@
+"""
+Read-replica routing.
+
+``ReplicaRouter`` sends reads of the balance, ledger and user tables to one
+of the ``REPLICA_DATABASES`` and everything else to ``default``. Reads stay
+on the primary when they could miss a recent write:
+
+* inside a transaction on the primary;
+* for ``REPLICA_STICKY_SECONDS`` after this thread or task was routed a write;
+* for requests from a client that sent a POST, PUT, PATCH or DELETE within
+  that window, which ``PrimaryPinMiddleware`` tracks with a cookie.
+
+Replicas are configured from ``DATABASE_REPLICA_URLS`` (see settings.py).
+"""
+import random
+import time
+from contextvars import ContextVar
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+PIN_COOKIE = 'primary_pin'
+
+# Reads of these models may be served by a replica (app_label, model_name)
+REPLICA_MODELS = {
+    ('auth', 'user'),
+    ('time_management', 'usertime'),
+    ('time_management', 'ledgerentry'),
+    ('time_management', 'userusage'),
+    ('time_management', 'dailyusage'),
+}
+
+# Monotonic time until which reads go to the primary
+_primary_until = ContextVar('primary_until', default=0.0)
+
+
+def _sticky_seconds():
+    return getattr(settings, 'REPLICA_STICKY_SECONDS', 5)
+
+
+def pin_primary(seconds=None):
+    """Send this thread's or task's reads to the primary for ``seconds`` (default ``REPLICA_STICKY_SECONDS``)."""
+    until = time.monotonic() + (_sticky_seconds() if seconds is None else seconds)
+    _primary_until.set(max(_primary_until.get(), until))
+
+
+def primary_pinned():
+    return time.monotonic() < _primary_until.get()
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        replicas = getattr(settings, 'REPLICA_DATABASES', [])
+        if (
+            not replicas
+            or (model._meta.app_label, model._meta.model_name) not in REPLICA_MODELS
+            or primary_pinned()
+            or connections['default'].in_atomic_block
+        ):
+            return 'default'
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        pin_primary()
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
+
+
+class PrimaryPinMiddleware:
+    """
+    Keep a client's reads on the primary for ``REPLICA_STICKY_SECONDS`` after a writing request.
+
+    Removes itself when no ``REPLICA_DATABASES`` are configured.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'REPLICA_DATABASES', []):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        self.process_request(request)
+        return self.process_response(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        self.process_request(request)
+        return self.process_response(request, await self.get_response(request))
+
+    def process_request(self, request):
+        _primary_until.set(0.0)
+        if PIN_COOKIE in request.COOKIES:
+            pin_primary()
+
+    def process_response(self, request, response):
+        # Only writing requests push the window forward; pinned reads leave it to expire
+        if request.method not in ('GET', 'HEAD', 'OPTIONS', 'TRACE'):
+            response.set_cookie(PIN_COOKIE, '1', max_age=_sticky_seconds(), httponly=True, samesite='Lax')
+        return response
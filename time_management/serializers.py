@@ -1,6 +1,11 @@
 from rest_framework import serializers
+from django.conf import settings
 from django.contrib.auth.models import User
-from .models import UserTime
+from django.db import transaction
+from django.utils.duration import duration_string
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from .models import DailyUsage
+from .tokens import ClaimsRefreshToken
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -9,12 +14,66 @@ class UserSerializer(serializers.ModelSerializer):
         extra_kwargs = {'password': {'write_only': True}}
 
     def create(self, validated_data):
-        user = User.objects.create_user(**validated_data)
+        # The balance row is created by a post_save signal; keep both inserts in one transaction
+        with transaction.atomic():
+            user = User.objects.create_user(**validated_data)
         return user
 
-class UserTimeSerializer(serializers.ModelSerializer):
-    user = serializers.StringRelatedField()  # Display username instead of user ID
+class ClaimsTokenObtainPairSerializer(TokenObtainPairSerializer):
+    token_class = ClaimsRefreshToken
 
+class ClaimsTokenRefreshSerializer(TokenRefreshSerializer):
+    token_class = ClaimsRefreshToken  # Checks the blacklist through the in-process filter
+
+# Bounds of balance changes sent by clients: a year of time, far beyond any
+# real purchase or balance, keeps typos out and timedelta arithmetic in range.
+MAX_MINUTES = 366 * 24 * 60
+MAX_SECONDS = MAX_MINUTES * 60
+
+def remaining_seconds_field(remaining):
+    """``{'remaining_seconds': ...}`` when ``TIME_REMAINING_SECONDS`` is on, else nothing."""
+    if getattr(settings, 'TIME_REMAINING_SECONDS', False):
+        return {'remaining_seconds': remaining.total_seconds()}
+    return {}
+
+class UserTimeSerializer(serializers.BaseSerializer):
+    """
+    Read-only ``{'user': <username>, 'remaining_time': <duration>}`` built
+    directly, without the per-field machinery of a ModelSerializer. The
+    balance is live while a session runs.
+    """
+
+    def to_representation(self, instance):
+        remaining = instance.current_remaining_time
+        return {
+            'user': instance.user.username,
+            'remaining_time': duration_string(remaining),
+            **remaining_seconds_field(remaining),
+        }
+
+class BulkTimeItemSerializer(serializers.Serializer):
+    username = serializers.CharField()
+    remaining_time = serializers.IntegerField(required=False, min_value=0, max_value=MAX_SECONDS)  # Seconds
+    add_minutes = serializers.IntegerField(required=False, min_value=-MAX_MINUTES, max_value=MAX_MINUTES)
+
+    def validate(self, attrs):
+        if ('remaining_time' in attrs) == ('add_minutes' in attrs):
+            raise serializers.ValidationError("Exactly one of 'remaining_time' or 'add_minutes' is required.")
+        return attrs
+
+class ConsumptionReportSerializer(serializers.Serializer):
+    device_id = serializers.CharField(max_length=64)
+    # Increases with every report from the device; bounded by the BigIntegerField it is stored in
+    sequence = serializers.IntegerField(min_value=0, max_value=2**63 - 1)
+    consumed_seconds = serializers.IntegerField(min_value=0, max_value=24 * 60 * 60)  # At most a day per report
+
+class ProvisionUserSerializer(serializers.Serializer):
+    username = serializers.CharField(max_length=150, validators=User._meta.get_field('username').validators)
+    password = serializers.CharField(required=False)  # Unusable password when missing
+    email = serializers.EmailField(required=False)
+    minutes = serializers.IntegerField(required=False, default=0, min_value=0)  # Starting balance
+
+class DailyUsageSerializer(serializers.ModelSerializer):
     class Meta:
-        model = UserTime
-        fields = ['user', 'remaining_time']
+        model = DailyUsage
+        fields = ['day', 'purchased', 'consumed', 'corrected', 'entries']
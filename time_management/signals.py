@@ -1,13 +1,54 @@
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.contrib.auth.models import User
-from .models import UserTime
+from .cache import forget_balance, store_balances
+from .ledger import record_entries
+from .models import LedgerEntry, UserTime, balance_changed
+from .pubsub import get_broker
 
+# Only creation needs a balance row. Other User saves (last_login updates,
+# admin edits, password changes) must not touch UserTime.
 @receiver(post_save, sender=User)
-def create_user_time(sender, instance, created, **kwargs):
-    if created:
+def create_user_time(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
         UserTime.objects.create(user=instance)
 
-@receiver(post_save, sender=User)
-def save_user_time(sender, instance, **kwargs):
-    instance.time.save()
+# Full saves (admin edits, new balance rows) count as balance changes too.
+# An empty opening balance is what the rollups assume before a user's first
+# entry, so it is not recorded.
+@receiver(post_save, sender=UserTime)
+def user_time_saved(sender, instance, created, raw=False, **kwargs):
+    if not raw:
+        kind = LedgerEntry.Kind.CORRECTION
+        if created:
+            kind = LedgerEntry.Kind.OPENING if instance.remaining_time else None
+        balance_changed.send(sender=sender, user_times=[instance], kind=kind)
+
+# Append the change to the usage ledger in the mutating transaction, unless
+# the mutating statement already did.
+@receiver(balance_changed)
+def record_ledger_entries(sender, user_times, kind=None, ledger_recorded=False, **kwargs):
+    if kind is not None and not ledger_recorded:
+        record_entries(user_times, kind)
+
+# Push the new balance to the user's connected PCs once it is committed.
+@receiver(balance_changed)
+def publish_balance(sender, user_times, **kwargs):
+    messages = [
+        (user_time.user_id, {
+            'remaining_time': user_time.remaining_time.total_seconds(),
+            'session_started_at': user_time.session_started_at.timestamp() if user_time.session_started_at else None,
+        })
+        for user_time in user_times
+    ]
+    transaction.on_commit(lambda: get_broker().publish_many(messages))
+
+# Write committed balances through to the read cache.
+@receiver(balance_changed)
+def cache_balance(sender, user_times, **kwargs):
+    transaction.on_commit(lambda: store_balances(user_times))
+
+@receiver(post_delete, sender=UserTime)
+def forget_cached_balance(sender, instance, **kwargs):
+    transaction.on_commit(lambda: forget_balance(instance.user_id))
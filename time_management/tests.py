@@ -1,13 +1,49 @@
+import asyncio
+import gzip
+import io
+import json
+import logging
 import pytest
+import threading
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.test import AsyncClient, Client
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.duration import duration_string
 from django.contrib.auth.models import User
 from rest_framework import status
 from rest_framework.test import APIClient
-from time_management.models import UserTime
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.tokens import AccessToken
+from pc_usage_manager.database import database_config
+from time_management import async_views, buffer, expiry, export, logs, metrics, pubsub, routers, throttling, tokens
+from time_management.deployment import process_local_backends
+from time_management.pubsub import InProcessBroker, get_broker
+from time_management.routers import ReplicaRouter
+from time_management.authentication import StatelessJWTAuthentication
+from time_management.expiry import ExpiryScheduler
+from time_management.ledger import rebuild_rollups, roll_up
+from time_management.models import DailyUsage, LedgerEntry, UserTime, UserUsage, session_expired
+from time_management.tokens import ClaimsRefreshToken, prune_expired_tokens
 
 DEFAULT_USERNAME = "testuser"
 DEFAULT_EMAIL = "user@example.com"
 DEFAULT_PASSWORD = "password123"
+# Balance mutations insert their ledger entry in the same statement on PostgreSQL only
+LEDGERED_MUTATION_QUERIES = 1 if connection.vendor == 'postgresql' else 2
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    """Fixture clearing the local-memory caches and throttle buckets, which outlive each test's database transaction."""
+    yield
+    for cache in caches.all():
+        cache.clear()
+    throttling.get_bucket_store().clear()
+
 
 @pytest.fixture
 def api_client():
@@ -207,3 +243,1280 @@ def test_logout_access_denied_after_logout(api_client, user):
     response = api_client.patch(add_user_minutes_url, add_minutes_data, format='json', **logout_headers)
     assert response.status_code == status.HTTP_401_UNAUTHORIZED
     assert response.data.get("detail") == "Authentication credentials were not provided."
+
+
+@pytest.mark.django_db
+def test_balance_mutations_by_username_and_user_id(user):
+    """Test the add/consume/set balance API keyed by username or user id."""
+    user_time = UserTime.objects.add(timedelta(minutes=10), username=user.username)
+    assert user_time.remaining_time == timedelta(minutes=10)
+    assert str(user_time.user) == user.username
+
+    user_time = UserTime.objects.consume(timedelta(minutes=4), user_id=user.id)
+    assert user_time.remaining_time == timedelta(minutes=6)
+
+    user_time = UserTime.objects.consume(timedelta(hours=1), username=user.username)
+    assert user_time.remaining_time == timedelta(0)
+
+    user_time = UserTime.objects.set(timedelta(seconds=90), user_id=user.id)
+    assert user_time.remaining_time == timedelta(seconds=90)
+    assert UserTime.objects.get(user=user).remaining_time == timedelta(seconds=90)
+
+
+@pytest.mark.django_db
+def test_balance_mutation_is_a_single_query(user, django_assert_num_queries):
+    """Test that a balance mutation and its ledger entry cost one round trip (plus the ledger insert off PostgreSQL)."""
+    with django_assert_num_queries(LEDGERED_MUTATION_QUERIES):
+        user_time = UserTime.objects.add(timedelta(minutes=5), username=user.username)
+        assert user_time.user.username == user.username
+
+
+@pytest.mark.django_db
+def test_balance_mutation_unknown_user():
+    """Test that mutating a missing balance returns None."""
+    assert UserTime.objects.add(timedelta(minutes=5), username="non_existing") is None
+
+
+@pytest.mark.django_db
+def test_balance_mutation_fallback_without_returning(user, monkeypatch):
+    """Test the locked read-back path used by backends without UPDATE ... RETURNING."""
+    monkeypatch.setattr(UserTime.objects, "_supports_update_returning", lambda connection: False)
+    user_time = UserTime.objects.add(timedelta(minutes=3), username=user.username)
+    assert user_time.remaining_time == timedelta(minutes=3)
+    user_time = UserTime.objects.consume(timedelta(minutes=5), user_id=user.id)
+    assert user_time.remaining_time == timedelta(0)
+
+
+@pytest.mark.django_db
+def test_add_time_unknown_user(api_client, user):
+    """Test adding time to a user that does not exist."""
+    access_token, refresh_token = obtain_tokens(api_client, DEFAULT_USERNAME, DEFAULT_PASSWORD)
+    url = reverse('add-user-minutes', kwargs={"username": "non_existing"})
+    headers = {"HTTP_AUTHORIZATION": f"Bearer {access_token}"}
+    response = api_client.patch(url, {"add_minutes": 15}, format='json', **headers)
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.django_db
+def test_session_countdown_is_computed_lazily(user):
+    """Test that a running session derives the balance without writing it."""
+    started = timezone.now()
+    UserTime.objects.set(timedelta(minutes=30), user_id=user.id)
+    user_time = UserTime.objects.start_session(user_id=user.id, now=started)
+    assert user_time.session_started_at == started
+    assert user_time.remaining_time_at(started + timedelta(minutes=10)) == timedelta(minutes=20)
+    assert user_time.remaining_time_at(started + timedelta(hours=1)) == timedelta(0)
+
+    # Starting again keeps the original start time
+    user_time = UserTime.objects.start_session(username=user.username, now=started + timedelta(minutes=5))
+    assert user_time.session_started_at == started
+
+    # A top-up during the session is kept when it stops
+    UserTime.objects.add(timedelta(minutes=15), user_id=user.id)
+    user_time = UserTime.objects.stop_session(username=user.username, now=started + timedelta(minutes=10))
+    assert user_time.session_started_at is None
+    assert user_time.remaining_time == timedelta(minutes=35)
+
+    # Stopping a stopped session changes nothing
+    user_time = UserTime.objects.stop_session(user_id=user.id, now=started + timedelta(minutes=20))
+    assert user_time.remaining_time == timedelta(minutes=35)
+
+
+@pytest.mark.django_db
+def test_session_set_reanchors_running_session(user):
+    """Test that overwriting the balance restarts the countdown from the new value."""
+    started = timezone.now() - timedelta(minutes=10)
+    UserTime.objects.start_session(user_id=user.id, now=started)
+    now = started + timedelta(minutes=10)
+    user_time = UserTime.objects.set(timedelta(minutes=5), user_id=user.id, now=now)
+    assert user_time.session_started_at == now
+    assert user_time.remaining_time_at(now + timedelta(minutes=2)) == timedelta(minutes=3)
+
+
+@pytest.mark.django_db
+def test_session_start_stop_endpoints(api_client, user):
+    """Test the session start/stop endpoints."""
+    UserTime.objects.set(timedelta(minutes=30), user_id=user.id)
+    access_token, refresh_token = obtain_tokens(api_client, DEFAULT_USERNAME, DEFAULT_PASSWORD)
+    headers = {"HTTP_AUTHORIZATION": f"Bearer {access_token}"}
+
+    response = api_client.post(reverse('start-user-session', kwargs={"username": user.username}), **headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.data["user"] == user.username
+    assert UserTime.objects.get(user=user).session_started_at is not None
+
+    response = api_client.post(reverse('stop-user-session', kwargs={"username": user.username}), **headers)
+    assert response.status_code == status.HTTP_200_OK
+    user_time = UserTime.objects.get(user=user)
+    assert user_time.session_started_at is None
+    assert user_time.remaining_time <= timedelta(minutes=30)
+
+    response = api_client.post(reverse('stop-user-session', kwargs={"username": "non_existing"}), **headers)
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.django_db
+def test_bulk_apply_folds_changes_per_user(user):
+    """Test that bulk changes for one user are applied in order."""
+    other = User.objects.create_user(username="otheruser", password=DEFAULT_PASSWORD)
+    UserTime.objects.set(timedelta(minutes=10), user_id=other.id)
+    user_times = UserTime.objects.bulk_apply([
+        (user.username, None, timedelta(minutes=5)),
+        (user.username, timedelta(minutes=20), timedelta(0)),
+        (user.username, None, timedelta(minutes=1)),
+        (other.username, None, timedelta(minutes=-4)),
+        ("non_existing", None, timedelta(minutes=1)),
+    ])
+    assert set(user_times) == {user.username, other.username}
+    assert user_times[user.username].remaining_time == timedelta(minutes=21)
+    assert user_times[other.username].remaining_time == timedelta(minutes=6)
+    assert UserTime.objects.get(user=user).remaining_time == timedelta(minutes=21)
+
+
+@pytest.mark.django_db
+def test_bulk_sync_endpoint(api_client, user, django_assert_max_num_queries):
+    """Test the bulk sync endpoint with a constant number of queries."""
+    access_token, refresh_token = obtain_tokens(api_client, DEFAULT_USERNAME, DEFAULT_PASSWORD)
+    headers = {"HTTP_AUTHORIZATION": f"Bearer {access_token}"}
+    usernames = [f"pc{i}" for i in range(20)]
+    for username in usernames:
+        User.objects.create_user(username=username)
+
+    items = [{"username": username, "add_minutes": 15} for username in usernames]
+    items += [
+        {"username": DEFAULT_USERNAME, "remaining_time": 2700},
+        {"username": "non_existing", "add_minutes": 5},
+        {"username": DEFAULT_USERNAME},
+    ]
+    with django_assert_max_num_queries(8):
+        response = api_client.post(reverse('bulk-sync-user-time'), {"items": items}, format='json', **headers)
+    assert response.status_code == status.HTTP_200_OK
+
+    results = response.data["results"]
+    assert len(results) == len(items)
+    assert all(result["success"] for result in results[:21])
+    assert results[0] == {"success": True, "user": "pc0", "remaining_time": "00:15:00"}
+    assert results[20]["remaining_time"] == "00:45:00"
+    assert results[21] == {"username": "non_existing", "success": False, "error": "User not found."}
+    assert results[22]["success"] is False
+    assert UserTime.objects.get(user__username="pc7").remaining_time == timedelta(minutes=15)
+
+
+@pytest.mark.django_db
+def test_bulk_sync_endpoint_requires_list(api_client, user):
+    """Test that the bulk sync endpoint rejects a payload without items and out-of-range items."""
+    access_token, refresh_token = obtain_tokens(api_client, DEFAULT_USERNAME, DEFAULT_PASSWORD)
+    headers = {"HTTP_AUTHORIZATION": f"Bearer {access_token}"}
+    response = api_client.post(reverse('bulk-sync-user-time'), {"username": DEFAULT_USERNAME}, format='json', **headers)
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    # Values that would overflow timedelta are item errors, not a server error
+    items = [{"username": DEFAULT_USERNAME, "add_minutes": 10**12}, {"username": DEFAULT_USERNAME, "remaining_time": 10**15}]
+    response = api_client.post(reverse('bulk-sync-user-time'), {"items": items}, format='json', **headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert [result["success"] for result in response.data["results"]] == [False, False]
+    assert set(response.data["results"][0]["error"]) == {"add_minutes"}
+    assert UserTime.objects.get(user=user).remaining_time == timedelta(0)
+
+
+@pytest.fixture
+def write_behind_buffer(monkeypatch, settings):
+    """Fixture enabling the write-behind buffer without its background flusher."""
+    settings.TIME_SYNC_WRITE_BEHIND = {"ENABLED": True}
+    time_buffer = buffer.WriteBehindBuffer(buffer.MemoryStore(), flush_interval=60)
+    monkeypatch.setattr(buffer, "_buffer", time_buffer)
+    return time_buffer
+
+
+@pytest.mark.django_db
+def test_write_behind_coalesces_syncs(api_client, user, write_behind_buffer):
+    """Test that buffered syncs are served from the buffer and flushed in bulk."""
+    access_token, refresh_token = obtain_tokens(api_client, DEFAULT_USERNAME, DEFAULT_PASSWORD)
+    headers = {"HTTP_AUTHORIZATION": f"Bearer {access_token}"}
+    url = reverse('sync-user-remaining-time', kwargs={"username": user.username})
+    for seconds in (2700, 2690, 2680):
+        response = api_client.patch(url, {"remaining_time": seconds}, format='json', **headers)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data == {"user": user.username, "remaining_time": duration_string(timedelta(seconds=seconds))}
+
+    assert UserTime.objects.get(user=user).remaining_time == timedelta(0)
+    assert write_behind_buffer.get(user.username) == timedelta(seconds=2680)
+
+    assert write_behind_buffer.flush() == 1
+    assert write_behind_buffer.get(user.username) is None
+    assert UserTime.objects.get(user=user).remaining_time == timedelta(seconds=2680)
+
+    # Unknown users are rejected before anything is buffered, by both endpoints
+    for name in ('sync-user-remaining-time', 'async-sync-user-remaining-time'):
+        url = reverse(name, kwargs={"username": "non_existing"})
+        response = api_client.patch(url, {"remaining_time": 60}, format='json', **headers)
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+    assert write_behind_buffer.get("non_existing") is None
+
+
+@pytest.mark.django_db
+def test_write_behind_flushes_before_top_up(api_client, user, write_behind_buffer):
+    """Test that a top-up is applied on top of a pending buffered sync."""
+    access_token, refresh_token = obtain_tokens(api_client, DEFAULT_USERNAME, DEFAULT_PASSWORD)
+    headers = {"HTTP_AUTHORIZATION": f"Bearer {access_token}"}
+    write_behind_buffer.put(user.username, timedelta(minutes=10))
+
+    url = reverse('add-user-minutes', kwargs={"username": user.username})
+    response = api_client.patch(url, {"add_minutes": 5}, format='json', **headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.data["remaining_time"] == "00:15:00"
+    assert write_behind_buffer.flush() == 0
+    assert UserTime.objects.get(user=user).remaining_time == timedelta(minutes=15)
+
+
+def test_cache_store_last_writer_wins():
+    """Test the cache-backed store keeps only the newest value per user."""
+    store = buffer.CacheStore()
+    store.put("pc1", timedelta(seconds=30))
+    store.put("pc1", timedelta(seconds=20))
+    store.put("pc2", timedelta(seconds=10))
+    assert store.get("pc1") == timedelta(seconds=20)
+    assert store.pop("pc2") == timedelta(seconds=10)
+    assert store.drain() == {"pc1": timedelta(seconds=20)}
+    assert store.get("pc1") is None
+
+
+@pytest.mark.django_db
+def test_user_save_does_not_touch_user_time(user, django_assert_num_queries):
+    """Test that saving an existing user does not rewrite its balance row."""
+    user.last_login = timezone.now()
+    with django_assert_num_queries(1):
+        user.save(update_fields=["last_login"])
+    with django_assert_num_queries(1):
+        user.set_password("new-password-456")
+        user.save()
+
+
+@pytest.mark.django_db
+def test_registration_query_count(api_client, django_assert_num_queries):
+    """Test that registration inserts the user and its balance in one transaction."""
+    data = {"username": DEFAULT_USERNAME, "email": DEFAULT_EMAIL, "password": DEFAULT_PASSWORD}
+    # Username uniqueness check, savepoint, user insert, balance insert, release
+    with django_assert_num_queries(5):
+        response = api_client.post(reverse('register'), data)
+    assert response.status_code == status.HTTP_201_CREATED
+    assert UserTime.objects.filter(user__username=DEFAULT_USERNAME).exists()
+
+
+@pytest.mark.django_db
+def test_login_query_count(api_client, user, django_assert_num_queries):
+    """Test that login loads the user with the balance, records the token and never rewrites the balance."""
+    data = {"username": DEFAULT_USERNAME, "password": DEFAULT_PASSWORD}
+    with django_assert_num_queries(2) as captured:
+        response = api_client.post(reverse("login"), data, format="json")
+    assert response.status_code == status.HTTP_200_OK
+    assert not any(
+        query["sql"].startswith("UPDATE") and "time_management_usertime" in query["sql"]
+        for query in captured.captured_queries
+    )
+
+
+@pytest.mark.django_db
+def test_login_upgrades_password_hash_in_one_transaction(api_client, user, settings, django_assert_num_queries):
+    """Test that a hash made at another cost is upgraded by the next login and that token recording can be turned off."""
+    settings.PASSWORD_HASH_ITERATIONS = 1000
+    data = {"username": DEFAULT_USERNAME, "password": DEFAULT_PASSWORD}
+    with django_assert_num_queries(5):  # Read, savepoint, password update, token insert, release
+        response = api_client.post(reverse("login"), data, format="json")
+    assert response.status_code == status.HTTP_200_OK
+    user.refresh_from_db()
+    assert user.password.startswith("pbkdf2_sha256$1000$")
+    assert user.check_password(DEFAULT_PASSWORD)
+
+    settings.TIME_LOGIN_RECORD_TOKENS = False
+    with django_assert_num_queries(1):
+        response = api_client.post(reverse("login"), data, format="json")
+    assert response.status_code == status.HTTP_200_OK
+    assert OutstandingToken.objects.filter(user=user).count() == 1
+
+
+@pytest.mark.django_db
+def test_login_creates_missing_balance_lazily(api_client, user):
+    """Test that a user without a balance row gets one on login."""
+    UserTime.objects.filter(user=user).delete()
+    response = api_client.post(reverse("login"), {"username": DEFAULT_USERNAME, "password": DEFAULT_PASSWORD}, format="json")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.data["remaining_time"] == "0:00:00"
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_login_and_time_endpoints(client, user):
+    """Test the async login, time and logout endpoints."""
+    data = {"username": DEFAULT_USERNAME, "password": DEFAULT_PASSWORD}
+    response = client.post(reverse("async-login"), data, content_type="application/json")
+    assert response.status_code == status.HTTP_200_OK
+    body = response.json()
+    assert body["username"] == DEFAULT_USERNAME
+    headers = {"HTTP_AUTHORIZATION": f"Bearer {body['access']}"}
+
+    url = reverse("async-add-user-minutes", kwargs={"username": user.username})
+    response = client.patch(url, {"add_minutes": 15}, content_type="application/json", **headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {"user": user.username, "remaining_time": "00:15:00"}
+
+    url = reverse("async-sync-user-remaining-time", kwargs={"username": user.username})
+    response = client.patch(url, {"remaining_time": 2700}, content_type="application/json", **headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert UserTime.objects.get(user=user).remaining_time == timedelta(seconds=2700)
+
+    response = client.post(reverse("async-logout"), {"refresh": body["refresh"]}, content_type="application/json", **headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["success"] is True
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_time_endpoints_reject_invalid_bodies(api_client, client, user, caplog):
+    """Test that non-object bodies and non-integer or out-of-range values get 400, and unknown users log no success."""
+    access_token, refresh_token = obtain_tokens(api_client, DEFAULT_USERNAME, DEFAULT_PASSWORD)
+    headers = {"HTTP_AUTHORIZATION": f"Bearer {access_token}"}
+    add_url = reverse("async-add-user-minutes", kwargs={"username": user.username})
+    sync_url = reverse("async-sync-user-remaining-time", kwargs={"username": user.username})
+    for url, field in ((add_url, "add_minutes"), (sync_url, "remaining_time")):
+        for body in (42, [field], {field: "abc"}, {field: 10**12}, {field: True}):
+            response = client.patch(url, body, content_type="application/json", **headers)
+            assert response.status_code == status.HTTP_400_BAD_REQUEST
+    response = client.patch(sync_url, {"remaining_time": -1}, content_type="application/json", **headers)
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert UserTime.objects.get(user=user).remaining_time == timedelta(0)
+
+    caplog.clear()
+    for name, body in (
+        ("async-add-user-minutes", {"add_minutes": 5}), ("async-sync-user-remaining-time", {"remaining_time": 60}),
+    ):
+        url = reverse(name, kwargs={"username": "nobody"})
+        response = client.patch(url, body, content_type="application/json", **headers)
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+    assert not [record for record in caplog.records if record.getMessage() in ("time_added", "time_synced")]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_login_failure(client, user):
+    """Test async login with invalid credentials."""
+    data = {"username": DEFAULT_USERNAME, "password": "wrongpassword"}
+    response = client.post(reverse("async-login"), data, content_type="application/json")
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+    assert response.json()["error"] == "Invalid username or password."
+
+
+@pytest.mark.django_db
+def test_async_time_endpoints_require_auth(client, user):
+    """Test that the async time endpoints reject unauthenticated and unknown requests."""
+    url = reverse("async-add-user-minutes", kwargs={"username": user.username})
+    response = client.patch(url, {"add_minutes": 15}, content_type="application/json")
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+    response = client.get(url)
+    assert response.status_code == status.HTTP_405_METHOD_NOT_ALLOWED
+
+
+@pytest.mark.django_db(transaction=True)
+def test_balance_stream_pushes_changes(user, settings):
+    """Test that the balance stream pushes top-ups and warns before expiry."""
+    settings.TIME_STREAM_EXPIRY_WARNING = 60
+
+    async def scenario():
+        events = async_views._balance_events(user.id, user.username)
+        first = await anext(events)
+        await UserTime.objects.aadd(timedelta(minutes=5), user_id=user.id)
+        second = await asyncio.wait_for(anext(events), 5)
+        # Five minutes left, so the warning is not due yet; a 30 second session is
+        await UserTime.objects.aset(timedelta(seconds=30), user_id=user.id)
+        await UserTime.objects.astart_session(user_id=user.id)
+        third = await asyncio.wait_for(anext(events), 5)
+        fourth = await asyncio.wait_for(anext(events), 5)
+        await events.aclose()
+        return first, second, third, fourth
+
+    first, second, third, fourth = asyncio.run(scenario())
+    assert first.startswith("event: balance\n")
+    assert '"remaining_time": "00:00:00"' in first
+    assert '"remaining_time": "00:05:00"' in second
+    assert '"session_active": true' in third
+    assert fourth.startswith("event: expiring\n")
+    assert not get_broker()._subscribers
+
+
+@pytest.mark.django_db(transaction=True)
+def test_balance_stream_closes_without_balance(user):
+    """Test that a stream whose balance row is gone ends with a final event."""
+    UserTime.objects.filter(user=user).delete()
+
+    async def scenario():
+        return [event async for event in async_views._balance_events(user.id, user.username)]
+
+    events = asyncio.run(scenario())
+    assert len(events) == 1 and events[0].startswith("event: closed\n")
+    assert '"reason": "balance_not_found"' in events[0]
+    assert not get_broker()._subscribers
+
+
+@pytest.mark.django_db
+def test_balance_stream_unknown_user(api_client, user):
+    """Test that streaming an unknown user's balance returns 404."""
+    access_token, refresh_token = obtain_tokens(api_client, DEFAULT_USERNAME, DEFAULT_PASSWORD)
+    url = reverse("async-stream-user-time", kwargs={"username": "non_existing"})
+    response = api_client.get(url, HTTP_AUTHORIZATION=f"Bearer {access_token}")
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.django_db
+def test_stateless_jwt_skips_user_lookup(api_client, user, django_assert_num_queries):
+    """Test that the time endpoints authenticate from token claims without a user query."""
+    access_token, refresh_token = obtain_tokens(api_client, DEFAULT_USERNAME, DEFAULT_PASSWORD)
+    headers = {"HTTP_AUTHORIZATION": f"Bearer {access_token}"}
+    url = reverse('add-user-minutes', kwargs={"username": user.username})
+    with django_assert_num_queries(LEDGERED_MUTATION_QUERIES):
+        response = api_client.patch(url, {"add_minutes": 15}, format='json', **headers)
+    assert response.status_code == status.HTTP_200_OK
+
+
+@pytest.mark.django_db
+def test_lazy_token_user_loads_user_on_demand(user, django_assert_num_queries):
+    """Test that token users answer claims without a query and load the row otherwise."""
+    token = ClaimsRefreshToken.for_user(user).access_token
+    token_user = StatelessJWTAuthentication().get_user(token)
+    with django_assert_num_queries(0):
+        assert token_user.id == str(user.id)
+        assert token_user.username == DEFAULT_USERNAME
+        assert token_user.is_staff is False
+    with django_assert_num_queries(1):
+        assert token_user.email == DEFAULT_EMAIL
+        assert token_user.date_joined == user.date_joined
+
+
+@pytest.mark.django_db
+def test_refreshed_access_token_keeps_claims(api_client, user):
+    """Test that access tokens minted on refresh still carry the username claim."""
+    access_token, refresh_token = obtain_tokens(api_client, DEFAULT_USERNAME, DEFAULT_PASSWORD)
+    access_token = refresh_access_token(api_client, refresh_token)
+    assert AccessToken(access_token)["username"] == DEFAULT_USERNAME
+
+
+@pytest.mark.django_db
+def test_prune_expired_tokens(api_client, user):
+    """Test that pruning removes only expired outstanding and blacklisted tokens."""
+    for _ in range(5):
+        ClaimsRefreshToken.for_user(user).blacklist()
+    live = ClaimsRefreshToken.for_user(user)
+    OutstandingToken.objects.exclude(jti=live["jti"]).update(expires_at=timezone.now() - timedelta(minutes=1))
+
+    assert prune_expired_tokens(batch_size=2) == 5
+    assert list(OutstandingToken.objects.values_list("jti", flat=True)) == [live["jti"]]
+    assert not BlacklistedToken.objects.exists()
+
+    call_command("prunetokens", stdout=io.StringIO())
+
+
+@pytest.mark.django_db
+def test_blacklist_filter_answers_refresh_checks(api_client, user, settings, monkeypatch, django_assert_num_queries):
+    """Test that the blacklist filter skips the blacklist query on refresh."""
+    settings.TOKEN_BLACKLIST_FILTER = {"ENABLED": True, "REBUILD_INTERVAL": 60}
+    monkeypatch.setattr(tokens, "_blacklist_filter", None)
+    access_token, refresh_token = obtain_tokens(api_client, DEFAULT_USERNAME, DEFAULT_PASSWORD)
+    tokens.get_blacklist_filter().rebuild()
+
+    with django_assert_num_queries(0):
+        ClaimsRefreshToken(refresh_token)
+
+    response = api_client.post(reverse('logout'), {"refresh": refresh_token}, format='json',
+                               HTTP_AUTHORIZATION=f"Bearer {access_token}")
+    assert response.status_code == status.HTTP_200_OK
+    with django_assert_num_queries(0):
+        assert refresh_access_token(api_client, refresh_token) is None
+
+
+@pytest.mark.django_db
+def test_metrics_endpoint_reports_requests(api_client, user, monkeypatch):
+    """Test that requests are recorded per view and exposed in Prometheus format."""
+    monkeypatch.setattr(metrics, "registry", metrics.MetricsRegistry())
+    access_token, refresh_token = obtain_tokens(api_client, DEFAULT_USERNAME, DEFAULT_PASSWORD)
+    url = reverse('add-user-minutes', kwargs={"username": user.username})
+    api_client.patch(url, {"add_minutes": 15}, format='json', HTTP_AUTHORIZATION=f"Bearer {access_token}")
+
+    response = api_client.get(reverse("metrics"))
+    assert response.status_code == status.HTTP_200_OK
+    body = response.content.decode()
+    labels = 'view="add-user-minutes",method="PATCH",status="200"'
+    assert f'http_request_duration_seconds_count{{{labels}}} 1' in body
+    assert f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} 1' in body
+    assert f'http_request_db_queries_total{{{labels}}} {LEDGERED_MUTATION_QUERIES}' in body
+    assert 'http_request_duration_seconds_count{view="login",method="POST",status="200"} 1' in body
+
+
+def test_metrics_fold_shards_of_finished_threads():
+    """Test that a thread per request does not leave a shard per thread behind."""
+    import threading
+    registry = metrics.MetricsRegistry()
+    for _ in range(50):
+        thread = threading.Thread(target=registry.record, args=("view", "GET", 200, 0.001, 1, 0.0, 10))
+        thread.start()
+        thread.join()
+    totals = registry.collect()
+    assert totals[("view", "GET", 200)][metrics._COUNT] == 50
+    assert len(registry._shards) <= 1
+
+
+@pytest.mark.django_db
+def test_slow_request_log_includes_sql(api_client, user, settings, caplog):
+    """Test that slow requests are logged with the SQL they executed."""
+    settings.METRICS_SLOW_REQUEST_THRESHOLD = 0
+    with caplog.at_level(logging.WARNING, logger="time_management.slow_requests"):
+        api_client.post(reverse("login"), {"username": DEFAULT_USERNAME, "password": DEFAULT_PASSWORD}, format="json")
+    assert "Slow request POST /api/login/ (login)" in caplog.text
+    assert "time_management_usertime" in caplog.text
+
+
+def test_metrics_token_required(client, settings):
+    """Test that /metrics requires the configured bearer token."""
+    settings.METRICS_TOKEN = "scrape-secret"
+    assert client.get(reverse("metrics")).status_code == status.HTTP_403_FORBIDDEN
+    assert client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer scrape-secret").status_code == status.HTTP_200_OK
+
+
+@pytest.mark.django_db
+def test_get_time_conditional_requests(api_client, user, django_assert_num_queries, django_capture_on_commit_callbacks):
+    """Test that balance reads are cached and revalidated with ETags."""
+    access_token, refresh_token = obtain_tokens(api_client, DEFAULT_USERNAME, DEFAULT_PASSWORD)
+    headers = {"HTTP_AUTHORIZATION": f"Bearer {access_token}"}
+    url = reverse('add-user-minutes', kwargs={"username": user.username})
+
+    response = api_client.get(url, **headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.data == {"user": user.username, "remaining_time": "00:00:00"}
+    etag = response["ETag"]
+    assert response["Last-Modified"]
+
+    with django_assert_num_queries(0):
+        response = api_client.get(url, HTTP_IF_NONE_MATCH=etag, **headers)
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+    # A top-up is written through on commit, so the next read sees it without a query
+    with django_capture_on_commit_callbacks(execute=True):
+        api_client.patch(url, {"add_minutes": 15}, format='json', **headers)
+    with django_assert_num_queries(0):
+        response = api_client.get(url, HTTP_IF_NONE_MATCH=etag, **headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.data["remaining_time"] == "00:15:00"
+    assert response["ETag"] != etag
+
+    # A running balance has no Last-Modified, so If-Modified-Since alone never gets a stale 304
+    last_modified = response["Last-Modified"]
+    with django_capture_on_commit_callbacks(execute=True):
+        api_client.post(reverse('start-user-session', kwargs={"username": user.username}), **headers)
+    response = api_client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified, **headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert "Last-Modified" not in response
+
+
+@pytest.mark.django_db
+def test_get_time_unknown_user(api_client, user):
+    """Test reading the balance of a user that does not exist."""
+    access_token, refresh_token = obtain_tokens(api_client, DEFAULT_USERNAME, DEFAULT_PASSWORD)
+    url = reverse('add-user-minutes', kwargs={"username": "non_existing"})
+    response = api_client.get(url, HTTP_AUTHORIZATION=f"Bearer {access_token}")
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.django_db
+def test_balance_version_bumped_by_every_write(user):
+    """Test that mutations, bulk changes and full saves all bump the balance version."""
+    version = UserTime.objects.get(user=user).version
+    assert UserTime.objects.add(timedelta(minutes=1), user_id=user.id).version == version + 1
+    UserTime.objects.bulk_apply([(user.username, None, timedelta(minutes=1))])
+    user_time = UserTime.objects.get(user=user)
+    assert user_time.version == version + 2
+    user_time.remaining_time = timedelta(minutes=5)
+    user_time.save(update_fields=["remaining_time"])
+    assert UserTime.objects.get(user=user).version == version + 3
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("returning", [True, False])
+def test_expires_at_tracks_every_mutation(user, monkeypatch, returning):
+    """Test that expires_at follows the running session through every kind of balance change."""
+    if not returning:
+        monkeypatch.setattr(UserTime.objects, "_supports_update_returning", lambda connection: False)
+    started = timezone.now().replace(microsecond=0)
+    assert UserTime.objects.set(timedelta(minutes=30), user_id=user.id).expires_at is None
+    user_time = UserTime.objects.start_session(user_id=user.id, now=started)
+    assert user_time.expires_at == started + timedelta(minutes=30)
+    user_time = UserTime.objects.add(timedelta(minutes=15), username=user.username)
+    assert user_time.expires_at == started + timedelta(minutes=45)
+    user_time = UserTime.objects.consume(timedelta(minutes=5), user_id=user.id)
+    assert user_time.expires_at == started + timedelta(minutes=40)
+    user_time = UserTime.objects.consume(timedelta(hours=2), user_id=user.id)
+    assert user_time.expires_at == started
+    now = started + timedelta(minutes=1)
+    user_time = UserTime.objects.set(timedelta(minutes=10), user_id=user.id, now=now)
+    assert user_time.expires_at == now + timedelta(minutes=10)
+    assert UserTime.objects.stop_session(user_id=user.id, now=now).expires_at is None
+
+
+@pytest.mark.django_db
+def test_expires_at_tracks_bulk_changes_and_saves(user):
+    """Test that bulk changes and full saves keep expires_at in step with the balance."""
+    now = timezone.now().replace(microsecond=0)
+    UserTime.objects.set(timedelta(minutes=30), user_id=user.id)
+    UserTime.objects.start_session(user_id=user.id, now=now)
+    UserTime.objects.bulk_apply([(user.username, None, timedelta(minutes=5))])
+    assert UserTime.objects.get(user=user).expires_at == now + timedelta(minutes=35)
+    UserTime.objects.bulk_apply([(user.username, timedelta(minutes=10), None)], now=now)
+    assert UserTime.objects.get(user=user).expires_at == now + timedelta(minutes=10)
+    user_time = UserTime.objects.get(user=user)
+    user_time.session_started_at = None
+    user_time.save()
+    assert UserTime.objects.get(user=user).expires_at is None
+
+
+@pytest.mark.django_db
+def test_expiry_scheduler_zeroes_due_sessions(user, django_capture_on_commit_callbacks):
+    """Test that the scheduler expires due sessions in one batch and skips topped-up ones."""
+    other = User.objects.create_user(username="otheruser", password=DEFAULT_PASSWORD)
+    idle = User.objects.create_user(username="idleuser", password=DEFAULT_PASSWORD)
+    started = timezone.now()
+    for account in (user, other):
+        UserTime.objects.set(timedelta(minutes=10), user_id=account.id)
+        UserTime.objects.start_session(user_id=account.id, now=started)
+    UserTime.objects.set(timedelta(minutes=1), user_id=idle.id)
+
+    scheduler = ExpiryScheduler(horizon=3600, refresh=60)
+    assert scheduler.run_pending(started) == []
+    assert scheduler.seconds_until_next(started) == 60
+    # Topped up after being scheduled, so it is no longer due
+    UserTime.objects.add(timedelta(minutes=5), user_id=other.id)
+
+    fired = []
+    session_expired.connect(lambda sender, user_times, **kwargs: fired.extend(user_times), weak=False, dispatch_uid="test")
+    try:
+        with django_capture_on_commit_callbacks(execute=True):
+            expired = scheduler.run_pending(started + timedelta(minutes=10))
+    finally:
+        session_expired.disconnect(dispatch_uid="test")
+
+    assert [user_time.user.username for user_time in expired] == [user.username]
+    assert fired == expired
+    user_time = UserTime.objects.get(user=user)
+    assert user_time.remaining_time == timedelta(0)
+    assert user_time.session_started_at is None and user_time.expires_at is None
+    assert UserTime.objects.get(user=other).session_started_at == started
+    assert UserTime.objects.get(user=idle).remaining_time == timedelta(minutes=1)
+
+
+class SharedBroker(InProcessBroker):
+    """Stands in for a broker shared between processes, such as ``RedisBroker``."""
+
+    process_local = False
+
+
+@pytest.mark.django_db
+def test_expiry_scheduler_reads_a_backlog_in_limited_loads(user):
+    """Test that a backlog larger than the load limit is read and expired in several passes."""
+    started = timezone.now() - timedelta(hours=1)
+    for number in range(3):
+        account = User.objects.create_user(username=f"user{number}", password=DEFAULT_PASSWORD)
+        UserTime.objects.set(timedelta(minutes=1), user_id=account.id)
+        UserTime.objects.start_session(user_id=account.id, now=started)
+
+    scheduler = ExpiryScheduler(horizon=3600, refresh=60, load_limit=2)
+    now = timezone.now()
+    assert len(scheduler.run_pending(now)) == 2
+    assert scheduler.seconds_until_next(now) == 0
+    assert len(scheduler.run_pending(now)) == 1
+    assert scheduler.seconds_until_next(now) == 60
+
+
+def test_expiry_scheduler_survives_failures(monkeypatch, caplog):
+    """Test that a failed pass is logged and retried with backoff instead of ending the loop."""
+    scheduler = ExpiryScheduler()
+    outcomes = [RuntimeError("database is down"), RuntimeError("database is down"), []]
+    waits = []
+
+    class Stop(threading.Event):
+        def wait(self, timeout=None):
+            waits.append(timeout)
+            if not outcomes:
+                self.set()
+
+    def run_pending(now):
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(scheduler, "run_pending", run_pending)
+    monkeypatch.setattr(scheduler, "seconds_until_next", lambda now: 10)
+    monkeypatch.setattr(expiry, "close_old_connections", lambda: None)
+    with caplog.at_level(logging.ERROR, logger="time_management.expiry"):
+        scheduler.run(Stop())
+    assert waits == [1, 2, 10]
+    assert [record.getMessage() for record in caplog.records] == [
+        "Expiring sessions failed, retrying in 1s.", "Expiring sessions failed, retrying in 2s.",
+    ]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_expiry_scheduler_command_once(user, monkeypatch):
+    """Test that the scheduler command refuses an in-process broker and pushes its expiries to subscribers."""
+    UserTime.objects.set(timedelta(minutes=1), user_id=user.id)
+    UserTime.objects.start_session(user_id=user.id, now=timezone.now() - timedelta(minutes=2))
+    with pytest.raises(CommandError, match="RedisBroker"):
+        call_command('runexpiryscheduler', '--once', stdout=io.StringIO())
+
+    monkeypatch.setattr(pubsub, "_broker", SharedBroker())
+    out = io.StringIO()
+
+    async def scenario():
+        queue = get_broker().subscribe(user.id)
+        await sync_to_async(call_command)('runexpiryscheduler', '--once', stdout=out)
+        return await asyncio.wait_for(queue.get(), 5)
+
+    assert asyncio.run(scenario()) == {'remaining_time': 0.0, 'session_started_at': None}
+    assert "Expired 1 sessions." in out.getvalue()
+    assert UserTime.objects.get(user=user).remaining_time == timedelta(0)
+
+
+@pytest.mark.django_db
+def test_ledger_records_every_balance_change(user):
+    """Test that each kind of balance change appends a ledger entry with the resulting balance."""
+    started = timezone.now()
+    UserTime.objects.add(timedelta(minutes=60), user_id=user.id)
+    UserTime.objects.start_session(user_id=user.id, now=started)
+    UserTime.objects.set(timedelta(minutes=50), username=user.username, now=started)
+    UserTime.objects.stop_session(user_id=user.id, now=started + timedelta(minutes=20))
+    UserTime.objects.bulk_apply([(user.username, None, timedelta(minutes=5))])
+    # Heartbeats that report an unchanged balance leave no entry
+    UserTime.objects.set(timedelta(minutes=35), user_id=user.id)
+    UserTime.objects.bulk_apply([(user.username, timedelta(minutes=35), None)])
+    entries = list(LedgerEntry.objects.filter(user=user).order_by('id').values_list('kind', 'balance'))
+    # The empty opening balance is implied
+    assert entries == [
+        ('purchase', timedelta(minutes=60)),
+        ('sync', timedelta(minutes=50)),
+        ('consumption', timedelta(minutes=30)),
+        ('purchase', timedelta(minutes=35)),
+    ]
+
+
+@pytest.mark.django_db
+def test_ledger_rollups_are_incremental(user, django_assert_max_num_queries):
+    """Test that roll-ups fold only new entries and match a rebuild from the whole ledger."""
+    other = User.objects.create_user(username="otheruser", password=DEFAULT_PASSWORD)
+    UserTime.objects.add(timedelta(minutes=60), user_id=user.id)
+    UserTime.objects.set(timedelta(minutes=45), user_id=user.id)
+    UserTime.objects.add(timedelta(minutes=30), user_id=other.id)
+    assert roll_up(settle=0) == 3
+    assert roll_up(settle=0) == 0
+
+    UserTime.objects.consume(timedelta(minutes=50), user_id=other.id)
+    UserTime.objects.set(timedelta(minutes=50), user_id=user.id)
+    # Entries newer than the settle delay wait for the next run
+    assert roll_up(settle=60) == 0
+    with django_assert_max_num_queries(10):
+        assert roll_up(settle=0) == 2
+
+    usage = UserUsage.objects.get(user=user)
+    assert (usage.purchased, usage.consumed, usage.corrected) == (
+        timedelta(minutes=60), timedelta(minutes=15), timedelta(minutes=5),
+    )
+    assert UserUsage.objects.get(user=other).consumed == timedelta(minutes=30)
+    daily = DailyUsage.objects.get(day=timezone.localdate())
+    assert (daily.purchased, daily.consumed, daily.entries) == (timedelta(minutes=90), timedelta(minutes=45), 5)
+
+    rolled_up = list(DailyUsage.objects.values_list('day', 'purchased', 'consumed', 'corrected', 'entries'))
+    assert rebuild_rollups(settle=0) == 5
+    assert list(DailyUsage.objects.values_list('day', 'purchased', 'consumed', 'corrected', 'entries')) == rolled_up
+
+
+@pytest.mark.django_db
+def test_daily_usage_report(api_client, user):
+    """Test that the usage report is served to staff from the rollups."""
+    UserTime.objects.add(timedelta(minutes=15), user_id=user.id)
+    roll_up(settle=0)
+    url = reverse('daily-usage-report')
+    api_client.force_authenticate(user)
+    assert api_client.get(url).status_code == status.HTTP_403_FORBIDDEN
+
+    user.is_staff = True
+    today = timezone.localdate().isoformat()
+    response = api_client.get(url, {"from": today, "to": today})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.data["days"] == [
+        {"day": today, "purchased": "00:15:00", "consumed": "00:00:00", "corrected": "00:00:00", "entries": 1},
+    ]
+    assert api_client.get(url, {"from": "2026-13-01"}).status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.django_db
+def test_export_streams_balances_and_ledger(api_client, user, django_assert_num_queries):
+    """Test that staff can stream the balances and the ledger as CSV, NDJSON and gzip."""
+    other = User.objects.create_user(username="otheruser", password=DEFAULT_PASSWORD)
+    UserTime.objects.add(timedelta(minutes=15), user_id=user.id)
+    url = reverse('export', kwargs={"dataset": "balances"})
+    api_client.force_authenticate(user)
+    assert api_client.get(url).status_code == status.HTTP_403_FORBIDDEN
+
+    user.is_staff = True
+    response = api_client.get(url)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.streaming and response['Content-Type'] == 'text/csv'
+    with django_assert_num_queries(1):
+        lines = b"".join(response.streaming_content).decode().splitlines()
+    assert lines[0] == "user_id,username,remaining_seconds,session_started_at,expires_at,version,updated_at"
+    assert [line.split(",")[:3] for line in lines[1:]] == [
+        [str(user.id), user.username, "900"], [str(other.id), "otheruser", "0"],
+    ]
+
+    response = api_client.get(reverse('export', kwargs={"dataset": "ledger"}), {"output": "ndjson", "gzip": "1"})
+    assert response['Content-Disposition'] == 'attachment; filename="ledger.ndjson.gz"'
+    entries = [json.loads(line) for line in gzip.decompress(b"".join(response.streaming_content)).splitlines()]
+    assert [(entry["username"], entry["kind"], entry["balance_seconds"]) for entry in entries] == [
+        (user.username, "purchase", 900),
+    ]
+    assert api_client.get(url, {"output": "xml"}).status_code == status.HTTP_400_BAD_REQUEST
+    assert api_client.get(reverse('export', kwargs={"dataset": "users"})).status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.django_db(transaction=True)
+def test_export_streams_over_asgi(user, settings, monkeypatch):
+    """Test that under ASGI the export is sent chunk by chunk, not collected before the first byte."""
+    for number in range(5):
+        User.objects.create_user(username=f"user{number}", password=DEFAULT_PASSWORD)
+    admin = User.objects.create_superuser(username="admin", password=DEFAULT_PASSWORD)
+    settings.TIME_EXPORT_CHUNK_SIZE = 1
+    read = []
+    rows = export.rows
+
+    def counting_rows(*args, **kwargs):
+        for row in rows(*args, **kwargs):
+            read.append(row)
+            yield row
+
+    monkeypatch.setattr(export, "rows", counting_rows)
+
+    async def scenario():
+        client = AsyncClient()
+        await client.aforce_login(admin)
+        response = await client.get(reverse('export', kwargs={"dataset": "balances"}), {"output": "ndjson"})
+        assert response.is_async
+        chunks = aiter(response.streaming_content)
+        first = await anext(chunks)
+        read_before_first = len(read)
+        return first, read_before_first, [first, *[chunk async for chunk in chunks]]
+
+    first, read_before_first, chunks = asyncio.run(scenario())
+    assert read_before_first < len(read) == 7
+    assert len(chunks) == 7 and json.loads(first)["username"] == user.username
+
+
+@pytest.mark.django_db
+def test_export_command_in_chunks(user):
+    """Test that the export command writes every row however small the chunks are."""
+    User.objects.create_user(username="otheruser", password=DEFAULT_PASSWORD)
+    out = io.StringIO()
+    call_command('exportusage', 'balances', '--format', 'ndjson', '--chunk-size', '1', stdout=out)
+    assert [json.loads(line)["username"] for line in out.getvalue().splitlines()] == [user.username, "otheruser"]
+
+
+@pytest.mark.django_db
+def test_provision_users_command(tmp_path, user):
+    """Test that users and starting balances are bulk created from CSV with hashing on a process pool."""
+    users_file = tmp_path / "users.csv"
+    users_file.write_text(
+        "username,password,email,minutes\n"
+        "alice,Secret-pass-1,alice@example.com,30\n"
+        f"{user.username},whatever,,\n"
+        "bob,Secret-pass-2,,\n"
+        "alice,again,,\n"
+        "carol,,,-5\n"
+    )
+    out, err = io.StringIO(), io.StringIO()
+    call_command('provisionusers', str(users_file), '--workers', '2', '--chunk-size', '2', stdout=out, stderr=err)
+    assert "Created 2 users" in out.getvalue() and "skipped 3" in out.getvalue()
+    assert "Row 1 (testuser)" in err.getvalue() and "Row 3 (alice)" in err.getvalue()
+
+    alice = User.objects.get(username="alice")
+    assert alice.check_password("Secret-pass-1") and alice.email == "alice@example.com"
+    assert UserTime.objects.get(user=alice).remaining_time == timedelta(minutes=30)
+    assert UserTime.objects.get(user__username="bob").remaining_time == timedelta(0)
+    assert list(LedgerEntry.objects.filter(user__username__in=["alice", "bob"]).order_by('user__username')
+                .values_list('user__username', 'kind')) == [("alice", "purchase")]
+
+
+@pytest.mark.django_db
+def test_bulk_provision_endpoint(api_client, user, settings, django_assert_max_num_queries):
+    """Test that staff can provision users in bulk and that inserts are batched."""
+    settings.TIME_PROVISION_WORKERS = 2
+    url = reverse('bulk-provision-users')
+    api_client.force_authenticate(user)
+    assert api_client.post(url, {"users": []}, format='json').status_code == status.HTTP_403_FORBIDDEN
+
+    user.is_staff = True
+    users = [{"username": f"pc{number}", "minutes": 10} for number in range(20)]
+    with django_assert_max_num_queries(10):
+        response = api_client.post(url, {"users": users + [{"username": ""}]}, format='json')
+    assert response.status_code == status.HTTP_201_CREATED
+    assert response.data["created"] == 20
+    assert [error["row"] for error in response.data["errors"]] == [20]
+    assert not User.objects.get(username="pc0").has_usable_password()
+    assert UserTime.objects.filter(user__username__startswith="pc", remaining_time=timedelta(minutes=10)).count() == 20
+    assert api_client.post(url, {"users": "pc1"}, format='json').status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.django_db
+def test_provisioning_reports_usernames_taken_concurrently(monkeypatch):
+    """Test that users created by a concurrent call after the existence check are reported, not a crash."""
+    from time_management import provisioning
+    make_password = provisioning.make_password
+
+    def hash_while_another_call_inserts(password):
+        if not User.objects.filter(username="pc1").exists():
+            User.objects.create_user(username="pc1")
+        return make_password(password)
+
+    monkeypatch.setattr(provisioning, "make_password", hash_while_another_call_inserts)
+    rows = [{"username": f"pc{number}", "password": DEFAULT_PASSWORD} for number in range(3)]
+    result = provisioning.provision_users(rows, workers=1)
+    assert result["created"] == 2
+    assert result["errors"] == [{"row": 1, "username": "pc1", "error": provisioning.USERNAME_TAKEN}]
+    assert User.objects.get(username="pc2").check_password(DEFAULT_PASSWORD)
+
+
+@pytest.fixture
+def admin_client_with_balances(client, user):
+    admin = User.objects.create_superuser(username="admin", password=DEFAULT_PASSWORD)
+    client.force_login(admin)
+    for number in range(5):
+        User.objects.create_user(username=f"pc{number}", password=DEFAULT_PASSWORD)
+    return client
+
+
+@pytest.mark.django_db
+def test_user_time_admin_changelist_queries(admin_client_with_balances, django_assert_max_num_queries):
+    """Test that the changelist query count does not grow with the number of rows and search works."""
+    url = reverse('admin:time_management_usertime_changelist')
+    with django_assert_max_num_queries(8):
+        response = admin_client_with_balances.get(url)
+    assert response.status_code == 200
+    assert response.context['cl'].result_count == 7
+    response = admin_client_with_balances.get(url, {"q": "pc"})
+    assert response.context['cl'].result_count == 5
+
+
+@pytest.mark.django_db
+def test_user_time_admin_bulk_actions(admin_client_with_balances, user, django_assert_max_num_queries):
+    """Test that bulk top-up and zeroing update the selected balances at once and record them in the ledger."""
+    url = reverse('admin:time_management_usertime_changelist')
+    selected = list(UserTime.objects.filter(user__username__startswith="pc").values_list('pk', flat=True))
+    UserTime.objects.start_session(username="pc0")
+
+    with django_assert_max_num_queries(12):
+        response = admin_client_with_balances.post(
+            url, {"action": "add_minutes", "minutes": "30", "_selected_action": selected},
+        )
+    assert response.status_code == 302
+    assert set(UserTime.objects.filter(pk__in=selected).values_list('remaining_time', flat=True)) == {timedelta(minutes=30)}
+    assert UserTime.objects.get(user=user).remaining_time == timedelta(0)
+    pc0 = UserTime.objects.get(user__username="pc0")
+    assert pc0.expires_at == pc0.session_started_at + timedelta(minutes=30)
+    assert LedgerEntry.objects.filter(kind='purchase').count() == 5
+
+    admin_client_with_balances.post(url, {"action": "add_minutes", "minutes": "-5", "_selected_action": selected})
+    assert LedgerEntry.objects.filter(kind='purchase').count() == 5
+
+    admin_client_with_balances.post(url, {"action": "zero_balance", "_selected_action": selected[:2]})
+    assert list(UserTime.objects.filter(pk__in=selected[:2]).values_list('remaining_time', flat=True)) == [timedelta(0)] * 2
+    assert LedgerEntry.objects.filter(kind='correction').count() == 2
+
+
+@pytest.mark.django_db
+def test_user_time_admin_flushes_buffered_syncs(admin_client_with_balances, write_behind_buffer):
+    """Test that admin top-ups and edits are not overwritten by older buffered syncs."""
+    pc0 = UserTime.objects.get(user__username="pc0")
+    write_behind_buffer.put("pc0", timedelta(minutes=10))
+    admin_client_with_balances.post(
+        reverse('admin:time_management_usertime_changelist'),
+        {"action": "add_minutes", "minutes": "30", "_selected_action": [pc0.pk]},
+    )
+    assert write_behind_buffer.flush() == 0
+    assert UserTime.objects.get(pk=pc0.pk).remaining_time == timedelta(minutes=40)
+
+    write_behind_buffer.put("pc0", timedelta(minutes=5))
+    admin_client_with_balances.post(
+        reverse('admin:time_management_usertime_change', args=[pc0.pk]),
+        {"user": pc0.user_id, "remaining_time": "01:00:00"},
+    )
+    assert write_behind_buffer.flush() == 0
+    assert UserTime.objects.get(pk=pc0.pk).remaining_time == timedelta(hours=1)
+
+
+def test_database_config_pool_modes():
+    """Test that DB_POOL selects a psycopg pool (the default), persistent connections or an external pooler."""
+    url = "postgres://app:secret@db:5432/pcs"
+    pooled = database_config(url, {"DB_POOL_MAX_SIZE": "20", "DB_CONNECT_TIMEOUT": "5"})
+    assert pooled["CONN_MAX_AGE"] == 0
+    assert pooled["OPTIONS"]["pool"]["max_size"] == 20 and pooled["OPTIONS"]["connect_timeout"] == 5
+
+    persistent = database_config(url, {"DB_POOL": "persistent"})
+    assert (persistent["CONN_MAX_AGE"], persistent["CONN_HEALTH_CHECKS"]) == (600, True)
+    assert "pool" not in persistent["OPTIONS"]
+    # Databases without a psycopg pool open a connection per request by default
+    assert database_config("sqlite:///replica.sqlite3", {})["CONN_MAX_AGE"] == 0
+
+    external = database_config(url, {"DB_POOL": "external", "DB_CONN_MAX_AGE": "60"})
+    assert (external["CONN_MAX_AGE"], external["DISABLE_SERVER_SIDE_CURSORS"]) == (60, True)
+    assert database_config(url, {"DB_POOL": "none"})["CONN_MAX_AGE"] == 0
+    with pytest.raises(ValueError):
+        database_config(url, {"DB_POOL": "bouncer"})
+
+
+@pytest.mark.django_db(transaction=True)
+def test_replica_router_keeps_read_your_writes(client, user, settings):
+    """Test that reads go to a replica unless the client or thread wrote recently or a transaction is open."""
+    settings.REPLICA_DATABASES = ['replica1']
+    replica_router = ReplicaRouter()
+    assert replica_router.db_for_read(UserTime) == 'replica1'
+    assert replica_router.db_for_read(OutstandingToken) == 'default'
+    with transaction.atomic():
+        assert replica_router.db_for_read(UserTime) == 'default'
+    assert replica_router.db_for_write(UserTime) == 'default'
+    assert replica_router.db_for_read(UserTime) == 'default'
+    assert not replica_router.allow_migrate('replica1', 'time_management')
+
+    # A request that writes sets the pin cookie; a read-only request does not.
+    # The primary stands in for the replica, which tests do not configure.
+    settings.REPLICA_DATABASES = ['default']
+    settings.DATABASE_ROUTERS = ['time_management.routers.ReplicaRouter']
+    client.force_login(user)
+    response = client.post(reverse('start-user-session', kwargs={"username": user.username}))
+    assert response.status_code == status.HTTP_200_OK
+    assert response.cookies[routers.PIN_COOKIE]["max-age"] == settings.REPLICA_STICKY_SECONDS
+    client.cookies.pop(routers.PIN_COOKIE)
+    response = client.get(reverse('add-user-minutes', kwargs={"username": user.username}))
+    assert response.status_code == status.HTTP_200_OK
+    assert routers.PIN_COOKIE not in response.cookies
+
+    # Without replicas the middleware removes itself
+    settings.REPLICA_DATABASES = []
+    response = Client().post(reverse('start-user-session', kwargs={"username": user.username}))
+    assert routers.PIN_COOKIE not in response.cookies
+
+
+@pytest.mark.django_db
+def test_consumption_reports_are_idempotent_deltas(api_client, user, django_assert_max_num_queries):
+    """Test that usage reports apply once per device sequence and never undo a concurrent top-up."""
+    UserTime.objects.add(timedelta(minutes=60), user_id=user.id)
+    url = reverse('consume-user-time', kwargs={"username": user.username})
+    api_client.force_authenticate(user)
+
+    response = api_client.post(url, {"device_id": "pc-1", "sequence": 1, "consumed_seconds": 300}, format='json')
+    assert response.status_code == status.HTTP_200_OK
+    assert response.data["applied"] is True and response.data["remaining_time"] == "00:55:00"
+    # A top-up lands between reports, then the first report is retried
+    UserTime.objects.add(timedelta(minutes=30), user_id=user.id)
+    response = api_client.post(url, {"device_id": "pc-1", "sequence": 1, "consumed_seconds": 300}, format='json')
+    assert response.data["applied"] is False and response.data["remaining_time"] == "01:25:00"
+
+    UserTime.objects.consume_reported(timedelta(minutes=5), device_id="pc-2", sequence=1, user_id=user.id)
+    # Later reports update the device cursor and the balance without reading either first
+    with django_assert_max_num_queries(5):
+        UserTime.objects.consume_reported(timedelta(minutes=5), device_id="pc-1", sequence=2, user_id=user.id)
+    assert UserTime.objects.get(user=user).remaining_time == timedelta(minutes=75)
+    assert LedgerEntry.objects.filter(user=user, kind='consumption').count() == 3
+
+    assert api_client.post(url, {"device_id": "pc-1", "sequence": 3}, format='json').status_code == status.HTTP_400_BAD_REQUEST
+    for report in ({"sequence": 2**63, "consumed_seconds": 1}, {"sequence": 4, "consumed_seconds": 10**20}):
+        response = api_client.post(url, {"device_id": "pc-1", **report}, format='json')
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+    unknown = reverse('consume-user-time', kwargs={"username": "nobody"})
+    response = api_client.post(unknown, {"device_id": "pc-1", "sequence": 1, "consumed_seconds": 1}, format='json')
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_event_logging_is_lazy_sampled_and_backgrounded(settings):
+    """Test that events carry their fields, are sampled and are written by the background thread."""
+    stream = io.StringIO()
+    handler = logs.BackgroundHandler(stream, queue_size=100)
+    handler.setFormatter(logs.JSONFormatter())
+    event_logger = logs.get_event_logger("time_management.tests.events")
+    event_logger.logger.addHandler(handler)
+    event_logger.logger.setLevel(logging.INFO)
+    settings.LOG_SAMPLING = {"time_synced": 0.0}
+    try:
+        event_logger.debug("not_enabled", value=1)
+        event_logger.info("time_synced", username="someone")
+        event_logger.info("time_added", username="someone", minutes=15)
+        handler.dropped += 2
+        # Drops are exported with the metrics
+        assert "log_records_dropped_total 2\n" in metrics.render_log_stats()
+        handler.close()
+    finally:
+        event_logger.logger.removeHandler(handler)
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [(line["message"], line["level"]) for line in lines] == [("time_added", "INFO")]
+    assert lines[0]["username"] == "someone" and lines[0]["minutes"] == 15
+
+    record = logging.LogRecord("name", logging.INFO, __file__, 1, "time_added", None, None)
+    record.fields = {"username": "someone", "gzip": False}
+    assert logs.KeyValueFormatter().format(record).endswith('time_added username="someone" gzip=false')
+
+
+@pytest.mark.django_db
+def test_bootstrap_is_idempotent(monkeypatch):
+    """Test that bootstrap creates the admin once and reports its startup phases."""
+    monkeypatch.setenv("ADMIN_USER", "boss")
+    monkeypatch.setenv("ADMIN_PASSWORD", DEFAULT_PASSWORD)
+    out = io.StringIO()
+    call_command('bootstrap', stdout=out)
+    assert "Created the admin user 'boss'." in out.getvalue()
+    assert "migration check" in out.getvalue() and "migrate (" not in out.getvalue()
+    assert User.objects.get(username="boss").is_superuser
+
+    out = io.StringIO()
+    call_command('bootstrap', stdout=out)
+    assert "Created the admin user" not in out.getvalue() and "Bootstrapped in" in out.getvalue()
+
+
+@pytest.mark.django_db
+def test_bootstrap_warns_without_admin_password(monkeypatch):
+    """Test that bootstrap warns when it cannot create the admin user."""
+    monkeypatch.setenv("ADMIN_PASSWORD", "")
+    err = io.StringIO()
+    call_command('bootstrap', stdout=io.StringIO(), stderr=err)
+    assert "ADMIN_PASSWORD is empty" in err.getvalue() and "No superuser exists" in err.getvalue()
+    assert not User.objects.filter(is_superuser=True).exists()
+
+
+def test_process_local_backends_are_reported(settings):
+    """Test that the defaults are reported as per-process state and shared backends are not."""
+    settings.TIME_THROTTLE = {**settings.TIME_THROTTLE, 'RATES': {'sync': '3/min'}}
+    settings.TIME_SYNC_WRITE_BEHIND = {"ENABLED": True}
+    found = process_local_backends()
+    assert [message.split(" ")[0] for message in found] == [
+        "CACHES['balances']", "TIME_PUBSUB['BACKEND']", "TIME_THROTTLE['STORE']", "TIME_SYNC_WRITE_BEHIND['STORE']",
+    ]
+
+    settings.CACHES = {
+        **settings.CACHES,
+        "shared": {"BACKEND": "django.core.cache.backends.db.DatabaseCache", "LOCATION": "cache"},
+    }
+    settings.BALANCE_CACHE_ALIAS = "shared"
+    settings.TIME_PUBSUB = {"BACKEND": "time_management.pubsub.RedisBroker"}
+    settings.TIME_THROTTLE = {
+        **settings.TIME_THROTTLE, 'STORE': 'time_management.throttling.CacheBucketStore', 'STORE_OPTIONS': {'alias': 'shared'},
+    }
+    settings.TIME_SYNC_WRITE_BEHIND = {
+        "ENABLED": True, "STORE": "time_management.buffer.CacheStore", "STORE_OPTIONS": {"alias": "shared"},
+    }
+    assert process_local_backends() == []
+
+
+@pytest.mark.django_db
+def test_throttling_rejects_runaway_clients_with_retry_after(api_client, client, user, settings):
+    """Test that each client's bucket allows a burst, then answers 429 with Retry-After until it refills."""
+    settings.TIME_THROTTLE = {**settings.TIME_THROTTLE, 'RATES': {'sync': '3/min', 'login': '2/min', 'login_ip': '3/min'}}
+    url = reverse('sync-user-remaining-time', kwargs={"username": user.username})
+    api_client.force_authenticate(user)
+    for _ in range(3):
+        assert api_client.patch(url, {"remaining_time": 60}, format='json').status_code == status.HTTP_200_OK
+    response = api_client.patch(url, {"remaining_time": 60}, format='json')
+    assert response.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+    assert response["Retry-After"] == "20"
+
+    # Other users have their own buckets
+    other = User.objects.create_user(username="otheruser", password=DEFAULT_PASSWORD)
+    api_client.force_authenticate(other)
+    other_url = reverse('sync-user-remaining-time', kwargs={"username": other.username})
+    assert api_client.patch(other_url, {"remaining_time": 60}, format='json').status_code == status.HTTP_200_OK
+
+    # Logins are limited per username, and the async endpoint shares the bucket
+    login = {"username": user.username, "password": "wrong"}
+    for _ in range(2):
+        assert client.post(reverse('login'), login, content_type='application/json').status_code == status.HTTP_401_UNAUTHORIZED
+    response = client.post(reverse('async-login'), login, content_type='application/json')
+    assert response.status_code == status.HTTP_429_TOO_MANY_REQUESTS and response["Retry-After"] == "30"
+
+    # Logins are limited per address too, so rotating usernames does not escape the limit
+    login = {"username": "someone-else", "password": "wrong"}
+    response = client.post(reverse('login'), login, content_type='application/json')
+    assert response.status_code == status.HTTP_429_TOO_MANY_REQUESTS and response["Retry-After"] == "20"
+
+
+@pytest.mark.django_db
+def test_login_throttling_with_non_object_body(client, settings):
+    """Test that a login body that is not an object is throttled per address and rejected with 400."""
+    settings.TIME_THROTTLE = {**settings.TIME_THROTTLE, 'RATES': {'login': '1/min', 'login_ip': '6/min'}}
+    for body in ('["user"]', '42', '"user"'):
+        for name in ('login', 'async-login'):
+            response = client.post(reverse(name), body, content_type='application/json')
+            assert response.status_code == status.HTTP_400_BAD_REQUEST
+    response = client.post(reverse('login'), '["user"]', content_type='application/json')
+    assert response.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+
+
+def test_token_bucket_refills():
+    """Test that a bucket refills at its rate and never beyond its capacity."""
+    store = throttling.MemoryBucketStore()
+    capacity, refill_rate = throttling.parse_rate("2/s")
+    assert [store.take("key", capacity, refill_rate, 100.0) for _ in range(3)] == [0, 0, 0.5]
+    assert store.take("key", capacity, refill_rate, 100.5) == 0
+    assert [store.take("key", capacity, refill_rate, 200.0) for _ in range(3)] == [0, 0, 0.5]
+
+
+def test_token_buckets_evicted_least_recently_used(monkeypatch):
+    """Test that idle buckets are dropped by their own rate and the oldest go beyond the size limit."""
+    monkeypatch.setattr(throttling.MemoryBucketStore, "MAX_BUCKETS", 3)
+    store = throttling.MemoryBucketStore()
+    hourly, fast = throttling.parse_rate("10/hour"), throttling.parse_rate("10/s")
+    store.take("slow", *hourly, 100.0)
+    store.take("fast", *fast, 100.0)
+    store.take("other", *hourly, 101.0)
+    assert list(store._buckets) == ["slow", "fast", "other"]  # 'slow' is not full again yet, so it stays
+    store.take("slow", *hourly, 102.0)
+    assert list(store._buckets) == ["other", "slow"]  # 'fast' refilled at its own rate once it reached the LRU end
+    for index in range(5):
+        store.take(f"client{index}", *hourly, 103.0)
+    assert list(store._buckets) == ["client2", "client3", "client4"]
+
+
+def test_fast_json_renderer_matches_drf():
+    """Test that the fast renderer and parser round-trip the same JSON as DRF's."""
+    from decimal import Decimal
+    from rest_framework import serializers
+    from rest_framework.parsers import JSONParser
+    from rest_framework.renderers import JSONRenderer
+    from time_management.renderers import FastJSONParser, FastJSONRenderer
+
+    now = timezone.now().replace(microsecond=123456)
+    data = {"user": "pc1", "remaining_time": timedelta(minutes=15), "at": now, "price": Decimal("1.50"), "tags": ["é"]}
+    rendered = FastJSONRenderer().render(data, "application/json")
+    assert json.loads(rendered) == json.loads(JSONRenderer().render(data, "application/json"))
+    assert FastJSONParser().parse(io.BytesIO(rendered)) == JSONParser().parse(io.BytesIO(rendered))
+
+    class ItemsSerializer(serializers.Serializer):
+        items = serializers.ListField(child=serializers.IntegerField())
+
+    # List field errors are keyed by item index
+    serializer = ItemsSerializer(data={"items": [1, "x"]})
+    assert not serializer.is_valid() and 1 in serializer.errors["items"]
+    rendered = FastJSONRenderer().render(serializer.errors, "application/json")
+    assert json.loads(rendered) == json.loads(JSONRenderer().render(serializer.errors, "application/json"))
+
+
+@pytest.mark.django_db
+def test_remaining_seconds_field(api_client, user, settings):
+    """Test that balances carry a numeric 'remaining_seconds' only when TIME_REMAINING_SECONDS is on."""
+    access, _ = obtain_tokens(api_client, DEFAULT_USERNAME, DEFAULT_PASSWORD)
+    api_client.credentials(HTTP_AUTHORIZATION=f"Bearer {access}")
+    url = reverse("add-user-minutes", kwargs={"username": user.username})
+    response = api_client.patch(url, {"add_minutes": 15}, format="json")
+    assert response.json() == {"user": user.username, "remaining_time": "00:15:00"}
+
+    settings.TIME_REMAINING_SECONDS = True
+    response = api_client.patch(url, {"add_minutes": 15}, format="json")
+    assert response.json() == {"user": user.username, "remaining_time": "00:30:00", "remaining_seconds": 1800.0}
+    response = api_client.post(reverse("login"), {"username": DEFAULT_USERNAME, "password": DEFAULT_PASSWORD}, format="json")
+    assert response.json()["remaining_seconds"] == 1800.0
@@ -0,0 +1,188 @@
+"""
+Token-bucket throttling for the time endpoints.
+
+Each client gets a bucket per scope (``login``, ``sync``, ...), keyed by user
+id when authenticated and by IP address otherwise. A bucket holds up to
+``N`` tokens and refills at ``N`` per period, so ``'60/min'`` allows bursts
+of 60 requests and one request per second after that. Rejected requests get
+``429`` with a ``Retry-After`` header saying when the next token arrives.
+
+Rates come from ``TIME_THROTTLE['RATES']``; scopes without a rate are not
+throttled. The default ``MemoryBucketStore`` keeps buckets per process
+without locks: a bucket is replaced with a single dict assignment, so
+concurrent requests may occasionally both take the last token, which is the
+price of never blocking. ``CacheBucketStore`` shares buckets between
+processes through a Django cache, with the same best-effort semantics.
+"""
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils.module_loading import import_string
+from rest_framework.throttling import BaseThrottle
+
+DEFAULTS = {
+    'STORE': 'time_management.throttling.MemoryBucketStore',
+    'STORE_OPTIONS': {},
+    'RATES': {},
+}
+
+PERIODS = {'s': 1, 'sec': 1, 'm': 60, 'min': 60, 'h': 3600, 'hour': 3600, 'd': 86400, 'day': 86400}
+
+
+def parse_rate(rate):
+    """Parse ``'<count>/<period>'`` (e.g. ``'60/min'``) into ``(capacity, tokens per second)``."""
+    count, period = rate.split('/')
+    count = int(count)
+    return count, count / PERIODS[period]
+
+
+def _refill(bucket, capacity, refill_rate, now):
+    if bucket is None:
+        return capacity
+    tokens, stamp = bucket[0], bucket[1]
+    return min(capacity, tokens + (now - stamp) * refill_rate)
+
+
+class MemoryBucketStore:
+    """
+    Per-process buckets in a dict kept in least-recently-used order, updated
+    without locks.
+
+    Each bucket remembers when it will be full again. Full buckets (idle
+    clients) are dropped from the least recently used end as new tokens are
+    taken, as are the oldest buckets beyond ``MAX_BUCKETS``, so both cost
+    O(1) per take.
+    """
+
+    MAX_BUCKETS = 100000
+    process_local = True
+
+    def __init__(self):
+        self._buckets = OrderedDict()
+
+    def take(self, key, capacity, refill_rate, now):
+        """Take a token from the bucket at ``key``. Returns 0 or the seconds until a token is available."""
+        tokens = _refill(self._buckets.get(key), capacity, refill_rate, now)
+        if tokens < 1:
+            return (1 - tokens) / refill_rate
+        tokens -= 1
+        self._buckets[key] = (tokens, now, now + (capacity - tokens) / refill_rate)
+        try:
+            self._buckets.move_to_end(key)
+        except KeyError:
+            pass  # Evicted by another thread in between
+        self._evict(now)
+        return 0
+
+    def _evict(self, now):
+        buckets = self._buckets
+        while buckets:
+            try:
+                key = next(iter(buckets))
+                full_at = buckets[key][2]
+                if len(buckets) <= self.MAX_BUCKETS and now < full_at:
+                    return
+                del buckets[key]
+            except (KeyError, RuntimeError, StopIteration):
+                return  # Another thread changed the buckets; it evicts for us
+
+    def clear(self):
+        self._buckets = OrderedDict()
+
+
+class CacheBucketStore:
+    """Buckets shared by every process through a Django cache."""
+
+    KEY_PREFIX = 'throttle:'
+
+    def __init__(self, alias='default'):
+        self._cache = caches[alias]
+        self.process_local = isinstance(self._cache, LocMemCache)
+
+    def take(self, key, capacity, refill_rate, now):
+        tokens = _refill(self._cache.get(self.KEY_PREFIX + key), capacity, refill_rate, now)
+        if tokens < 1:
+            return (1 - tokens) / refill_rate
+        # Expire once the bucket would be full again
+        self._cache.set(self.KEY_PREFIX + key, (tokens - 1, now), int(capacity / refill_rate) + 1)
+        return 0
+
+
+_store = None
+_store_lock = threading.Lock()
+_rates = {}  # Parsed rates by rate string
+
+
+def get_bucket_store():
+    """Return the process-wide bucket store."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                config = {**DEFAULTS, **getattr(settings, 'TIME_THROTTLE', {})}
+                _store = import_string(config['STORE'])(**config['STORE_OPTIONS'])
+    return _store
+
+
+def check(scope, ident, now=None):
+    """Take a token for ``ident`` in ``scope``. Returns 0 when allowed, else the seconds to wait."""
+    rate = getattr(settings, 'TIME_THROTTLE', {}).get('RATES', {}).get(scope)
+    if rate is None:
+        return 0
+    parsed = _rates.get(rate)
+    if parsed is None:
+        parsed = _rates[rate] = parse_rate(rate)
+    return get_bucket_store().take(f'{scope}:{ident}', *parsed, time.time() if now is None else now)
+
+
+def client_ident(request, user_id=None):
+    """
+    The bucket owner: ``user:<id>`` for authenticated requests, ``ip:<address>``
+    otherwise (honouring ``X-Forwarded-For`` as DRF's ``NUM_PROXIES`` allows).
+    """
+    if user_id is None and getattr(request, 'user', None) is not None and request.user.is_authenticated:
+        user_id = request.user.id
+    if user_id is not None:
+        return f'user:{user_id}'
+    return f'ip:{BaseThrottle().get_ident(request)}'
+
+
+def check_buckets(buckets):
+    """Take a token from each ``(scope, ident)`` bucket. Returns 0 when all allowed, else the longest wait."""
+    return max([check(scope, ident) for scope, ident in buckets], default=0)
+
+
+def login_buckets(request, data):
+    """
+    Login attempts are limited per account, so a lab's PCs sharing one public
+    address can all log in, and per address at the higher ``login_ip`` rate,
+    so rotating usernames does not escape the limit. ``data`` is the request
+    body, not validated yet: without a username only the address is limited.
+    """
+    username = data.get('username') if isinstance(data, dict) else None
+    buckets = [('login', f'username:{username}')] if isinstance(username, str) else []
+    return buckets + [('login_ip', f'ip:{BaseThrottle().get_ident(request)}')]
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Throttles views by their ``throttle_scope`` with the rate configured for
+    it. Views may take tokens from other buckets instead with a
+    ``throttle_buckets(request)`` method returning ``(scope, ident)`` pairs.
+    """
+
+    def allow_request(self, request, view):
+        if hasattr(view, 'throttle_buckets'):
+            buckets = view.throttle_buckets(request)
+        elif getattr(view, 'throttle_scope', None) is not None:
+            buckets = [(view.throttle_scope, client_ident(request))]
+        else:
+            return True
+        self._wait = check_buckets(buckets)
+        return not self._wait
+
+    def wait(self):
+        return self._wait
@@ -0,0 +1,139 @@
+import logging
+import threading
+import time
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.tokens import BlacklistMixin, RefreshToken
+from rest_framework_simplejwt.utils import datetime_from_epoch
+
+logger = logging.getLogger(__name__)
+
+
+class BlacklistFilter:
+    """
+    In-process set of the JTIs of unexpired blacklisted tokens.
+
+    It answers "not blacklisted" for a refresh without a query. The set is
+    rebuilt from the database at most every ``rebuild_interval`` seconds and
+    tokens blacklisted by this process are added immediately, so a token
+    blacklisted by another process can still refresh for up to one interval.
+    Expired tokens are left out because they fail verification anyway.
+    """
+
+    def __init__(self, rebuild_interval):
+        self.rebuild_interval = rebuild_interval
+        self._jtis = frozenset()
+        self._built_at = None
+        self._lock = threading.Lock()
+
+    def __contains__(self, jti):
+        if self._built_at is None or time.monotonic() - self._built_at >= self.rebuild_interval:
+            self.rebuild()
+        return jti in self._jtis
+
+    def add(self, jti):
+        with self._lock:
+            self._jtis = self._jtis | {jti}
+
+    def rebuild(self):
+        jtis = frozenset(
+            BlacklistedToken.objects.filter(token__expires_at__gt=timezone.now())
+            .values_list('token__jti', flat=True)
+        )
+        with self._lock:
+            self._jtis = jtis
+            self._built_at = time.monotonic()
+
+
+_blacklist_filter = None
+_blacklist_filter_lock = threading.Lock()
+
+
+def get_blacklist_filter():
+    """Return the process-wide ``BlacklistFilter`` or ``None`` when ``TOKEN_BLACKLIST_FILTER`` is off."""
+    global _blacklist_filter
+    config = getattr(settings, 'TOKEN_BLACKLIST_FILTER', {})
+    if not config.get('ENABLED', False):
+        return None
+    if _blacklist_filter is None:
+        with _blacklist_filter_lock:
+            if _blacklist_filter is None:
+                _blacklist_filter = BlacklistFilter(config.get('REBUILD_INTERVAL', 30))
+    return _blacklist_filter
+
+
+class ClaimsRefreshToken(RefreshToken):
+    """
+    Refresh token carrying the user's username and staff flag.
+
+    The claims are copied into every access token minted from it, which lets
+    ``StatelessJWTAuthentication`` build the request user without a query.
+    Blacklist checks go through the ``BlacklistFilter`` when it is enabled.
+    """
+
+    @classmethod
+    def for_user(cls, user):
+        token = cls.mint(user)
+        token.outstanding_token(user).save()
+        return token
+
+    @classmethod
+    def mint(cls, user):
+        """Like ``for_user`` but without recording the token; see ``outstanding_token``."""
+        token = super(BlacklistMixin, cls).for_user(user)
+        token['username'] = user.get_username()
+        token['is_staff'] = user.is_staff
+        return token
+
+    def outstanding_token(self, user, encoded=None):
+        """The unsaved ``OutstandingToken`` row recording this token (``encoded`` saves signing it again)."""
+        return OutstandingToken(
+            user=user,
+            jti=self[api_settings.JTI_CLAIM],
+            token=encoded or str(self),
+            created_at=self.current_time,
+            expires_at=datetime_from_epoch(self['exp']),
+        )
+
+    def check_blacklist(self):
+        blacklist_filter = get_blacklist_filter()
+        if blacklist_filter is None:
+            return super().check_blacklist()
+        if self.payload[api_settings.JTI_CLAIM] in blacklist_filter:
+            raise TokenError("Token is blacklisted")
+
+    def blacklist(self):
+        result = super().blacklist()
+        blacklist_filter = get_blacklist_filter()
+        if blacklist_filter is not None:
+            blacklist_filter.add(self.payload[api_settings.JTI_CLAIM])
+        return result
+
+
+def prune_expired_tokens(batch_size=1000, now=None):
+    """
+    Delete expired outstanding tokens and their blacklist entries in batches.
+
+    Each batch runs in its own short transaction so pruning a large backlog
+    never holds locks for long. Returns the number of outstanding tokens deleted.
+    """
+    now = now or timezone.now()
+    deleted = 0
+    while True:
+        with transaction.atomic():
+            ids = list(
+                OutstandingToken.objects.filter(expires_at__lte=now)
+                .order_by()
+                .values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            BlacklistedToken.objects.filter(token_id__in=ids).delete()
+            OutstandingToken.objects.filter(id__in=ids).delete()
+        deleted += len(ids)
+        logger.debug("Pruned %d expired tokens.", len(ids))
+    return deleted
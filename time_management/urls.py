@@ -1,13 +1,32 @@
 from django.urls import path
-from .views import RegisterUserView, UserTimeView, UpdateUserTimeView, LoginUserView, LogoutUserView
+from .views import (
+    RegisterUserView, UserTimeView, UpdateUserTimeView, ConsumeUserTimeView, LoginUserView, LogoutUserView, StartSessionView, StopSessionView,
+    BulkUserTimeView, BulkProvisionUsersView, DailyUsageReportView, ExportView,
+)
+from . import async_views
 from rest_framework_simplejwt.views import ( TokenObtainPairView, TokenRefreshView, )
 
 urlpatterns = [
     path('register/', RegisterUserView.as_view(), name='register'),
     path('login/', LoginUserView.as_view(), name='login'),
     path('logout/', LogoutUserView.as_view(), name='logout'),
+    path('users/bulk/', BulkProvisionUsersView.as_view(), name='bulk-provision-users'),
+    path('users/time/bulk/', BulkUserTimeView.as_view(), name='bulk-sync-user-time'),
     path('users/<str:username>/time/', UserTimeView.as_view(), name='add-user-minutes'),
     path('users/<str:username>/time/update/', UpdateUserTimeView.as_view(), name='sync-user-remaining-time'),
+    path('users/<str:username>/time/consume/', ConsumeUserTimeView.as_view(), name='consume-user-time'),
+    path('users/<str:username>/session/start/', StartSessionView.as_view(), name='start-user-session'),
+    path('users/<str:username>/session/stop/', StopSessionView.as_view(), name='stop-user-session'),
+    path('reports/usage/daily/', DailyUsageReportView.as_view(), name='daily-usage-report'),
+    path('reports/export/<str:dataset>/', ExportView.as_view(), name='export'),
+    # Native async endpoints for ASGI deployments
+    path('async/login/', async_views.login_user, name='async-login'),
+    path('async/logout/', async_views.logout_user, name='async-logout'),
+    path('async/users/<str:username>/time/', async_views.add_user_minutes, name='async-add-user-minutes'),
+    path('async/users/<str:username>/time/update/', async_views.sync_user_remaining_time, name='async-sync-user-remaining-time'),
+    path('async/users/<str:username>/time/stream/', async_views.stream_user_time, name='async-stream-user-time'),
+    path('async/users/<str:username>/session/start/', async_views.start_user_session, name='async-start-user-session'),
+    path('async/users/<str:username>/session/stop/', async_views.stop_user_session, name='async-stop-user-session'),
     path('api/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
 ]
@@ -1,65 +1,71 @@
-import logging
 from datetime import timedelta
-from django.contrib.auth import authenticate
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_date
+from django.utils.http import http_date
 from rest_framework import generics, views, status
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated, AllowAny
-from rest_framework_simplejwt.tokens import RefreshToken
-from .models import UserTime
-from .serializers import UserSerializer, UserTimeSerializer
+from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
+from .authentication import time_endpoint_authentication_classes
+from .buffer import flush_pending, get_write_behind_buffer
+from .cache import balance_user_id, get_balance
+from .provisioning import provision_users
+from . import export
+from .login import log_in
+from .logs import get_event_logger
+from .models import DailyUsage, UserTime
+from .serializers import (
+    UserSerializer, UserTimeSerializer, BulkTimeItemSerializer, ConsumptionReportSerializer, DailyUsageSerializer,
+)
+from .throttling import login_buckets
+from .tokens import ClaimsRefreshToken
 
-# Initialize logger
-logger = logging.getLogger(__name__)
+logger = get_event_logger(__name__)
 
 # User Registration Endpoint
 class RegisterUserView(generics.CreateAPIView):
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permission_classes = [AllowAny]
+    throttle_scope = 'register'
 
     def create(self, request, *args, **kwargs):
-        logger.info("Attempting to register a new user.")
+        logger.debug('registration_started')
         response = super().create(request, *args, **kwargs)
-        logger.info(f"User '{response.data['username']}' registered successfully.")
+        logger.info('user_registered', username=response.data['username'])
         return response
 
 # User Login Endpoint
 class LoginUserView(views.APIView):
     permission_classes = [AllowAny]
+    throttle_scope = 'login'
+
+    def throttle_buckets(self, request):
+        return login_buckets(request, request.data)
 
     def post(self, request):
-        logger.info("Login attempt received.")
-        username = request.data.get('username')
-        password = request.data.get('password')
+        logger.debug('login_started')
+        data = request.data if isinstance(request.data, dict) else {}
+        username = data.get('username')
+        password = data.get('password')
 
         if not username or not password:
-            logger.warning("Login failed: missing username or password.")
+            logger.warning('login_failed', reason='missing_credentials')
             return Response(
                 {"error": "Both username and password are required."},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        user = authenticate(username=username, password=password)
-
-        if user:
-            logger.info(f"User '{username}' authenticated successfully.")
-            refresh = RefreshToken.for_user(user)
-            user_time = UserTime.objects.get(user=user)
-            remaining_time = user_time.remaining_time
+        body = log_in(request, username, password)
 
-            return Response(
-                {
-                    "success": True,
-                    "username": user.username,
-                    "remaining_time": str(remaining_time),
-                    "access": str(refresh.access_token),
-                    "refresh": str(refresh),
-                },
-                status=status.HTTP_200_OK
-            )
+        if body:
+            logger.info('login_succeeded', username=username)
+            return Response(body, status=status.HTTP_200_OK)
         else:
-            logger.warning(f"Login failed for username '{username}'. Invalid credentials.")
+            logger.warning('login_failed', username=username, reason='invalid_credentials')
             return Response(
                 {"error": "Invalid username or password."},
                 status=status.HTTP_401_UNAUTHORIZED
@@ -67,51 +73,281 @@ class LoginUserView(views.APIView):
 
 # User Logout Endpoint
 class LogoutUserView(views.APIView):
+    authentication_classes = time_endpoint_authentication_classes()
+
     def post(self, request):
-        logger.info("Logout attempt received.")
+        logger.debug('logout_started')
         try:
             refresh_token = request.data.get('refresh')
-            token = RefreshToken(refresh_token)
+            token = ClaimsRefreshToken(refresh_token)
             token.blacklist()
 
-            logger.info("User logged out successfully and token revoked.")
+            logger.info('logged_out')
             return Response({"success": True, "message": "Logged out successfully and token revoked."}, status=status.HTTP_200_OK)
         except Exception as e:
-            logger.warning(f"Logout failed: {e}")
+            logger.warning('logout_failed', error=str(e))
             return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
 
-# Add minutes bought to user's remaining time
+# Read the user's balance, or add minutes bought to it
 class UserTimeView(views.APIView):
+    authentication_classes = time_endpoint_authentication_classes()
+    throttle_scope = 'time'
+
+    def get(self, request, username):
+        time_buffer = get_write_behind_buffer()
+        buffered = time_buffer.get(username) if time_buffer is not None else None
+        if buffered is not None:
+            user_time = UserTime(user=User(username=username), remaining_time=buffered)
+            return Response(UserTimeSerializer(user_time).data, status=status.HTTP_200_OK)
+
+        state = get_balance(username)
+        if state is None:
+            logger.warning('time_read_failed', username=username, reason='user_not_found')
+            return Response({'error': 'User not found.'}, status=status.HTTP_404_NOT_FOUND)
+
+        user_time = UserTime(
+            user=User(username=username),
+            remaining_time=state['remaining_time'],
+            session_started_at=state['session_started_at'],
+        )
+        # The version changes with every balance write. A running session also
+        # changes the tag every TIME_BALANCE_ETAG_RESOLUTION seconds of countdown.
+        # updated_at stays put while a session counts down, so Last-Modified is
+        # only sent for balances that are not running.
+        etag = f'"{state["user_id"]}-{state["version"]}"'
+        last_modified = None
+        if state['session_started_at'] is not None:
+            resolution = getattr(settings, 'TIME_BALANCE_ETAG_RESOLUTION', 60)
+            etag = f'"{state["user_id"]}-{state["version"]}-{int(user_time.current_remaining_time.total_seconds() // resolution)}"'
+        elif state['updated_at']:
+            last_modified = int(state['updated_at'].timestamp())
+
+        not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if not_modified is not None:
+            return not_modified
+
+        response = Response(UserTimeSerializer(user_time).data, status=status.HTTP_200_OK)
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        response['Cache-Control'] = 'no-cache'
+        return response
+
     def patch(self, request, username):
-        user = User.objects.get(username=username)
-        user_time = user.time
         data = request.data
 
         if 'add_minutes' in data:
-            user_time.add_time(int(data['add_minutes']))
+            flush_pending(username)
+            user_time = UserTime.objects.add(timedelta(minutes=int(data['add_minutes'])), username=username)
+            if user_time is None:
+                logger.warning('time_add_failed', username=username, reason='user_not_found')
+                return Response({'error': 'User not found.'}, status=status.HTTP_404_NOT_FOUND)
             serializer = UserTimeSerializer(user_time)
-            logger.info(f"Added {data['add_minutes']} minutes for user '{username}'.")
+            logger.info('time_added', username=username, minutes=data['add_minutes'])
             return Response(serializer.data, status=status.HTTP_200_OK)
         else:
-            logger.warning(f"Failed to update time for user '{username}': 'add_minutes' field missing.")
+            logger.warning('time_add_failed', username=username, reason='add_minutes_missing')
             return Response({'error': 'add_minutes field is required'}, status=status.HTTP_400_BAD_REQUEST)
 
 # Sync User Time
 class UpdateUserTimeView(views.APIView):
+    authentication_classes = time_endpoint_authentication_classes()
+    throttle_scope = 'sync'
+
     def patch(self, request, username):
-        logger.info(f"Updating remaining time for user '{username}'.")
-        user = User.objects.get(username=username)
-        user_time = user.time
         data = request.data
 
         if 'remaining_time' in data:
             # Convert the incoming seconds to a timedelta
-            user_time.remaining_time = timedelta(seconds=int(data['remaining_time']))
-            user_time.save()
+            remaining_time = timedelta(seconds=int(data['remaining_time']))
+            time_buffer = get_write_behind_buffer()
+            if time_buffer is not None:
+                if balance_user_id(username) is None:
+                    logger.warning('time_sync_failed', username=username, reason='user_not_found')
+                    return Response({'error': 'User not found.'}, status=status.HTTP_404_NOT_FOUND)
+                # Coalesced with later syncs and persisted by the background flusher
+                time_buffer.put(username, remaining_time)
+                serializer = UserTimeSerializer(UserTime(user=User(username=username), remaining_time=remaining_time))
+                logger.info('time_synced', username=username, seconds=data['remaining_time'], buffered=True)
+                return Response(serializer.data, status=status.HTTP_200_OK)
+            user_time = UserTime.objects.set(remaining_time, username=username)
+            if user_time is None:
+                logger.warning('time_sync_failed', username=username, reason='user_not_found')
+                return Response({'error': 'User not found.'}, status=status.HTTP_404_NOT_FOUND)
             serializer = UserTimeSerializer(user_time)
-            logger.info(f"Updated remaining time for user '{username}' to {data['remaining_time']} seconds.")
+            logger.info('time_synced', username=username, seconds=data['remaining_time'])
             return Response(serializer.data, status=status.HTTP_200_OK)
         else:
-            logger.warning(f"Failed to update time for user '{username}': 'remaining_time' field missing.")
-            return Response({'error': 'remaining_time field is required'}, status=status.HTTP_400_BAD_REQUEST)
\ No newline at end of file
+            logger.warning('time_sync_failed', username=username, reason='remaining_time_missing')
+            return Response({'error': 'remaining_time field is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+# Report time used on a PC since its last report; safe to retry and to send to any node
+class ConsumeUserTimeView(views.APIView):
+    authentication_classes = time_endpoint_authentication_classes()
+    throttle_scope = 'sync'
+
+    def post(self, request, username):
+        serializer = ConsumptionReportSerializer(data=request.data)
+        if not serializer.is_valid():
+            logger.warning('usage_report_failed', username=username, errors=serializer.errors)
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        report = serializer.validated_data
+
+        flush_pending(username)
+        user_time, applied = UserTime.objects.consume_reported(
+            timedelta(seconds=report['consumed_seconds']),
+            device_id=report['device_id'],
+            sequence=report['sequence'],
+            username=username,
+        )
+        if user_time is None:
+            logger.warning('usage_report_failed', username=username, reason='user_not_found')
+            return Response({'error': 'User not found.'}, status=status.HTTP_404_NOT_FOUND)
+        if applied:
+            logger.info(
+                'usage_reported', username=username, device_id=report['device_id'],
+                sequence=report['sequence'], seconds=report['consumed_seconds'],
+            )
+        else:
+            logger.info('usage_report_replayed', username=username, device_id=report['device_id'], sequence=report['sequence'])
+        return Response({'applied': applied, **UserTimeSerializer(user_time).data}, status=status.HTTP_200_OK)
+
+# Sync many users' time in one request (lab controllers)
+class BulkUserTimeView(views.APIView):
+    authentication_classes = time_endpoint_authentication_classes()
+    throttle_scope = 'bulk'
+
+    def post(self, request):
+        items = request.data.get('items') if isinstance(request.data, dict) else request.data
+        if not isinstance(items, list):
+            logger.warning('bulk_sync_failed', reason='items_missing')
+            return Response({'error': 'A list of items is required.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        max_items = getattr(settings, 'TIME_BULK_SYNC_MAX_ITEMS', 1000)
+        if len(items) > max_items:
+            logger.warning('bulk_sync_failed', reason='too_many_items', items=len(items), limit=max_items)
+            return Response({'error': f'At most {max_items} items are allowed.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        item_serializers = [BulkTimeItemSerializer(data=item) for item in items]
+        changes = [
+            (
+                serializer.validated_data['username'],
+                timedelta(seconds=serializer.validated_data['remaining_time'])
+                if 'remaining_time' in serializer.validated_data else None,
+                timedelta(minutes=serializer.validated_data.get('add_minutes', 0)),
+            )
+            for serializer in item_serializers if serializer.is_valid()
+        ]
+        flush_pending(*{username for username, remaining_time, add in changes})
+        user_times = UserTime.objects.bulk_apply(changes)
+
+        results = []
+        for item, serializer in zip(items, item_serializers):
+            if serializer.errors:
+                username = item.get('username') if isinstance(item, dict) else None
+                results.append({'username': username, 'success': False, 'error': serializer.errors})
+                continue
+            username = serializer.validated_data['username']
+            if username not in user_times:
+                results.append({'username': username, 'success': False, 'error': 'User not found.'})
+            else:
+                results.append({'success': True, **UserTimeSerializer(user_times[username]).data})
+
+        logger.info('bulk_synced', applied=len(changes), items=len(items))
+        return Response({'results': results}, status=status.HTTP_200_OK)
+
+# Create many users and their starting balances at once (branch onboarding)
+class BulkProvisionUsersView(views.APIView):
+    permission_classes = [IsAdminUser]
+    throttle_scope = 'bulk'
+
+    def post(self, request):
+        rows = request.data.get('users') if isinstance(request.data, dict) else request.data
+        if not isinstance(rows, list):
+            logger.warning('bulk_provision_failed', reason='users_missing')
+            return Response({'error': 'A list of users is required.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        max_items = getattr(settings, 'TIME_PROVISION_MAX_ITEMS', 5000)
+        if len(rows) > max_items:
+            logger.warning('bulk_provision_failed', reason='too_many_users', users=len(rows), limit=max_items)
+            return Response({'error': f'At most {max_items} users are allowed.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Threads, not processes: forking a threaded server process is unsafe
+        result = provision_users(rows, workers=getattr(settings, 'TIME_PROVISION_WORKERS', None), processes=False)
+        return Response(result, status=status.HTTP_201_CREATED if result['created'] else status.HTTP_200_OK)
+
+# Start counting down the user's balance on the server
+class StartSessionView(views.APIView):
+    authentication_classes = time_endpoint_authentication_classes()
+    throttle_scope = 'session'
+
+    def post(self, request, username):
+        flush_pending(username)
+        user_time = UserTime.objects.start_session(username=username)
+        if user_time is None:
+            logger.warning('session_start_failed', username=username, reason='user_not_found')
+            return Response({'error': 'User not found.'}, status=status.HTTP_404_NOT_FOUND)
+        serializer = UserTimeSerializer(user_time)
+        logger.info('session_started', username=username, started_at=user_time.session_started_at)
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+# Stop the countdown and persist the time used
+class StopSessionView(views.APIView):
+    authentication_classes = time_endpoint_authentication_classes()
+    throttle_scope = 'session'
+
+    def post(self, request, username):
+        flush_pending(username)
+        user_time = UserTime.objects.stop_session(username=username)
+        if user_time is None:
+            logger.warning('session_stop_failed', username=username, reason='user_not_found')
+            return Response({'error': 'User not found.'}, status=status.HTTP_404_NOT_FOUND)
+        serializer = UserTimeSerializer(user_time)
+        logger.info('session_stopped', username=username, remaining_seconds=user_time.remaining_time.total_seconds())
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+# Minutes sold and used per day, read from the ledger rollups
+class DailyUsageReportView(views.APIView):
+    permission_classes = [IsAdminUser]
+    throttle_scope = 'reports'
+
+    def get(self, request):
+        days = DailyUsage.objects.order_by('day')
+        for param, lookup in (('from', 'day__gte'), ('to', 'day__lte')):
+            if param in request.query_params:
+                try:
+                    day = parse_date(request.query_params[param])
+                except ValueError:
+                    day = None
+                if day is None:
+                    return Response({'error': f"'{param}' must be a date (YYYY-MM-DD)."}, status=status.HTTP_400_BAD_REQUEST)
+                days = days.filter(**{lookup: day})
+        return Response({'days': DailyUsageSerializer(days, many=True).data}, status=status.HTTP_200_OK)
+
+# Every balance or ledger entry, streamed as CSV or NDJSON for reconciliation
+class ExportView(views.APIView):
+    permission_classes = [IsAdminUser]
+    throttle_scope = 'reports'
+
+    def get(self, request, dataset):
+        # Not ?format=, which DRF reserves for picking a renderer
+        output = request.query_params.get('output', 'csv')
+        compress = request.query_params.get('gzip', '').lower() in ('true', '1')
+        if dataset not in export.DATASETS:
+            return Response({'error': f"Unknown dataset '{dataset}'."}, status=status.HTTP_404_NOT_FOUND)
+        if output not in export.FORMATS:
+            return Response(
+                {'error': f"'output' must be one of: {', '.join(export.FORMATS)}."}, status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        chunk_size = getattr(settings, 'TIME_EXPORT_CHUNK_SIZE', 2000)
+        # ASGI servers stream only async iterators; a sync one would be read whole before sending
+        stream = export.aexport if isinstance(request._request, ASGIRequest) else export.export
+        response = StreamingHttpResponse(
+            stream(dataset, output, compress=compress, chunk_size=chunk_size),
+            content_type='application/gzip' if compress else export.FORMATS[output][0],
+        )
+        response['Content-Disposition'] = f'attachment; filename="{export.filename(dataset, output, compress)}"'
+        logger.info('export_started', dataset=dataset, output=output, gzip=compress)
+        return response